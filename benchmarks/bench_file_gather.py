@@ -0,0 +1,405 @@
+"""
+A benchmark suite for the file gathering code, which measures how gathering
+project files, coalescing build folders and calculating the deltas between
+manifests scale as projects grow.
+
+Synthetic project trees are generated in a temporary folder for every
+combination of tree shape and file count that is requested:
+
+    wide      many files spread over a few flat folders
+    deep      files spread along long chains of nested folders
+    large     a few large (1MB) files instead of many small ones
+    excludes  a wide tree with many exclude patterns, some of which match
+
+Each combination runs in its own process, so that the peak RSS reported is
+for that combination alone. Every phase produces one JSON object per line on
+standard output (or the file given with --output, which is appended to), so
+runs can be collected and compared between releases. For example:
+
+    python3 benchmarks/bench_file_gather.py --sizes 1000,10000,100000
+    python3 benchmarks/bench_file_gather.py --shapes deep --sizes 1000000
+
+Every record has these fields:
+
+    suite, revision, python, platform, timestamp   where the numbers came from
+    shape, size       the tree shape and the number of files requested
+    phase             which operation was measured
+    items, unit       how many things the phase handled (files, folders)
+    wall_s            elapsed wall clock time in seconds
+    per_s             items handled per second
+    read_syscalls     read and write system calls made during the phase, from
+    write_syscalls    /proc/self/io (null where that isn't available)
+    os_calls          calls to the instrumented os functions during the phase
+    peak_rss_kb       peak resident set size of the process so far, in KB
+
+The stored phases repeat the gather and the deltas with the manifests held in
+a SQLite manifest store, when the sqlite3 module is available.
+
+This is run outside of Sublime, with stub_sublime standing in for the
+Sublime API.
+"""
+from collections import Counter
+from threading import Lock
+import subprocess
+import importlib
+import argparse
+import platform
+import builtins
+import tempfile
+import shutil
+import types
+import json
+import time
+import sys
+import os
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+### ---------------------------------------------------------------------------
+
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_ROOT = os.path.dirname(_HERE)
+
+# The name that the plugin package is imported under while benchmarking.
+_PACKAGE = "remote_build_bench"
+
+_SHAPES = ("wide", "deep", "large", "excludes")
+_DEFAULT_SIZES = "1000,10000"
+
+# Generated files are given a modification time this far in the past, so
+# that the hash cache will store their hashes.
+_FILE_AGE = 3600
+
+# The fraction of files whose content is changed for the modified deltas.
+_MODIFIED_FRACTION = 0.01
+
+# The os functions whose calls are counted during each phase.
+_COUNTED_CALLS = ((os, "stat"), (os, "lstat"), (os, "scandir"),
+                  (os, "listdir"), (builtins, "open"))
+
+
+### ---------------------------------------------------------------------------
+
+
+def _load_plugin():
+    """
+    Install the Sublime stubs and import the plugin modules that are being
+    benchmarked, returning a tuple of the file_gather and manifest modules.
+    """
+    sys.path.insert(0, _HERE)
+    import stub_sublime
+
+    package = types.ModuleType(_PACKAGE)
+    package.__path__ = [_ROOT]
+    sys.modules[_PACKAGE] = package
+
+    return (importlib.import_module(_PACKAGE + ".file_gather"),
+            importlib.import_module(_PACKAGE + ".manifest"))
+
+
+def _write_file(path, data, mtime):
+    with open(path, "wb") as file:
+        file.write(data)
+    os.utime(path, (mtime, mtime))
+
+
+def _make_tree(root, shape, size):
+    """
+    Generate a synthetic tree of the given shape with (about) the given
+    number of files in the root folder. Returns a tuple of the folder entry
+    to gather and the list of every folder that was created.
+    """
+    mtime = time.time() - _FILE_AGE
+    folders = set([root])
+    folder = {"path": root}
+
+    def place(relative_dir, name, data):
+        path = os.path.join(root, relative_dir)
+        if path not in folders:
+            os.makedirs(path, exist_ok=True)
+            folders.add(path)
+        _write_file(os.path.join(path, name), data, mtime)
+
+    if shape == "wide":
+        for i in range(size):
+            place("d%04d" % (i // 1000), "f%07d.cs" % i, b"// file %d\n" % i * 8)
+
+    elif shape == "deep":
+        # Chains of 64 nested folders with 8 files at every level.
+        for i in range(size):
+            level = (i // 8) % 64
+            chain = ["b%05d" % (i // 512)] + ["l%02d" % n for n in range(level)]
+            place(os.path.join(*chain), "f%07d.cs" % i, b"// file %d\n" % i * 8)
+
+    elif shape == "large":
+        block = os.urandom(1048576)
+        for i in range(max(size // 1000, 4)):
+            place("d%04d" % (i // 100), "f%05d.bin" % i, b"%d" % i + block)
+
+    elif shape == "excludes":
+        # A quarter of the files are logs, and every tenth folder is a build
+        # output folder; both are excluded by the patterns below.
+        for i in range(size):
+            relative_dir = "d%04d" % (i // 100)
+            if (i // 100) % 10 == 9:
+                relative_dir = os.path.join(relative_dir, "obj")
+            ext = "log" if i % 4 == 0 else "cs"
+            place(relative_dir, "f%07d.%s" % (i, ext), b"// file %d\n" % i * 8)
+
+        folder["file_exclude_patterns"] = (["*.log", "*.tmp", "*.pdb"] +
+            ["*.gen%d" % n for n in range(200)] +
+            ["cache_%d_*.dat" % n for n in range(50)])
+        folder["folder_exclude_patterns"] = (["obj", "bin", ".git"] +
+            ["out%d" % n for n in range(50)] +
+            ["tmp_*_%d" % n for n in range(20)])
+
+    else:
+        raise ValueError("Unknown tree shape '{0}'".format(shape))
+
+    return folder, sorted(folders)
+
+
+### ---------------------------------------------------------------------------
+
+
+class _CallCounter():
+    """
+    Counts calls to the os functions in _COUNTED_CALLS by wrapping them for as
+    long as this is installed. Calls from any thread are counted.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.counts = Counter()
+        self.originals = []
+
+    def install(self):
+        for module, name in _COUNTED_CALLS:
+            original = getattr(module, name, None)
+            if original is None:
+                continue
+
+            self.originals.append((module, name, original))
+            setattr(module, name, self._wrap(name, original))
+
+    def uninstall(self):
+        for module, name, original in self.originals:
+            setattr(module, name, original)
+        self.originals = []
+
+    def _wrap(self, name, original):
+        def wrapper(*args, **kwargs):
+            with self.lock:
+                self.counts[name] += 1
+            return original(*args, **kwargs)
+        return wrapper
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.counts)
+
+
+def _proc_io():
+    """
+    Return the read and write system call counts for this process from
+    /proc/self/io, or None where that is not available.
+    """
+    try:
+        with open("/proc/self/io") as file:
+            values = dict(line.split(": ") for line in file.read().splitlines())
+        return int(values["syscr"]), int(values["syscw"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _peak_rss_kb():
+    """
+    Return the peak resident set size of this process in KB, or None if it
+    can't be determined.
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def _measure(counter, func):
+    """
+    Call the given function, returning a tuple of its result and a dictionary
+    of the measurements taken while it ran.
+    """
+    io = _proc_io()
+    calls = counter.snapshot()
+    start = time.perf_counter()
+
+    result = func()
+
+    elapsed = time.perf_counter() - start
+    calls = counter.snapshot() - calls
+    io_after = _proc_io()
+
+    return result, {
+        "wall_s": round(elapsed, 6),
+        "read_syscalls": io_after[0] - io[0] if io else None,
+        "write_syscalls": io_after[1] - io[1] if io else None,
+        "os_calls": dict(calls),
+        "peak_rss_kb": _peak_rss_kb()
+    }
+
+
+def _file_count(manifest):
+    return sum(len(files) for files in manifest.values())
+
+
+def _modified_copy(manifest_module, files, result=None):
+    """
+    Return a copy of the given Manifest, with the digests of a fraction of
+    the files in it changed. The copy is made into the given empty manifest,
+    or a new Manifest if there isn't one.
+    """
+    if result is None:
+        result = manifest_module.Manifest(files.algorithm)
+    for root, folder in files.items():
+        dst = result.folder(root)
+        for index, name in enumerate(sorted(folder)):
+            info = folder[name]
+            if index % int(1 / _MODIFIED_FRACTION) == 0:
+                info = manifest_module.FileRecord(name, info.last_modified,
+                                                  bytes(len(info.digest)))
+            dst.add(info)
+
+    return result
+
+
+def run_scenario(shape, size, workers, common):
+    """
+    Generate a tree of the given shape and size and run every phase against
+    it, writing one JSON record per phase to standard output.
+    """
+    file_gather, manifest = _load_plugin()
+    counter = _CallCounter()
+
+    root = tempfile.mkdtemp(prefix="rb_bench_tree_")
+    try:
+        folder, folders = _make_tree(root, shape, size)
+
+        def phase(name, func, items=None, unit="files"):
+            result, record = _measure(counter, func)
+            count = items(result) if callable(items) else items
+            record.update(common, shape=shape, size=size, phase=name,
+                          items=count, unit=unit,
+                          per_s=round(count / max(record["wall_s"], 1e-9), 1))
+            print(json.dumps(record, sort_keys=True), flush=True)
+            return result
+
+        gather = lambda **kwargs: file_gather.find_project_files(
+            None, folders=[folder], workers=workers, **kwargs)
+
+        counter.install()
+        try:
+            cold = phase("gather_cold", gather, _file_count)
+            warm = phase("gather_warm", gather, _file_count)
+            phase("gather_nohash", lambda: gather(hash_files=False), _file_count)
+            phase("gather_nocache", lambda: gather(use_cache=False), _file_count)
+
+            phase("coalesce_roots", lambda: file_gather._coalesce_roots(folders),
+                  len(folders), "folders")
+
+            modified = _modified_copy(manifest, cold)
+            plain = lambda files: {root: {name: dict(info) for name, info in f.items()}
+                                    for root, f in files.items()}
+            plain_cold, plain_modified = plain(cold), plain(modified)
+
+            count = _file_count(cold)
+            phase("deltas_identical",
+                  lambda: file_gather.calculate_fileset_deltas(cold, warm), count)
+            phase("deltas_modified",
+                  lambda: file_gather.calculate_fileset_deltas(modified, cold), count)
+            phase("deltas_dict",
+                  lambda: file_gather.calculate_fileset_deltas(plain_modified, plain_cold), count)
+
+            # The same gather and deltas with the manifests in a SQLite store.
+            manifest_store = importlib.import_module(_PACKAGE + ".manifest_store")
+            if manifest_store.sqlite3 is not None:
+                store = manifest_store.get_manifest_store()
+                stored = phase("gather_stored",
+                               lambda: gather(manifest=store.create("cold")), _file_count)
+                stored_modified = _modified_copy(manifest, cold, store.create("modified"))
+                phase("deltas_stored",
+                      lambda: file_gather.calculate_fileset_deltas(stored_modified, stored), count)
+                manifest_store.plugin_unloaded()
+        finally:
+            counter.uninstall()
+
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+        shutil.rmtree(sys.modules["sublime"].cache_path(), ignore_errors=True)
+
+
+### ---------------------------------------------------------------------------
+
+
+def _revision():
+    """
+    Return the git revision of the code being benchmarked, if known.
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=_ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark RemoteBuild file gathering")
+    parser.add_argument("--sizes", default=_DEFAULT_SIZES,
+                        help="comma separated file counts (default: %(default)s)")
+    parser.add_argument("--shapes", default=",".join(_SHAPES),
+                        help="comma separated tree shapes (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="hashing worker threads (default: based on CPU count)")
+    parser.add_argument("--output", default=None,
+                        help="append results to this file instead of standard output")
+    parser.add_argument("--scenario", nargs=2, metavar=("SHAPE", "SIZE"),
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--common", default="{}", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # In a child process, run just the one scenario we were given.
+    if args.scenario:
+        return run_scenario(args.scenario[0], int(args.scenario[1]), args.workers,
+                            json.loads(args.common))
+
+    common = {
+        "suite": "file_gather",
+        "revision": _revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    }
+
+    output = open(args.output, "a") if args.output else sys.stdout
+    try:
+        for shape in args.shapes.split(","):
+            for size in args.sizes.split(","):
+                print("Running {0} x {1}".format(shape, size), file=sys.stderr)
+                cmd = [sys.executable, os.path.abspath(__file__),
+                       "--scenario", shape, size, "--common", json.dumps(common)]
+                if args.workers is not None:
+                    cmd.extend(["--workers", str(args.workers)])
+
+                result = subprocess.run(cmd, stdout=subprocess.PIPE, check=True)
+                output.write(result.stdout.decode("utf-8"))
+                output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+A minimal stand in for the sublime and sublime_plugin modules, which only
+exist inside of Sublime Text. This provides just enough of the API for the
+file gathering code to be imported and run from a normal Python process.
+
+Importing this module registers the stubs in sys.modules, so it needs to be
+imported before any of the plugin modules are.
+"""
+import tempfile
+import types
+import sys
+
+
+### ---------------------------------------------------------------------------
+
+
+class Settings():
+    """
+    An in memory version of a sublime.Settings object.
+    """
+    def __init__(self):
+        self.values = {}
+        self.callbacks = {}
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+        for callback in list(self.callbacks.values()):
+            callback()
+
+    def add_on_change(self, tag, callback):
+        self.callbacks[tag] = callback
+
+    def clear_on_change(self, tag):
+        self.callbacks.pop(tag, None)
+
+
+_settings = {}
+_cache_path = tempfile.mkdtemp(prefix="rb_bench_cache_")
+
+
+def load_settings(name):
+    return _settings.setdefault(name, Settings())
+
+
+def cache_path():
+    return _cache_path
+
+
+def platform():
+    return {"win32": "windows", "darwin": "osx"}.get(sys.platform, "linux")
+
+
+def set_timeout(callback, delay=0):
+    callback()
+
+
+### ---------------------------------------------------------------------------
+
+
+sublime = types.ModuleType("sublime")
+sublime.Settings = Settings
+sublime.load_settings = load_settings
+sublime.cache_path = cache_path
+sublime.platform = platform
+sublime.set_timeout = set_timeout
+sublime.set_timeout_async = set_timeout
+
+sublime_plugin = types.ModuleType("sublime_plugin")
+sublime_plugin.WindowCommand = type("WindowCommand", (), {})
+sublime_plugin.TextCommand = type("TextCommand", (), {})
+sublime_plugin.EventListener = type("EventListener", (), {})
+
+sys.modules.setdefault("sublime", sublime)
+sys.modules.setdefault("sublime_plugin", sublime_plugin)
+
+
+### ---------------------------------------------------------------------------
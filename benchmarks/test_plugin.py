@@ -0,0 +1,425 @@
+"""
+Behavior checks for the parts of the plugin that can run without Sublime:
+the hash cache, manifest deltas, git index parsing, ignore file rules, the
+content defined chunker and bounded decompression of messages.
+
+These use unittest and stub_sublime, so they run from a normal Python
+process, either directly or through a test runner:
+
+    python3 benchmarks/test_plugin.py
+    python3 -m pytest benchmarks
+
+The git index checks need the git command line client, and are skipped when
+it isn't available.
+"""
+import subprocess
+import importlib
+import unittest
+import tempfile
+import hashlib
+import random
+import shutil
+import types
+import time
+import sys
+import os
+
+
+### ---------------------------------------------------------------------------
+
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_ROOT = os.path.dirname(_HERE)
+
+# The name that the plugin package is imported under while checking it.
+_PACKAGE = "remote_build_check"
+
+
+def _load_plugin():
+    """
+    Install the Sublime stubs and make the plugin importable as a package,
+    so that its relative imports work.
+    """
+    sys.path.insert(0, _HERE)
+    import stub_sublime
+
+    if _PACKAGE not in sys.modules:
+        package = types.ModuleType(_PACKAGE)
+        package.__path__ = [_ROOT]
+        sys.modules[_PACKAGE] = package
+
+
+def _plugin(name):
+    return importlib.import_module(_PACKAGE + "." + name)
+
+
+_load_plugin()
+chunker = _plugin("chunker")
+compression = _plugin("compression")
+git_index = _plugin("git_index")
+hash_cache = _plugin("hash_cache")
+ignore_files = _plugin("ignore_files")
+manifest = _plugin("manifest")
+messages = _plugin("messages")
+
+
+def _write_file(path, data, mtime=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(data)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+### ---------------------------------------------------------------------------
+
+
+class TempFolderTestCase(unittest.TestCase):
+    """
+    A test case that gets a fresh temporary folder for every test.
+    """
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix="rb_check_")
+        self.addCleanup(shutil.rmtree, self.folder, True)
+
+    def path(self, *names):
+        return os.path.join(self.folder, *names)
+
+
+class HashCacheTests(TempFolderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = hash_cache.HashCache(self.path("cache", "hashes.json"))
+        self.digest = hashlib.sha1(b"content").digest()
+
+    def test_recently_modified_files_are_not_cached(self):
+        name = self.path("tree", "new.txt")
+        _write_file(name, b"content")
+        self.cache.store(name, os.stat(name), self.digest)
+        self.assertIsNone(self.cache.lookup(name, os.stat(name)))
+
+    def test_entries_need_matching_stat_and_algorithm(self):
+        name = self.path("tree", "old.txt")
+        _write_file(name, b"content", time.time() - 3600)
+        self.cache.store(name, os.stat(name), self.digest)
+        self.assertEqual(self.cache.lookup(name, os.stat(name)), self.digest)
+        self.assertIsNone(self.cache.lookup(name, os.stat(name), "sha256"))
+
+        # The same size content written an hour later is a different file.
+        _write_file(name, b"CONTENT", time.time() - 1800)
+        self.assertIsNone(self.cache.lookup(name, os.stat(name)))
+
+    def test_paths_under_a_root(self):
+        mtime = time.time() - 3600
+        names = ["a.txt", os.path.join("sub", "b.txt"),
+                 os.path.join("sub", "deeper", "c.txt"), os.path.join("subway", "d.txt")]
+        for name in names:
+            _write_file(self.path("tree", name), b"content", mtime)
+            self.cache.store(self.path("tree", name), os.stat(self.path("tree", name)),
+                             self.digest)
+
+        self.cache.evict(self.path("tree", "a.txt"))
+        self.assertEqual(sorted(self.cache.paths(self.path("tree", "sub"))),
+                         [self.path("tree", names[1]), self.path("tree", names[2])])
+
+        # The folder index is rebuilt from the saved entries.
+        self.cache.save()
+        loaded = hash_cache.HashCache(self.cache.filename)
+        self.assertEqual(sorted(loaded.paths(self.path("tree"))),
+                         sorted(self.path("tree", name) for name in names[1:]))
+        self.assertEqual(loaded.paths(self.path("elsewhere")), [])
+
+
+### ---------------------------------------------------------------------------
+
+
+class ManifestDiffTests(unittest.TestCase):
+    def _folder(self, files, algorithm=None):
+        folder = manifest.FolderManifest(algorithm)
+        for name, content in files.items():
+            folder.add(manifest.FileRecord(name, 0, hashlib.sha1(content).digest()))
+        return folder
+
+    def _naive_diff(self, ours, theirs):
+        return (sorted(set(ours) - set(theirs)),
+                sorted(set(theirs) - set(ours)),
+                sorted(n for n in set(ours) & set(theirs) if ours[n] != theirs[n]))
+
+    def test_diff_matches_comparing_every_file(self):
+        rng = random.Random(13)
+        for _ in range(50):
+            files = {}
+            for i in range(rng.randrange(1, 60)):
+                depth = rng.randrange(4)
+                parts = ["d{0}".format(rng.randrange(3)) for _ in range(depth)]
+                files[os.path.join(*(parts + ["f{0}".format(i)]))] = b"x"
+
+            changed = dict(files)
+            for name in rng.sample(sorted(files), len(files) // 4):
+                action = rng.randrange(3)
+                if action == 0:
+                    del changed[name]
+                elif action == 1:
+                    changed[name] = b"y"
+                else:
+                    changed[os.path.join("new", name)] = b"z"
+
+            result = self._folder(changed).diff(self._folder(files))
+            self.assertEqual(tuple(sorted(part) for part in result),
+                             self._naive_diff(changed, files))
+
+    def test_identical_folders_have_no_differences(self):
+        files = {"a": b"1", os.path.join("b", "c"): b"2"}
+        self.assertEqual(self._folder(files).diff(self._folder(dict(files))), ([], [], []))
+
+    def test_different_algorithms_cannot_be_compared(self):
+        with self.assertRaises(ValueError):
+            self._folder({}, "sha1").diff(self._folder({}, "sha256"))
+
+
+### ---------------------------------------------------------------------------
+
+
+@unittest.skipIf(shutil.which("git") is None, "git is not available")
+class GitIndexTests(TempFolderTestCase):
+    def git(self, *args):
+        return subprocess.check_output(("git", "-C", self.folder) + args)
+
+    def setUp(self):
+        super().setUp()
+        self.git("init", "-q")
+        self.names = ["top.txt", "src/main.c", "src/main.h", "src/util/strings.c",
+                      "a" * 200 + "/" + "b" * 200]
+        for name in self.names:
+            _write_file(self.path(*name.split("/")), name.encode("utf-8"),
+                        time.time() - 3600)
+        self.git("add", ".")
+
+        _write_file(self.path("intent.txt"), b"later")
+        self.git("add", "--intent-to-add", "intent.txt")
+
+    def _staged(self):
+        """
+        Return what git says is in the index, as a dictionary of names and
+        binary blob hashes.
+        """
+        result = {}
+        for line in self.git("ls-files", "-s", "-z").split(b"\0"):
+            if line:
+                info, name = line.split(b"\t", 1)
+                result[name.decode("utf-8")] = bytes.fromhex(info.split()[1].decode("ascii"))
+        return result
+
+    def test_index_versions(self):
+        for version in (2, 3, 4):
+            self.git("update-index", "--index-version", str(version))
+            with open(self.path(".git", "index"), "rb") as file:
+                data = file.read()
+
+            # An intent to add entry needs extended flags, so git never writes
+            # a version 2 index here.
+            entries = git_index.parse_index(data)
+            self.assertEqual(int.from_bytes(data[4:8], "big"), max(version, 3))
+            self.assertEqual({n: e.sha1 for n, e in entries.items()}, self._staged())
+
+            self.assertFalse(entries["intent.txt"].trusted)
+            for name in self.names:
+                self.assertTrue(entries[name].matches(os.stat(self.path(*name.split("/")))))
+
+    def test_corrupt_index(self):
+        with open(self.path(".git", "index"), "rb") as file:
+            data = bytearray(file.read())
+
+        data[20] ^= 1
+        with self.assertRaises(ValueError):
+            git_index.parse_index(bytes(data))
+
+
+### ---------------------------------------------------------------------------
+
+
+class IgnoreRuleTests(TempFolderTestCase):
+    def setUp(self):
+        super().setUp()
+        _write_file(self.path(".gitignore"), "\n".join([
+            "# comment",
+            "*.log",
+            "!keep.log",
+            "/build",
+            "out/",
+            "doc/**/*.txt",
+            "!doc/**/readme.txt",
+            "\\#notes",
+            "trailing\\ ",
+        ]).encode("utf-8"))
+        _write_file(self.path("sub", ".gitignore"), b"!*.log\n/local\n")
+
+    def check(self, name, is_dir, expected):
+        name = name.replace("/", os.sep)
+        self.assertEqual(ignore_files.path_ignored(self.folder, name, is_dir), expected,
+                         "{0} {1}".format("folder" if is_dir else "file", name))
+
+    def test_negation(self):
+        self.check("a.log", False, True)
+        self.check("x/y/a.log", False, True)
+        self.check("keep.log", False, False)
+        self.check("x/keep.log", False, False)
+        self.check("doc/x/y/a.txt", False, True)
+        self.check("doc/x/readme.txt", False, False)
+
+        # Rules in a deeper ignore file override the ones above it.
+        self.check("sub/a.log", False, False)
+        self.check("sub/x/a.log", False, False)
+
+        # Nothing in an ignored folder can be brought back.
+        self.check("out/keep.log", False, True)
+
+    def test_anchoring(self):
+        self.check("build", False, True)
+        self.check("build", True, True)
+        self.check("build/a.c", False, True)
+        self.check("x/build", True, False)
+
+        self.check("doc/a.txt", False, True)
+        self.check("x/doc/a.txt", False, False)
+
+        self.check("sub/local", True, True)
+        self.check("local", True, False)
+        self.check("sub/x/local", True, False)
+
+    def test_folder_only_rules(self):
+        self.check("out", True, True)
+        self.check("x/out", True, True)
+        self.check("out", False, False)
+
+    def test_escapes(self):
+        self.check("#notes", False, True)
+        self.check("notes", False, False)
+        self.check("trailing ", False, True)
+        self.check("trailing", False, False)
+
+
+### ---------------------------------------------------------------------------
+
+
+def _reference_chunks(data):
+    """
+    Find the chunks in the given data one byte at a time: the gear hash is
+    reset at the start of every chunk, skips the minimum chunk size and cuts
+    after the first byte that leaves the bits of the cut mask clear.
+    """
+    chunks = []
+    offset = 0
+    while offset < len(data):
+        end = min(len(data) - offset, chunker.MAX_CHUNK_SIZE)
+        length = end
+        h = 0
+        for i in range(chunker.MIN_CHUNK_SIZE, end):
+            h = ((h << 1) + chunker._GEAR[data[offset + i]]) & 0xFFFFFFFF
+            if not h & chunker._CUT_MASK:
+                length = i + 1
+                break
+
+        chunks.append((offset, length, hashlib.sha1(data[offset:offset + length]).digest()))
+        offset += length
+
+    return chunks
+
+
+class ChunkerTests(TempFolderTestCase):
+    def _chunks(self, data, block_size):
+        instance = chunker.Chunker()
+        for offset in range(0, len(data), block_size):
+            instance.update(data[offset:offset + block_size])
+        return instance.finish()
+
+    def test_cut_points_match_reference(self):
+        rng = random.Random(11)
+        samples = [b"", b"x", bytes(rng.getrandbits(8) for _ in range(chunker.MIN_CHUNK_SIZE + 40)),
+                   bytes(rng.getrandbits(8) for _ in range(300000)),
+                   bytes(rng.choice(b"ab\0") for _ in range(150000)) + bytes(150000)]
+        for data in samples:
+            expected = _reference_chunks(data)
+            for block_size in (1000, 65536, 1048576):
+                self.assertEqual(self._chunks(data, block_size), expected,
+                                 "{0} bytes in blocks of {1}".format(len(data), block_size))
+
+    def test_chunk_sizes_are_bounded(self):
+        data = os.urandom(500000) + bytes(200000)
+        chunks = self._chunks(data, 65536)
+        self.assertEqual(sum(length for _, length, _ in chunks), len(data))
+        for _, length, _ in chunks[:-1]:
+            self.assertTrue(chunker.MIN_CHUNK_SIZE <= length <= chunker.MAX_CHUNK_SIZE)
+
+    def test_edits_only_change_nearby_chunks(self):
+        data = os.urandom(400000)
+        edited = data[:200000] + b"inserted" + data[200000:]
+        before = set(digest for _, _, digest in self._chunks(data, 65536))
+        after = [digest for _, _, digest in self._chunks(edited, 65536)]
+        self.assertLessEqual(len([d for d in after if d not in before]), 2)
+
+    def test_chunk_file(self):
+        data = os.urandom(200000)
+        _write_file(self.path("file.bin"), data)
+        self.assertEqual(chunker.chunk_file(self.path("file.bin")), _reference_chunks(data))
+
+
+### ---------------------------------------------------------------------------
+
+
+class CompressionTests(unittest.TestCase):
+    def test_round_trip(self):
+        data = b"remote build " * 1000
+        for codec in compression.CODECS:
+            packed = compression.compress(codec, data)
+            self.assertEqual(compression.decompress(codec, packed, len(data)), data)
+
+    def test_inflate_is_bounded(self):
+        bomb = compression.compress("deflate-6", bytes(10 * 1024 * 1024))
+        for limit in (0, 1000, 10 * 1024 * 1024 - 1):
+            with self.assertRaises(ValueError):
+                compression.decompress("deflate-6", bomb, limit)
+
+    def test_truncated_data(self):
+        packed = compression.compress("deflate-6", os.urandom(10000))
+        with self.assertRaises(ValueError):
+            compression.decompress("deflate-6", packed[:len(packed) // 2], 10000)
+
+    def _decode(self, msg):
+        return messages.ProtocolMessage.from_data(msg.encode()[4:])
+
+    def test_compressed_message(self):
+        msg = messages.FileDataMessage(b"a" * 100000)
+        wrapped = messages.CompressedMessage.wrap("deflate-6", msg)
+        self.assertIsInstance(wrapped, messages.CompressedMessage)
+        self.assertEqual(bytes(self._decode(wrapped).data), msg.data)
+
+    def test_compressed_message_lengths(self):
+        wrapped = messages.CompressedMessage.wrap("deflate-6",
+                                                  messages.FileDataMessage(b"a" * 100000))
+        wrapped.length -= 1
+        with self.assertRaises(ValueError):
+            self._decode(wrapped)
+
+        # A length over the limit is rejected before anything is inflated.
+        wrapped = messages.CompressedMessage(
+            "deflate-6", messages.CompressedMessage.max_length + 1, b"",
+            compression.compress("deflate-6", b"x"))
+        with self.assertRaises(ValueError):
+            self._decode(wrapped)
+
+    def test_nested_compressed_message(self):
+        inner = messages.CompressedMessage.wrap("deflate-6",
+                                                messages.FileDataMessage(b"a" * 100000))
+        outer = messages.CompressedMessage("deflate-6", len(inner.encode()) - 4, b"",
+                                           compression.compress("deflate-6",
+                                                                inner.encode()[4:]))
+        with self.assertRaises(ValueError):
+            self._decode(outer)
+
+
+### ---------------------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    unittest.main()
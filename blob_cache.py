@@ -0,0 +1,146 @@
+import sublime
+
+from collections import OrderedDict
+from threading import Lock
+
+
+### ---------------------------------------------------------------------------
+
+
+# The default total size (in bytes) of the content held in the blob cache, and
+# the largest file whose content is put into it; larger files are read from
+# disk again when they are sent. These can be changed with the
+# blob_cache_size and blob_cache_max_file settings.
+_DEFAULT_SIZE = 67108864
+_DEFAULT_MAX_FILE = 1048576
+
+
+### ---------------------------------------------------------------------------
+
+
+class BlobCache():
+    """
+    A bounded in memory cache of file content, keyed on the digest algorithm
+    and digest of the content. Files are put into the cache as they are read
+    to be hashed, so that sending them to the server doesn't need to read
+    them from disk a second time. Since the key is the digest, the content
+    for a key can never be stale.
+
+    The compressed form of content is cached here too, with the name of the
+    compression codec appended to the algorithm, so that files that haven't
+    changed aren't compressed again for every build.
+
+    When the total size of the cached content would exceed the capacity, the
+    least recently used content is evicted; content larger than max_file is
+    never cached. A capacity of 0 disables the cache.
+    """
+    def __init__(self, capacity=_DEFAULT_SIZE, max_file=_DEFAULT_MAX_FILE):
+        self.lock = Lock()
+        self.blobs = OrderedDict()
+        self.size = 0
+        self.capacity = capacity
+        self.max_file = max_file
+
+    def __len__(self):
+        return len(self.blobs)
+
+    def wants(self, size):
+        """
+        Return a boolean to indicate if content of the given size would be
+        kept if it was put into the cache; callers can use this to avoid
+        holding on to content that would just be thrown away.
+        """
+        return 0 < self.capacity and size <= min(self.max_file, self.capacity)
+
+    def resize(self, capacity, max_file):
+        """
+        Change the limits of the cache, evicting content as needed.
+        """
+        with self.lock:
+            self.capacity = capacity
+            self.max_file = max_file
+            for key in [k for k, v in self.blobs.items() if len(v) > max_file]:
+                self.size -= len(self.blobs.pop(key))
+            self._evict()
+
+    def _evict(self):
+        """
+        Evict the least recently used content until the cache is within its
+        capacity. This must be called with the lock held.
+        """
+        while self.blobs and self.size > self.capacity:
+            _, data = self.blobs.popitem(last=False)
+            self.size -= len(data)
+
+    def put(self, algorithm, digest, data):
+        """
+        Cache the given content, which has the given digest when hashed with
+        the named algorithm.
+        """
+        if not self.wants(len(data)):
+            return
+
+        key = (algorithm, digest)
+        with self.lock:
+            old = self.blobs.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+            self.blobs[key] = bytes(data)
+            self.size += len(data)
+            self._evict()
+
+    def get(self, algorithm, digest):
+        """
+        Return the cached content with the given digest, or None if it is not
+        in the cache.
+        """
+        key = (algorithm, digest)
+        with self.lock:
+            data = self.blobs.get(key)
+            if data is not None:
+                self.blobs.move_to_end(key)
+
+            return data
+
+    def clear(self):
+        with self.lock:
+            self.blobs.clear()
+            self.size = 0
+
+
+### ---------------------------------------------------------------------------
+
+
+_cache = None
+_cache_lock = Lock()
+
+
+def plugin_unloaded():
+    global _cache
+
+    with _cache_lock:
+        _cache = None
+
+
+def get_blob_cache():
+    """
+    Return the global blob cache, creating it the first time it is requested;
+    its limits are updated from the settings every time.
+    """
+    global _cache
+
+    settings = sublime.load_settings("RemoteBuild.sublime-settings")
+    capacity = settings.get("blob_cache_size", _DEFAULT_SIZE)
+    max_file = settings.get("blob_cache_max_file", _DEFAULT_MAX_FILE)
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = BlobCache(capacity, max_file)
+        elif (_cache.capacity, _cache.max_file) != (capacity, max_file):
+            _cache.resize(capacity, max_file)
+
+        return _cache
+
+
+### ---------------------------------------------------------------------------
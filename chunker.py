@@ -0,0 +1,249 @@
+from collections import OrderedDict, deque
+from threading import Lock
+import hashlib
+import os
+
+
+### ---------------------------------------------------------------------------
+
+
+# The bounds on the size of a chunk; no chunk (other than the last chunk in a
+# file) is smaller than the minimum, and none is larger than the maximum.
+MIN_CHUNK_SIZE = 2048
+MAX_CHUNK_SIZE = 65536
+
+# A chunk boundary occurs wherever the rolling hash has all of these bits
+# clear; 13 bits gives an average chunk size of around 8k. The high bits are
+# used because they depend on the most bytes of the hash window.
+_CUT_MASK = 0xFFF80000
+
+# The gear table used by the rolling hash, which maps every byte value to a
+# pseudo random 32 bit value. This is the first four bytes of the SHA-1 of
+# the byte, so that the server can easily construct the identical table.
+_GEAR = [int.from_bytes(hashlib.sha1(bytes([i])).digest()[:4], "big")
+            for i in range(256)]
+
+# The number of bytes that the rolling hash covers; it is shifted one bit for
+# every byte, so bytes further back than this have been shifted out of it.
+_WINDOW = 32
+
+# How much of a file is read and searched for chunk boundaries at once.
+_BLOCK_SIZE = 1048576
+
+# Tables for bytes.translate() that map every byte value to one of the bytes
+# of its (little endian) gear value, and tables that map the bytes of a hash
+# to 0 if they have none of the bits of the cut mask set.
+_GEAR_BYTES = [bytes((g >> (8 * k)) & 0xFF for g in _GEAR) for k in range(4)]
+_CLEAR_BYTE2 = bytes(0 if not (v << 16) & _CUT_MASK else 1 for v in range(256))
+_CLEAR_BYTE3 = bytes(0 if not (v << 24) & _CUT_MASK else 1 for v in range(256))
+
+# How many chunks in total are remembered for files that have already been
+# chunked, so that an unchanged file doesn't need to be chunked again for
+# every build; this covers around a gigabyte of files.
+_CACHE_SIZE = 131072
+
+
+### ---------------------------------------------------------------------------
+
+
+def _candidates(data, start):
+    """
+    Given a buffer of data, return a list of the positions in it from start
+    onward where the rolling hash of the window of bytes that ends at that
+    position (inclusive) has all of the bits of the cut mask clear.
+
+    Rather than hashing one byte at a time, the gear values of the bytes are
+    laid out in 64 bit lanes of one large integer and added to themselves,
+    shifted by one more lane and one more bit each time, so that every lane
+    ends up holding the hash of the window that ends there; the sum never
+    overflows a lane, so there are no carries between them. Doubling the
+    shift each time needs only five additions for a 32 byte window, and the
+    positions that pass the cut test are then found with bytes operations.
+    All of this happens in C, which is far faster than a loop over bytes.
+
+    The windows of the first few positions of the buffer are incomplete.
+    """
+    begin = max(0, start - (_WINDOW - 1))
+    block = bytes(data[begin:])
+    count = len(block)
+
+    lanes = bytearray(8 * count)
+    for k in range(4):
+        lanes[k::8] = block.translate(_GEAR_BYTES[k])
+
+    value = int.from_bytes(lanes, "little")
+    shift = 65
+    while shift < 65 * _WINDOW:
+        value += value << shift
+        shift *= 2
+
+    hashes = value.to_bytes(max(8 * count, (value.bit_length() + 7) // 8), "little")
+    clear2 = hashes[2:8 * count:8].translate(_CLEAR_BYTE2)
+    clear3 = hashes[3:8 * count:8].translate(_CLEAR_BYTE3)
+    clear = (int.from_bytes(clear2, "big") | int.from_bytes(clear3, "big")).to_bytes(count, "big")
+
+    result = []
+    index = clear.find(0, start - begin)
+    while index >= 0:
+        result.append(begin + index)
+        index = clear.find(0, index + 1)
+
+    return result
+
+
+def _find_cut(data, length, candidates, base):
+    """
+    Given a buffer of data, return the length of the first chunk in it; the
+    buffer must contain at least MAX_CHUNK_SIZE bytes unless it holds the end
+    of the file. This is a gear based rolling hash, which is reset at the
+    start of every chunk and skips the bytes of the minimum chunk size.
+
+    candidates is an iterable of the offsets (relative to base, the offset of
+    the buffer) in ascending order that _candidates() found in the buffer.
+    Only the first few bytes after the minimum chunk size are hashed here;
+    after that the hash covers a full window, and is the same as the one
+    that the candidates were found with.
+    """
+    end = min(length, MAX_CHUNK_SIZE)
+    if end <= MIN_CHUNK_SIZE:
+        return end
+
+    gear = _GEAR
+    h = 0
+    full = min(MIN_CHUNK_SIZE + _WINDOW - 1, end)
+    for cut in range(MIN_CHUNK_SIZE, full):
+        h = ((h << 1) + gear[data[cut]]) & 0xFFFFFFFF
+        if not h & _CUT_MASK:
+            return cut + 1
+
+    for position in candidates:
+        cut = position - base
+        if cut >= end:
+            break
+        if cut >= full:
+            return cut + 1
+
+    return end
+
+
+class Chunker():
+    """
+    Finds the content defined chunks in data that is given to it a block at
+    a time, so that a file can be chunked with the same reads that hash it.
+    Since chunk boundaries are based on content and not position, an edit to
+    a file only changes the chunks around the edit.
+
+    The (offset, length, SHA-1 digest) of every chunk found so far is in the
+    chunks list.
+    """
+    def __init__(self):
+        self.chunks = []
+
+        # The data from the start of the chunk that is being searched for, the
+        # offset of it in the content, and the offsets of the positions after
+        # it that _candidates() found.
+        self.data = bytearray()
+        self.offset = 0
+        self.candidates = deque()
+
+    def _cut(self):
+        cut = _find_cut(self.data, len(self.data), self.candidates, self.offset)
+        self.chunks.append((self.offset, cut, hashlib.sha1(self.data[:cut]).digest()))
+
+        self.offset += cut
+        del self.data[:cut]
+        while self.candidates and self.candidates[0] < self.offset:
+            self.candidates.popleft()
+
+    def update(self, block):
+        """
+        Add the given block of data, which follows any data that was given
+        before.
+        """
+        start = len(self.data)
+        self.data.extend(block)
+        self.candidates.extend(self.offset + c for c in _candidates(self.data, start))
+
+        while len(self.data) >= MAX_CHUNK_SIZE:
+            self._cut()
+
+    def finish(self):
+        """
+        Find the chunks in the data that remains once all of the data has been
+        given to update(), and return the list of all of the chunks.
+        """
+        while self.data:
+            self._cut()
+
+        return self.chunks
+
+
+_cache = OrderedDict()
+_cache_chunks = 0
+_cache_lock = Lock()
+
+
+def cached_chunks(key):
+    """
+    Return the chunks that were remembered for the content with the given key
+    (see chunk_file()), or None if they're not known.
+    """
+    with _cache_lock:
+        chunks = _cache.get(key)
+        if chunks is not None:
+            _cache.move_to_end(key)
+
+        return chunks
+
+
+def remember_chunks(key, chunks):
+    """
+    Remember the given chunks for the content with the given key, such as
+    when they were found with a Chunker while the content was being hashed.
+    """
+    global _cache_chunks
+
+    with _cache_lock:
+        old = _cache.pop(key, None)
+        if old is not None:
+            _cache_chunks -= len(old)
+
+        _cache[key] = chunks
+        _cache_chunks += len(chunks)
+        while _cache_chunks > _CACHE_SIZE and len(_cache) > 1:
+            _cache_chunks -= len(_cache.popitem(last=False)[1])
+
+
+def chunk_file(path, key=None):
+    """
+    Return the list of (offset, length, digest) chunks for the file with the
+    given absolute path. The chunk lists of recently chunked files are kept
+    and reused; key identifies the content of the file, such as its digest
+    algorithm and digest, so that the chunks of identical content are shared
+    no matter where it is. Without a key, the chunks are reused for as long
+    as the stat information of the file is unchanged.
+
+    Chunking a file reads all of it, so this should not be called from the
+    main thread.
+    """
+    if key is None:
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    chunks = cached_chunks(key)
+    if chunks is None:
+        chunker = Chunker()
+        with open(path, "rb") as file:
+            while True:
+                block = file.read(_BLOCK_SIZE)
+                if not block:
+                    break
+                chunker.update(block)
+
+        chunks = chunker.finish()
+        remember_chunks(key, chunks)
+
+    return chunks
+
+
+### ---------------------------------------------------------------------------
@@ -0,0 +1,111 @@
+import zlib
+
+from collections import OrderedDict
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+### ---------------------------------------------------------------------------
+
+
+def _deflate(level):
+    """
+    Return a function that compresses data into a raw deflate stream at the
+    given level. Raw streams (without the zlib header and checksum) are what
+    the DeflateStream class on the server reads and writes.
+    """
+    def compress(data):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    return compress
+
+
+def _inflate(data, max_length):
+    """
+    Decompress a raw deflate stream, which must decompress to no more than
+    max_length bytes; decompression stops as soon as the output gets that
+    big, so a bad or hostile stream can't make us run out of memory.
+    """
+    # A max_length of 0 means no limit at all to zlib, so ask for one byte
+    # more than the limit; getting it means the data is too long.
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    data = decompressor.decompress(data, max_length + 1)
+    if len(data) > max_length or decompressor.unconsumed_tail or not decompressor.eof:
+        raise ValueError("Compressed data is invalid or too long")
+
+    return data
+
+
+def _unxz(data, max_length):
+    """
+    Decompress an lzma stream in the same way as _inflate(); versions of
+    Python before 3.5 can't limit the output of the decompressor, so there
+    the length is only checked after the fact.
+    """
+    decompressor = lzma.LZMADecompressor()
+    try:
+        data = decompressor.decompress(data, max_length + 1)
+    except TypeError:
+        data = decompressor.decompress(data)
+
+    if len(data) > max_length or not decompressor.eof:
+        raise ValueError("Compressed data is invalid or too long")
+
+    return data
+
+
+# The codecs that messages can be compressed with, keyed on the name that they
+# are known by on the wire, with the functions that compress and decompress
+# data with them. The level of a deflate codec only matters to the end that
+# is compressing; any of them can be decompressed the same way.
+CODECS = OrderedDict([
+    ("deflate-1", (_deflate(1), _inflate)),
+    ("deflate-6", (_deflate(6), _inflate)),
+    ("deflate-9", (_deflate(9), _inflate)),
+])
+
+# Not every build of Python has the lzma module. The build server doesn't
+# support lzma, so it isn't offered by default (see compression_codecs).
+if lzma is not None:
+    CODECS["lzma"] = (lambda data: lzma.compress(data, check=lzma.CHECK_NONE),
+                      _unxz)
+
+
+### ---------------------------------------------------------------------------
+
+
+def supported_codecs(preferred):
+    """
+    Given a list of codec names in order of preference, return the ones that
+    are supported here, in the same order.
+    """
+    return [name for name in preferred if name in CODECS]
+
+
+def compress(codec, data):
+    """
+    Compress the given data with the named codec, returning bytes.
+    """
+    if codec not in CODECS:
+        raise ValueError("Unknown compression codec '{0}'".format(codec))
+
+    return CODECS[codec][0](data)
+
+
+def decompress(codec, data, max_length):
+    """
+    Decompress the given data, which was compressed with the named codec,
+    returning bytes. A ValueError is raised if the data decompresses to more
+    than max_length bytes.
+    """
+    if codec not in CODECS:
+        raise ValueError("Unknown compression codec '{0}'".format(codec))
+
+    return CODECS[codec][1](data, max_length)
+
+
+### ---------------------------------------------------------------------------
@@ -0,0 +1,257 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import multiprocessing
+import hashlib
+import time
+
+
+### ---------------------------------------------------------------------------
+
+
+# The algorithm used when none is specified; this is what all manifests used
+# before the algorithm was selectable.
+DEFAULT_ALGORITHM = "sha1"
+
+# The size of the slices of an in memory buffer that are handed to a hasher
+# at a time by digest_buffer(); this is also the leaf size of the tree hash
+# algorithms.
+_BLOCK_SIZE = 4194304
+
+
+### ---------------------------------------------------------------------------
+
+
+class DigestAlgorithm():
+    """
+    A named algorithm that can be used to calculate the digests of files and
+    the Merkle hashes of the manifests that contain them. new() returns a
+    fresh hashlib style object with update() and digest() methods.
+    """
+    def __init__(self, name, factory):
+        self.name = name
+        self.new = factory
+        self.digest_size = factory().digest_size
+
+    def __repr__(self):
+        return "<DigestAlgorithm name='{0}' digest_size={1}>".format(
+            self.name, self.digest_size)
+
+    def file_hasher(self, size):
+        """
+        Return a new hash object for hashing the content of a file of the
+        given size; for most algorithms, this is the same as new().
+        """
+        return self.new()
+
+    def digest_buffer(self, data):
+        """
+        Return the digest of the given buffer (such as a memoryview of a
+        mapped file), without making any copies of it.
+        """
+        view = memoryview(data)
+        hasher = self.file_hasher(len(view))
+        for offset in range(0, len(view), _BLOCK_SIZE):
+            hasher.update(view[offset:offset + _BLOCK_SIZE])
+
+        return hasher.digest()
+
+
+class _TreeHasher():
+    """
+    A hashlib style object for a tree hash. The data is split into fixed size
+    leaves which are hashed on their own, and the digest is the hash of the
+    concatenated leaf digests. Leaf and root hashes are given different
+    prefixes, so a leaf can never be mistaken for a root.
+    """
+    def __init__(self, base, leaf_size):
+        self.base = base
+        self.leaf_size = leaf_size
+        self.digest_size = base().digest_size
+        self.leaves = []
+        self.pending = bytearray()
+
+    def update(self, data):
+        self.pending.extend(data)
+        while len(self.pending) >= self.leaf_size:
+            self.leaves.append(_leaf_digest(self.base, self.pending[:self.leaf_size]))
+            del self.pending[:self.leaf_size]
+
+    def digest(self):
+        leaves = list(self.leaves)
+        if self.pending or not leaves:
+            leaves.append(_leaf_digest(self.base, self.pending))
+
+        return _root_digest(self.base, leaves)
+
+
+def _leaf_digest(base, data):
+    hasher = base(b"\x00")
+    hasher.update(data)
+    return hasher.digest()
+
+
+def _root_digest(base, leaves):
+    hasher = base(b"\x01")
+    for leaf in leaves:
+        hasher.update(leaf)
+    return hasher.digest()
+
+
+class TreeDigestAlgorithm(DigestAlgorithm):
+    """
+    A digest algorithm that tree hashes data with a base hashlib algorithm.
+    The result is different from the digest of the base algorithm, but the
+    leaves of a large buffer can be hashed on several cores at once, so that
+    hashing a single huge file is not limited to the speed of one core.
+    """
+    def __init__(self, name, base, leaf_size=_BLOCK_SIZE):
+        super().__init__(name, lambda: _TreeHasher(base, leaf_size))
+        self.base = base
+        self.leaf_size = leaf_size
+
+    def digest_buffer(self, data):
+        view = memoryview(data)
+        offsets = range(0, len(view), self.leaf_size)
+        if len(offsets) < 2:
+            return super().digest_buffer(view)
+
+        leaves = _leaf_pool().map(
+            lambda offset: _leaf_digest(self.base, view[offset:offset + self.leaf_size]),
+            offsets)
+
+        return _root_digest(self.base, list(leaves))
+
+
+class GitBlobAlgorithm(DigestAlgorithm):
+    """
+    A digest algorithm that hashes files the way that git hashes blobs; the
+    content is prefixed with a header that contains its size. The digest of
+    an unmodified tracked file is thus the one already in the git index, so
+    gathering can take it from there instead of reading the file. Anything
+    else (such as the Merkle tree of a manifest) is hashed with plain sha1.
+    """
+    def __init__(self, name):
+        super().__init__(name, hashlib.sha1)
+
+    def file_hasher(self, size):
+        return hashlib.sha1("blob {0}\0".format(size).encode("ascii"))
+
+
+_registry = {}
+
+
+def register_algorithm(name, factory):
+    """
+    Register a digest algorithm under the given name; factory is called with
+    no arguments to create a new hash object. Registering a name a second
+    time replaces the previous algorithm.
+    """
+    _registry[name] = DigestAlgorithm(name, factory)
+
+
+def register_tree_algorithm(name, base):
+    """
+    Register a tree hash algorithm under the given name, which uses the given
+    hashlib constructor to hash the leaves and the root of the tree.
+    """
+    _registry[name] = TreeDigestAlgorithm(name, base)
+
+
+def get_algorithm(name=None):
+    """
+    Return the DigestAlgorithm with the given name, or the default algorithm
+    if the name is None. A ValueError is raised for an unknown algorithm.
+    """
+    name = DEFAULT_ALGORITHM if name is None else name
+    algorithm = _registry.get(name)
+    if algorithm is None:
+        raise ValueError("Unknown digest algorithm '{0}'; expected one of {1}".format(
+            name, ", ".join(available_algorithms())))
+
+    return algorithm
+
+
+def available_algorithms():
+    """
+    Return a sorted list of the names of all registered algorithms.
+    """
+    return sorted(_registry)
+
+
+# The hashlib algorithms that we offer, when this version of Python has them;
+# the blake2 and sha3 families only appeared in Python 3.6.
+for _name in ("sha1", "sha256", "sha512", "md5", "blake2b", "blake2s", "sha3_256"):
+    if hasattr(hashlib, _name):
+        register_algorithm(_name, getattr(hashlib, _name))
+
+# Tree hash variants of the most useful of the above.
+for _name in ("sha1", "sha256", "blake2b"):
+    if hasattr(hashlib, _name):
+        register_tree_algorithm(_name + "-tree", getattr(hashlib, _name))
+
+_registry["git"] = GitBlobAlgorithm("git")
+
+
+### ---------------------------------------------------------------------------
+
+
+_pool = None
+_pool_lock = Lock()
+
+
+def plugin_unloaded():
+    global _pool
+
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+            _pool = None
+
+
+def _leaf_pool():
+    """
+    Return the pool of threads that the leaves of tree hashes are hashed on,
+    creating it the first time it is needed. This is separate from the pool
+    that gathers files, since tasks in that pool wait on these.
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            try:
+                workers = multiprocessing.cpu_count()
+            except NotImplementedError:
+                workers = 1
+
+            _pool = ThreadPoolExecutor(max_workers=workers)
+
+        return _pool
+
+
+### ---------------------------------------------------------------------------
+
+
+def benchmark(names=None, size=67108864):
+    """
+    Measure how quickly each of the given algorithms (all of them by default)
+    can hash data on this machine, returning a dictionary that maps the name
+    of each algorithm to its throughput in MB/s. The data is hashed as one
+    buffer of the given size, the same way that large files are hashed while
+    gathering, so tree hash algorithms hash it on several cores.
+    """
+    names = available_algorithms() if names is None else names
+    data = bytes(range(256)) * max(size // 256, 1)
+
+    results = {}
+    for name in names:
+        algorithm = get_algorithm(name)
+        start = time.perf_counter()
+        algorithm.digest_buffer(data)
+        elapsed = time.perf_counter() - start
+
+        results[name] = len(data) / (1024 * 1024) / max(elapsed, 1e-9)
+
+    return results
+
+
+### ---------------------------------------------------------------------------
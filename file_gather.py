@@ -1,145 +1,632 @@
 import sublime
 import sublime_plugin
 
-import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from threading import Lock
+import multiprocessing
 import fnmatch
+import mmap
 import os
-from os.path import dirname, basename
+import re
+
+from .hash_cache import get_hash_cache
+from .blob_cache import get_blob_cache
+from .manifest import Manifest, FolderManifest, FileRecord
+from .manifest import file_digest, check_algorithms
+from .manifest_store import StoredManifest, StoredFolder
+from .git_index import GitIndexCache
+from .ignore_files import IGNORE_FILES, base_chain, extend_chain, is_ignored
+from .digests import get_algorithm
+from .chunker import Chunker, chunk_file, remember_chunks
 
 
 ### ---------------------------------------------------------------------------
 
 
-# TODO: this requires some case sensitive path checks
-def _keep(filename, includes, excludes):
+# The number of bytes read from a file at a time while hashing it; this is
+# also the most file data that any one hashing worker holds at once.
+_READ_SIZE = 262144
+
+# Files at least this large (in bytes) are hashed by mapping them into memory
+# rather than reading them, which avoids copying their content into a new
+# bytes object for every block. This can be changed with the
+# mmap_hash_threshold setting; 0 disables mapping files entirely.
+_MMAP_THRESHOLD = 4194304
+
+# The largest number of worker threads that will be used to hash files when
+# the caller does not specify a worker count. Beyond this we are generally
+# bound by the disk and not the CPU.
+_MAX_DEFAULT_WORKERS = 8
+
+# The key that our listener for changes in the user preferences is registered
+# with.
+_PREFS_KEY = "remote_build_file_gather"
+
+
+### ---------------------------------------------------------------------------
+
+
+# The compiled patterns for every folder entry that we have seen, keyed on the
+# patterns in the entry; this is thrown away whenever the user preferences
+# change, since the global exclude patterns are a part of every entry.
+_pattern_cache = {}
+_pattern_lock = Lock()
+_preferences = None
+
+
+def plugin_unloaded():
+    if _preferences is not None:
+        _preferences.clear_on_change(_PREFS_KEY)
+
+
+def _invalidate_patterns():
     """
-    Given a file name, return a boolean to indicate if this file should be
-    considered part of the build based on the given list of include and exclude
-    patterns.
+    Throw away all cached folder patterns; invoked when the user preferences
+    change.
+    """
+    with _pattern_lock:
+        _pattern_cache.clear()
 
-    The filters are applied in the order: "include, exclude" such that if there
-    are no includes, we assume that everything is included by default.
+
+### ---------------------------------------------------------------------------
+
+
+class _PatternMatcher():
+    """
+    A compiled form of a list of glob patterns, which can quickly determine if
+    a name matches any of them. This is built once per folder entry, so that
+    matching a name doesn't have to consider each pattern separately.
+
+    Patterns with no wildcards are looked up in a set, patterns of the common
+    form "*.ext" are checked with a single suffix test, and all others are
+    merged into a single regular expression.
+
+    Matching is case insensitive on Windows and MacOS, whose file systems are
+    case insensitive by default, and case sensitive everywhere else.
     """
-    def list_match(filename, patterns, default_if_empty):
-        if not patterns:
-            return default_if_empty
+    case_sensitive = sublime.platform() not in ("windows", "osx")
+
+    def __init__(self, patterns, case_sensitive=None):
+        if case_sensitive is not None:
+            self.case_sensitive = case_sensitive
 
+        literals = set()
+        suffixes = set()
+        regexes = []
         for pattern in patterns:
-            if fnmatch.fnmatch(filename, pattern):
-                return True
+            pattern = self._normalize(pattern.replace("/", os.sep))
+            if not any(c in pattern for c in "*?["):
+                literals.add(pattern)
+            elif (pattern.startswith("*") and
+                    not any(c in pattern[1:] for c in "*?[")):
+                suffixes.add(pattern[1:])
+            else:
+                regexes.append(self._translate(pattern))
+
+        self.literals = literals
+        self.suffixes = tuple(suffixes)
+        self.regex = None
+        if regexes:
+            flags = re.DOTALL if self.case_sensitive else re.DOTALL | re.IGNORECASE
+            self.regex = re.compile("|".join(regexes), flags)
+
+    def __bool__(self):
+        return bool(self.literals or self.suffixes or self.regex)
+
+    def _normalize(self, name):
+        return name if self.case_sensitive else name.lower()
+
+    def _translate(self, pattern):
+        """
+        Translate a glob pattern into a regular expression that can be joined
+        with others. Older versions of Python add global flags to the end of
+        the translation, which are not allowed in the middle of a regex.
+        """
+        regex = fnmatch.translate(pattern)
+        if regex.endswith("(?ms)"):
+            regex = regex[:-5]
+
+        return "(?:%s)" % regex
+
+    def match(self, name):
+        """
+        Return a boolean to indicate if the given name matches any of the
+        patterns in this matcher.
+        """
+        name = self._normalize(name)
+        return (name in self.literals or
+                (bool(self.suffixes) and name.endswith(self.suffixes)) or
+                (self.regex is not None and self.regex.match(name) is not None))
+
+
+class _FolderPatterns():
+    """
+    The effective set of include and exclude pattern matchers for a folder
+    entry, which combines the patterns in the entry itself with the global
+    exclude patterns from the user preferences.
+    """
+    def __init__(self, folder, preferences):
+        def merged(*pattern_lists):
+            result = []
+            for patterns in pattern_lists:
+                result.extend(p for p in patterns if p not in result)
+            return result
+
+        self.file_includes = _PatternMatcher(merged(
+            folder.get("file_include_patterns", [])))
+        self.file_excludes = _PatternMatcher(merged(
+            folder.get("file_exclude_patterns", []),
+            preferences.get("file_exclude_patterns", [])))
+        self.path_includes = _PatternMatcher(merged(
+            folder.get("folder_include_patterns", [])))
+        self.path_excludes = _PatternMatcher(merged(
+            folder.get("folder_exclude_patterns", []),
+            preferences.get("folder_exclude_patterns", [])))
+
+
+def _folder_patterns(folder):
+    """
+    Return the _FolderPatterns for the given folder entry, reusing the cached
+    version if this entry has been seen before. The folder entry is never
+    modified.
+    """
+    global _preferences
+
+    key = tuple(tuple(folder.get(name, [])) for name in (
+        "file_include_patterns", "file_exclude_patterns",
+        "folder_include_patterns", "folder_exclude_patterns"))
+
+    with _pattern_lock:
+        if _preferences is None:
+            _preferences = sublime.load_settings("Preferences.sublime-settings")
+            _preferences.add_on_change(_PREFS_KEY, _invalidate_patterns)
 
-        return False
+        patterns = _pattern_cache.get(key)
+        if patterns is None:
+            patterns = _FolderPatterns(folder, _preferences)
+            _pattern_cache[key] = patterns
 
-    return (list_match(filename, includes, True) and
-                not list_match(filename, excludes, False))
+        return patterns
+
+
+def _keep(filename, includes, excludes):
+    """
+    Given a file name, return a boolean to indicate if this file should be
+    considered part of the build based on the given include and exclude
+    pattern matchers.
+
+    The filters are applied in the order: "include, exclude" such that if there
+    are no includes, we assume that everything is included by default.
+    """
+    return ((not includes or includes.match(filename)) and
+                not excludes.match(filename))
 
 
-# TODO: this requires some case sensitive path checks
 def _prune_folders(folders, includes, excludes):
     """
     Given a list of folders, return a copy of it that includes just the folders
-    that should be considered part of the build based on the given list of
-    include and exclude patterns.
+    that should be considered part of the build based on the given include and
+    exclude pattern matchers.
 
     The filters are applied in the order: "include, exclude" such that if there
     are no includes, we assume that everything is included by default.
     """
-    result = []
+    return [folder for folder in folders if _keep(folder, includes, excludes)]
+
+
+def _coalesce_roots(folders):
+    """
+    Given a list of top level build folders, return a list of tuples that
+    pair each folder with the folder that it coalesces into, which is itself
+    if it is not contained within any of the other folders. Folders appear in
+    the list after the folder they coalesce into.
+
+    The folders are placed into a trie keyed on their path components, so a
+    folder is only ever coalesced into a folder that is one of its ancestors
+    and not just a string prefix of it. Every folder given appears in the
+    result, even if it is a duplicate of another one (or, on platforms where
+    case doesn't matter, only differs from another one in case); duplicates
+    coalesce into the first of them.
+    """
+    # Each node in the trie is a dictionary of child nodes keyed on the next
+    # path component; a node that represents one or more of the folders has
+    # the list of them stored in it under the key None.
+    trie = {}
     for folder in folders:
-        if not includes or folder in includes:
-            if folder not in excludes:
-                result.append(folder)
+        node = trie
+        for part in os.path.normcase(folder).split(os.sep):
+            if part:
+                node = node.setdefault(part, {})
+        node.setdefault(None, []).append(folder)
+
+    # Walk the trie top down; the first folder seen along any path is the one
+    # that any folders beneath it coalesce into.
+    result = []
+    pending = [(trie, None)]
+    while pending:
+        node, common = pending.pop()
+
+        for folder in node.get(None, []):
+            common = folder if common is None else common
+            result.append((folder, common))
+
+        pending.extend((child, common) for part, child in node.items()
+                                        if part is not None)
 
     return result
 
 
-def _coalesce_folders(folder_dict):
+def _mmap_threshold():
     """
-    Given a dictionary of top level build folders that has had its contents
-    filled out, attempt to coalesce all of the child folders that appear into
-    their parents.
+    Return the size at which files start being hashed through mmap.
     """
-    get_folders = lambda d: sorted(d.keys(), key=lambda fn: (dirname(fn), basename(fn)))
-
-    coalesced = {}
-    for folder in get_folders(folder_dict):
-        # Scan over all of the folders currently in the new output to see if
-        # any of them are wholly used as our path prefix.
-        common = None
-        for fixed_folder in get_folders(coalesced):
-            if folder.startswith(fixed_folder):
-                common = fixed_folder
-                break
-
-        if common is None:
-            coalesced[folder] = folder_dict[folder]
+    settings = sublime.load_settings("RemoteBuild.sublime-settings")
+    return settings.get("mmap_hash_threshold", _MMAP_THRESHOLD)
 
-        else:
-            suffix = folder[len(common):].lstrip(os.sep)
-            # print("Coalescing '{0}' into {1}".format(suffix, common))
 
-            # Alias the the dictionary we're going to copy items from and the
-            # dictionary we're going to copy them to.
-            src = folder_dict[folder]
-            dst = coalesced[common]
+def _hash_mapped(file, algorithm, chunker=None):
+    """
+    Return the digest of the content of the given open file, calculated by
+    mapping it into memory so that the hasher reads straight from the page
+    cache without any copies. Tree hash algorithms hash the leaves of a
+    mapped file in parallel. Returns None if the file can't be mapped, such
+    as when it is empty or is not a regular file.
+
+    When a Chunker is given, the content is also given to it as it's hashed;
+    that hashes the file a block at a time, even with a tree hash.
+    """
+    try:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError, OverflowError):
+        return None
 
-            for name,info in src.items():
-                new_entry = os.path.join(suffix, name)
-                dst[new_entry] = info
-                dst[new_entry]["name"] = new_entry
+    with mapped:
+        view = memoryview(mapped)
+        try:
+            if chunker is None:
+                return algorithm.digest_buffer(view)
 
-        # print(folder)
+            hasher = algorithm.file_hasher(len(view))
+            for offset in range(0, len(view), _READ_SIZE):
+                with view[offset:offset + _READ_SIZE] as block:
+                    hasher.update(block)
+                    chunker.update(block)
 
-    return coalesced
+            return hasher.digest()
+        finally:
+            view.release()
 
 
-def _get_file_details(root_path, filename, hash_file):
+def _get_file_details(root_path, filename, hash_file, cache=None, stat=None,
+                      algorithm=None, mmap_threshold=_MMAP_THRESHOLD, blobs=None,
+                      chunk_threshold=None):
     """
     Get all of the underlying file details for the provided file in the given
-    root path.
+    root path, as a FileRecord; the file is hashed with the named digest
+    algorithm, or the default one if algorithm is None.
+
+    When a hash cache is provided, it is consulted before the file is hashed
+    and updated with any newly calculated hash. If the stat result for the file
+    is already known it can be provided to avoid having to stat it again.
+
+    Files of at least mmap_threshold bytes are hashed through mmap when
+    possible; a threshold of 0 always reads files.
+
+    When a blob cache is provided, the content of any file that is read to be
+    hashed is put into it (if it is small enough), so that it doesn't need to
+    be read again to be sent.
+
+    Files of at least chunk_threshold bytes are also split into content
+    defined chunks, which are stored in the record so that they are ready
+    when the file is sent as a chunk list; None or 0 chunks nothing. A file
+    that has to be hashed is chunked with the same reads.
     """
     name = os.path.join(root_path, filename)
 
     try:
-        mtime = os.path.getmtime(name)
-        sha1 = None
+        stat = os.stat(name) if stat is None else stat
+        digest = None
+        chunks = None
+        chunker = None
+        if chunk_threshold and stat.st_size >= chunk_threshold:
+            chunker = Chunker()
 
         if hash_file:
-            sha1 = hashlib.sha1()
+            algorithm = get_algorithm(algorithm)
+            if cache is not None:
+                digest = cache.lookup(name, stat, algorithm.name)
+
+            if digest is None:
+                with open(name, "rb") as file:
+                    if mmap_threshold and stat.st_size >= mmap_threshold:
+                        digest = _hash_mapped(file, algorithm, chunker)
+
+                    if digest is None:
+                        content = []
+                        keep = blobs is not None and blobs.wants(stat.st_size)
+
+                        hasher = algorithm.file_hasher(stat.st_size)
+                        while True:
+                            data = file.read(_READ_SIZE)
+                            if not data:
+                                break
+                            hasher.update(data)
+                            if chunker is not None:
+                                chunker.update(data)
+                            if keep:
+                                content.append(data)
+
+                        digest = hasher.digest()
+                        if keep:
+                            blobs.put(algorithm.name, digest, b"".join(content))
+
+                if chunker is not None:
+                    chunks = chunker.finish()
+                    remember_chunks((algorithm.name, digest), chunks)
+
+                if cache is not None:
+                    cache.store(name, stat, digest, algorithm.name)
+
+        if chunker is not None and chunks is None:
+            key = None if digest is None else (algorithm.name, digest)
+            chunks = chunk_file(name, key)
+
+        return FileRecord(filename, stat.st_mtime, digest, chunks)
 
-            with open(name, "rb") as file:
-                while True:
-                    data = file.read(262144)
-                    if not data:
-                        break
-                    sha1.update(data)
+    except OSError:
+        if cache is not None:
+            cache.evict(name)
 
-            sha1 = sha1.hexdigest()
+        return None
 
-        return {
-            "name": filename,
-            "last_modified": mtime,
-            "sha1": sha1
-        }
 
-    except OSError:
-        return None
+def _digest_lookup(paths, cache, hash_files, algorithm, use_git_index=True):
+    """
+    Return the object that digests for files in the given paths should be
+    looked up in before they are hashed. This is the provided hash cache
+    (which may be None), unless files are being hashed with the "git" digest
+    algorithm, in which case the git indexes of the work trees that contain
+    the paths are consulted first.
+    """
+    if hash_files and use_git_index and get_algorithm(algorithm).name == "git":
+        return GitIndexCache(paths, cache)
+
+    return cache
 
 
-def _files_for_folder(window, folder, project_path, hash_files):
+def _default_workers():
     """
-    Given a particular folder dict in a window with the provided project path,
-    return a list of all files in that folder that should apply to the build.
+    Return the number of hashing worker threads to use when the caller does
+    not specify a count.
     """
-    search_path = folder.get("path", None)
-    file_includes = folder.get("file_include_patterns", [])
-    file_excludes = folder.get("file_exclude_patterns", [])
-    path_includes = folder.get("folder_include_patterns", [])
-    path_excludes = folder.get("folder_exclude_patterns", [])
+    try:
+        return min(multiprocessing.cpu_count(), _MAX_DEFAULT_WORKERS)
+    except NotImplementedError:
+        return 1
+
+
+def _iter_details(jobs, hash_files, cache, workers, algorithm=None, blobs=None,
+                  shared=None, chunk_threshold=None):
+    """
+    Given an iterable of (root_path, filename, stat) tuples, yield a tuple of
+    each job and the file details for it, in the same order. Jobs are taken
+    from the iterable as they are needed, so details for the first files are
+    available before the last jobs have been produced.
+
+    Files that share an inode (hard links, or a file reached both directly and
+    through a symlink) are only examined once; every other name for the same
+    file gets a renamed copy of those details. To keep memory use down, only
+    files that can have more than one name are remembered for this: those
+    with more than one link, and those for which the shared callable (if
+    given) returns True, such as files reached through a symlink. A file that
+    is reached directly before it is reached through a symlink is examined
+    twice.
+
+    When files are being hashed and more than one worker is requested, the
+    files are hashed on a pool of worker threads; hashlib releases the GIL
+    while it works, so this allows several files to be read and hashed at
+    once. The number of files in flight at once is bounded. Large files are
+    chunked (see _get_file_details()) on the pool as well.
+    """
+    threshold = _mmap_threshold()
+    get_details = lambda job: _get_file_details(job[0], job[1], hash_files, cache,
+                                                job[2], algorithm, threshold, blobs,
+                                                chunk_threshold)
+
+    pool = None
+    if (hash_files or chunk_threshold) and workers > 1:
+        pool = ThreadPoolExecutor(max_workers=workers)
+
+    # Maps the inode of every file that may have more than one name to its
+    # details (or the future for them, when a pool is hashing files); inode
+    # values of 0 are used by platforms that don't provide them, so those
+    # jobs are always unique.
+    first = {}
+    pending = deque()
+    in_flight = max(workers, 1) * 16
+
+    def remember(job):
+        stat = job[2]
+        return stat.st_nlink > 1 or (shared is not None and shared(job))
+
+    def renamed(job, info):
+        if info is not None and info.name != job[1]:
+            info = info.renamed(job[1])
+        return job, info
+
+    def resolve(job, future):
+        return renamed(job, future.result())
+
+    try:
+        for job in jobs:
+            stat = job[2]
+            key = (stat.st_dev, stat.st_ino) if stat.st_ino else None
 
-    settings = sublime.load_settings("Preferences.sublime-settings")
-    file_excludes.extend(settings.get("file_exclude_patterns", []))
-    path_excludes.extend(settings.get("folder_exclude_patterns", []))
+            if pool is None:
+                info = first.get(key) if key is not None else None
+                if info is None:
+                    info = get_details(job)
+                    if key is not None and remember(job):
+                        first[key] = info
+
+                yield renamed(job, info)
+                continue
+
+            future = first.get(key) if key is not None else None
+            if future is None:
+                future = pool.submit(get_details, job)
+                if key is not None and remember(job):
+                    first[key] = future
+
+            pending.append((job, future))
+            while pending and (len(pending) > in_flight or pending[0][1].done()):
+                yield resolve(*pending.popleft())
+
+        while pending:
+            yield resolve(*pending.popleft())
+
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def _gather_details(jobs, hash_files, cache, workers, algorithm=None, blobs=None,
+                    chunk_threshold=None):
+    """
+    Given a list of (root_path, filename, stat) tuples, return a list of the
+    file details for each, in the same order.
+    """
+    return [info for _, info in _iter_details(jobs, hash_files, cache, workers,
+                                              algorithm, blobs,
+                                              chunk_threshold=chunk_threshold)]
+
+
+class _DirEntry():
+    """
+    A minimal stand in for os.DirEntry, for versions of Python that don't
+    provide os.scandir(). This only supports what _walk_folder() requires.
+    """
+    def __init__(self, path, name):
+        self.name = name
+        self.path = os.path.join(path, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+def _scandir(path):
+    """
+    Return an iterable of directory entries for the given path, using
+    os.scandir() when it is available.
+    """
+    if hasattr(os, "scandir"):
+        return os.scandir(path)
+
+    return [_DirEntry(path, name) for name in os.listdir(path)]
+
+
+def _use_ignore_files():
+    """
+    Return a boolean to indicate if .gitignore and .rbignore files should be
+    honored while walking folders.
+    """
+    settings = sublime.load_settings("RemoteBuild.sublime-settings")
+    return settings.get("use_ignore_files", True)
+
+
+def _ignore_chain(search_path, top=None):
+    """
+    Return the chain of ignore rules that a walk of the given folder starts
+    with (see ignore_files.py), or None if ignore files are not in use.
+    """
+    return base_chain(search_path, top) if _use_ignore_files() else None
+
+
+def _walk_folder(search_path, path_includes, path_excludes, chain=None, links=None):
+    """
+    Walk the given folder, yielding a (relative_name, stat) tuple for every
+    file contained in it whose containing folders are all included based on
+    the given folder include and exclude pattern matchers.
+
+    The stat result comes from the directory scan itself, so files are never
+    examined twice. Symlinks to folders are followed, but any folder that has
+    already been visited (a symlink loop, or a second link to the same
+    folder) is not descended into again.
+
+    When chain is not None, it is the chain of ignore rules from the folders
+    above this one, and the ignore files in every folder walked are honored
+    as well; ignored files are skipped, and ignored folders are never
+    descended into.
+
+    When links is not None, it is a set that the relative name of every file
+    that is reached through a symlink (either the file itself or one of the
+    folders that contains it) is added to.
+    """
+    try:
+        root_stat = os.stat(search_path)
+    except OSError:
+        return
+
+    visited = {(root_stat.st_dev, root_stat.st_ino)}
+    pending = [(search_path, "", chain, False)]
+    while pending:
+        path, prefix, chain, linked = pending.pop()
+        try:
+            entries = list(_scandir(path))
+        except OSError:
+            continue
+
+        if chain is not None:
+            chain = extend_chain(chain, path, prefix,
+                                 [e.name for e in entries if e.name in IGNORE_FILES])
+
+        dirs = {}
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    dirs[entry.name] = entry
+                elif not (chain and is_ignored(chain, prefix + entry.name, False)):
+                    if links is not None and (linked or entry.is_symlink()):
+                        links.add(prefix + entry.name)
+                    yield prefix + entry.name, entry.stat()
+
+            # Broken symlinks and files that vanish mid-scan are skipped.
+            except OSError:
+                pass
+
+        for name in _prune_folders(sorted(dirs), path_includes, path_excludes):
+            if chain and is_ignored(chain, prefix + name, True):
+                continue
+
+            try:
+                # The directory entry stat doesn't have inode information on
+                # all platforms, so explicitly stat folders.
+                stat = os.stat(dirs[name].path)
+            except OSError:
+                continue
+
+            key = (stat.st_dev, stat.st_ino)
+            if stat.st_ino and key in visited:
+                continue
+
+            visited.add(key)
+            pending.append((dirs[name].path, prefix + name + os.sep, chain,
+                            linked or dirs[name].is_symlink()))
+
+
+def _folder_search_path(folder, project_path):
+    """
+    Given a particular folder dict with the provided project path, return the
+    absolute path of the folder that it represents.
+    """
+    search_path = folder.get("path", None)
 
     if search_path is None:
         raise ValueError("folder entry does not contain a path")
@@ -150,33 +637,54 @@ def _files_for_folder(window, folder, project_path, hash_files):
 
         search_path = os.path.abspath(os.path.join(project_path, search_path))
 
+    return search_path
+
+
+def _path_included(name, patterns):
+    """
+    Given the relative name of a file in a folder, return a boolean to indicate
+    if all of the folders that contain it are included by the provided folder
+    patterns.
+    """
+    return all(_keep(part, patterns.path_includes, patterns.path_excludes)
+                    for part in name.split(os.sep)[:-1])
+
+
+def _iter_folder(search_path, patterns, links=None):
+    """
+    Given the absolute path of a folder and its patterns, yield a (name, stat)
+    tuple for all files in that folder that should apply to the build. links
+    is as for _walk_folder().
+    """
     # print("---------------------------------------")
     # print("folder:       '%s'" % search_path)
-    # print("file include: %s" % file_includes)
-    # print("file exclude: %s" % file_excludes)
-    # print("path include: %s" % path_includes)
-    # print("path exclude: %s" % path_excludes)
 
-    results = {}
-    for (path, dirs, files) in os.walk(search_path):
-        dirs[:] = _prune_folders(dirs, path_includes, path_excludes)
+    for name, stat in _walk_folder(search_path, patterns.path_includes,
+                                   patterns.path_excludes,
+                                   _ignore_chain(search_path), links):
+        if _keep(name, patterns.file_includes, patterns.file_excludes):
+            yield name, stat
 
-        rPath = os.path.relpath(path, search_path) if path != search_path else ""
-        for name in files:
-            name = os.path.join(rPath, name)
-            if _keep(name, file_includes, file_excludes):
-                results[name] = _get_file_details(search_path, name, hash_files)
 
-    return search_path, results
+def _files_for_folder(window, folder, project_path):
+    """
+    Given a particular folder dict in a window with the provided project path,
+    return a list of (name, stat) tuples for all files in that folder that
+    should apply to the build.
+    """
+    search_path = _folder_search_path(folder, project_path)
+    return search_path, list(_iter_folder(search_path, _folder_patterns(folder)))
 
 
 ### ---------------------------------------------------------------------------
 
 
-def find_project_files(window, folders=None, hash_files=True):
+def _project_folders(window, folders):
     """
-    Given a list of folder entries and a potential project path, return a list
-    of all files that exist at that particular path.
+    Given a window and an optional list of folder entries, return a tuple of
+    the folder entries to use and the path that relative folder paths are
+    based on. When no folder entries are given, the folders from the project
+    in the window are used.
     """
     path = None
     if folders is None:
@@ -186,31 +694,195 @@ def find_project_files(window, folders=None, hash_files=True):
         if path:
             path = os.path.split(path)[0]
 
-    files = {}
+    return folders, path
+
+
+def project_roots(window, folders=None):
+    """
+    Given a list of folder entries (or None to use the project in the window),
+    return the list of build folders that the files of the project will be
+    reported in. This doesn't require the folders to be scanned.
+    """
+    folders, path = _project_folders(window, folders)
     if not folders:
         view = window.active_view()
         if view and view.file_name() is not None:
-            base_folder, filename = os.path.split(view.file_name())
-            files[base_folder] = _get_file_details(base_folder, filename, hash_files)
+            return [os.path.dirname(view.file_name())]
 
-        return files
+        return []
 
-    for folder in folders:
-        base_folder, folder_files = _files_for_folder(window, folder, path, hash_files)
-        files[base_folder] = folder_files
+    search_paths = [_folder_search_path(folder, path) for folder in folders]
+    return [folder for folder, common in _coalesce_roots(search_paths)
+                if folder == common]
 
-    return _coalesce_folders(files)
+
+def iter_project_files(window, folders=None, hash_files=True, use_cache=True,
+                       workers=None, algorithm=None, manifest=None,
+                       use_git_index=True, chunk_threshold=None):
+    """
+    Given a list of folder entries and a potential project path, yield a tuple
+    of (root, relative_name, details) for every file in the project as soon as
+    the details for that file are available. The root is one of the folders
+    returned by project_roots().
+
+    Once all files have been produced, a final tuple of (None, None, files) is
+    yielded, where files is the Manifest of all files in the project, as
+    find_project_files() returns.
+
+    The remaining arguments are as for find_project_files().
+    """
+    cache = get_hash_cache() if (hash_files and use_cache) else None
+    blobs = get_blob_cache() if hash_files else None
+    workers = _default_workers() if workers is None else workers
+
+    folders, path = _project_folders(window, folders)
+
+    files = Manifest(algorithm) if manifest is None else manifest
+    algorithm = files.algorithm
+    if not folders:
+        view = window.active_view()
+        if view and view.file_name() is not None:
+            base_folder, filename = os.path.split(view.file_name())
+            info = _get_file_details(base_folder, filename, hash_files, cache,
+                                     algorithm=algorithm,
+                                     mmap_threshold=_mmap_threshold(),
+                                     blobs=blobs, chunk_threshold=chunk_threshold)
+            if info is not None:
+                files.folder(base_folder).add(info)
+                yield base_folder, filename, info
+
+    else:
+        search_paths = [_folder_search_path(folder, path) for folder in folders]
+        roots = dict(_coalesce_roots(search_paths))
+        targets = {root: files.folder(root) for root in roots.values()}
+
+        # Files can only be reached more than once if they have more than one
+        # link, are reached through a symlink, or are in a folder that is
+        # nested in another; the names of the files in each folder that are
+        # reached through symlinks are collected as the folder is walked.
+        links = {search_path: set() for search_path in search_paths}
+        nested = {}
+        for search_path, root in roots.items():
+            if root != search_path:
+                prefix = os.path.join(search_path[len(root):].lstrip(os.sep), "")
+                nested[root] = nested.get(root, ()) + (prefix,)
+
+        def shared(job):
+            search_path, name, _ = job
+            return (roots[search_path] != search_path or
+                    name in links[search_path] or
+                    name.startswith(nested.get(search_path, ())))
+
+        jobs = ((search_path, name, stat)
+                    for folder, search_path in zip(folders, search_paths)
+                    for name, stat in _iter_folder(search_path, _folder_patterns(folder),
+                                                   links[search_path]))
+
+        lookup = _digest_lookup(search_paths, cache, hash_files, algorithm, use_git_index)
+        for (search_path, name, _), info in _iter_details(jobs, hash_files, lookup,
+                                                          workers, algorithm, blobs,
+                                                          shared, chunk_threshold):
+            if info is None:
+                continue
+
+            # Files in folders that are contained in other folders are reported
+            # in the outermost folder.
+            root = roots[search_path]
+            if root != search_path:
+                info = info.renamed(os.path.join(search_path[len(root):].lstrip(os.sep), name))
+
+            targets[root].add(info)
+            yield root, info.name, info
+
+        # Anything in the cache for one of our folders that we didn't just see
+        # has been deleted or is no longer a part of the build. Only the paths
+        # that are in the cache are checked against the folders, so that the
+        # names in a stored manifest don't all need to be held in memory.
+        if cache is not None:
+            for search_path in search_paths:
+                root = roots[search_path]
+                names = [path[len(root):].lstrip(os.sep) for path in cache.paths(search_path)]
+                for name in targets[root].missing(names):
+                    cache.evict(os.path.join(root, name))
+
+    if cache is not None:
+        cache.save()
+
+    yield None, None, files
+
+
+def find_project_files(window, folders=None, hash_files=True, use_cache=True,
+                       workers=None, algorithm=None, manifest=None,
+                       use_git_index=True, chunk_threshold=None):
+    """
+    Given a list of folder entries and a potential project path, return a
+    Manifest of all files that exist at that particular path.
+
+    When use_cache is True, file hashes are looked up in and stored to the
+    persistent hash cache so that files which have not changed since the last
+    call are not read again. The content of small files that are read to be
+    hashed is kept in the blob cache (see blob_cache.py) so that sending them
+    doesn't read them again.
+
+    workers is the number of threads used to hash files; when it is None, a
+    count based on the number of available CPUs is used.
+
+    algorithm is the name of the digest algorithm that files are hashed with
+    (see digests.py); None selects the default. The algorithm is recorded in
+    the returned Manifest.
+
+    manifest is an empty manifest to gather the files into, such as a
+    StoredManifest from a ManifestStore (see manifest_store.py) for projects
+    too large to comfortably hold in memory; it is returned instead of a new
+    Manifest, and its algorithm is used in place of the algorithm argument.
+
+    When files are hashed with the "git" algorithm and use_git_index is True,
+    the digests of tracked files that git knows to be unmodified are taken
+    from the index of their git work tree (see git_index.py) without reading
+    the files; only untracked and modified files are hashed.
+
+    Files of at least chunk_threshold bytes are split into the content
+    defined chunks that they are sent as (see chunker.py) while they are
+    gathered; the chunks are in the chunks attribute of their FileRecord.
+    """
+    for _, _, files in iter_project_files(window, folders, hash_files,
+                                          use_cache, workers, algorithm,
+                                          manifest, use_git_index,
+                                          chunk_threshold):
+        pass
+
+    return files
 
 
 def calculate_fileset_deltas(us, them):
     """
-    Given two fileset dictionarys, one representing our files and one
-    representing "their" files, this returns back a dictionary that indicates
-    what files need to be added, removed or updated in order to make their
-    files match ours.
+    Given two filesets, one representing our files and one representing
+    "their" files, this returns back a dictionary that indicates what files
+    need to be added, removed or updated in order to make their files match
+    ours.
+
+    The filesets can be either a Manifest, a StoredManifest or nested
+    dictionaries of the same shape; the details of the files in the result are
+    always dictionaries. When both are a Manifest, their Merkle hashes are
+    used to skip over any folders that are identical on both sides, and when
+    both are a StoredManifest in the same store the differences in each folder
+    are found by the database. Manifests that were hashed with different
+    digest algorithms can't be compared, and raise a ValueError.
     """
     file_deltas = {}
 
+    manifests = (Manifest, StoredManifest)
+    if isinstance(us, manifests) and isinstance(them, manifests):
+        check_algorithms(us, them)
+
+    # If both sides are identical, there is nothing to do in any folder.
+    if isinstance(us, Manifest) and isinstance(them, Manifest):
+        if us.root_hash() == them.root_hash():
+            for folder in us:
+                file_deltas[folder] = {"add": {}, "remove": {}, "modify": {}}
+
+            return file_deltas
+
     # For all folders that we have, add entries to tell the other end how to
     # create or update their copies of these folders.
     for our_folder, our_files in us.items():
@@ -226,7 +898,19 @@ def calculate_fileset_deltas(us, them):
         # that's all we have to worry about.
         their_files = them.get(our_folder, None)
         if their_files is None:
-            diffed["add"].update(us[our_folder])
+            diffed["add"].update((file, dict(info)) for file, info in our_files.items())
+            continue
+
+        # Manifest folders can tell us directly which files differ.
+        if ((isinstance(our_files, FolderManifest) and
+                isinstance(their_files, FolderManifest)) or
+            (isinstance(our_files, StoredFolder) and
+                isinstance(their_files, StoredFolder) and
+                our_files.store is their_files.store)):
+            added, removed, modified = our_files.diff(their_files)
+            diffed["add"].update((file, dict(our_files[file])) for file in added)
+            diffed["remove"].update((file, dict(their_files[file])) for file in removed)
+            diffed["modify"].update((file, dict(our_files[file])) for file in modified)
             continue
 
         # print(our_files)
@@ -242,16 +926,16 @@ def calculate_fileset_deltas(us, them):
 
         # Add files we have and they don't
         for file in our_set - their_set:
-            diffed["add"][file] = our_files[file]
+            diffed["add"][file] = dict(our_files[file])
 
         # Remove files they have and we don't
         for file in their_set - our_set:
-            diffed["remove"][file] = their_files[file]
+            diffed["remove"][file] = dict(their_files[file])
 
         # Update any files we both have that have changed
         for file in our_set & their_set:
-            if our_files[file]["sha1"] != their_files[file]["sha1"]:
-                diffed["modify"][file] = our_files[file]
+            if file_digest(our_files[file]) != file_digest(their_files[file]):
+                diffed["modify"][file] = dict(our_files[file])
 
 
     # For all folders that the remote end has, if we don't have them, tell the
@@ -260,7 +944,7 @@ def calculate_fileset_deltas(us, them):
         if their_folder not in us:
             file_deltas[their_folder] = {
                 "add": {},
-                "remove": their_files,
+                "remove": {file: dict(info) for file, info in their_files.items()},
                 "modify": {}
             }
 
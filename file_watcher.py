@@ -0,0 +1,530 @@
+import sublime
+import sublime_plugin
+
+from threading import Thread, Event, Lock
+import select
+import struct
+import errno
+import stat
+import json
+import time
+import sys
+import os
+
+from .hash_cache import get_hash_cache
+from .blob_cache import get_blob_cache
+from .file_gather import find_project_files
+from .file_gather import _project_folders, _folder_search_path, _folder_patterns
+from .file_gather import _files_for_folder, _walk_folder, _gather_details
+from .file_gather import _coalesce_roots, _default_workers, _keep
+from .file_gather import _path_included, _digest_lookup
+from .file_gather import _use_ignore_files, _ignore_chain
+from .ignore_files import IGNORE_FILES, extend_chain, is_ignored, path_ignored
+from .manifest import Manifest
+from .digests import get_algorithm
+
+try:
+    import ctypes
+    import ctypes.util
+
+    _libc = None
+    if sys.platform.startswith("linux"):
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        _libc.inotify_init1.argtypes = [ctypes.c_int]
+        _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                            ctypes.c_uint32]
+
+except (ImportError, OSError, AttributeError):
+    _libc = None
+
+
+### ---------------------------------------------------------------------------
+
+
+# The inotify constants that we use; see inotify(7).
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+
+IN_NONBLOCK    = 0o00004000
+IN_CLOEXEC     = 0o02000000
+
+# The events that we watch for on every folder.
+_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+               IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+               IN_MOVE_SELF | IN_ONLYDIR)
+
+# The fixed size header of every inotify event.
+_EVENT_HEADER = struct.Struct("iIII")
+
+# How often (in seconds) folders that can't be watched by inotify are polled
+# for changes.
+_POLL_INTERVAL = 2.0
+
+
+### ---------------------------------------------------------------------------
+
+
+class _FolderWatch():
+    """
+    The live state of a single folder entry: the files that were in it as of
+    the last refresh, plus the set of absolute paths that have changed since
+    then. Changes are detected with inotify where possible, and by polling the
+    folder otherwise.
+
+    The flag rescan is set whenever changes may have been missed (including
+    before the first refresh), in which case the whole folder is scanned again
+    at the next refresh. The same happens when the patterns that apply to the
+    folder change, since that can change what is a part of it.
+    """
+    def __init__(self, folder, search_path):
+        self.folder = folder
+        self.root = search_path
+        self.refreshed_patterns = None
+        self.watched_patterns = None
+
+        self.lock = Lock()
+        self.files = {}
+        self.algorithm = None
+        self.dirty = set()
+        self.rescan = True
+
+        self.fd = None
+        self.watches = {}
+        self.snapshot = None
+        self.last_poll = 0
+
+    @property
+    def patterns(self):
+        """
+        The patterns that currently apply to this folder. These come from the
+        pattern cache, which is flushed whenever the user preferences change,
+        so this is a new object whenever the patterns may have changed.
+        """
+        return _folder_patterns(self.folder)
+
+    def start(self):
+        """
+        Start watching the folder; this uses inotify if it is available, and
+        falls back to polling otherwise.
+        """
+        fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC) if _libc else -1
+        if fd < 0:
+            return self._fall_back_to_polling()
+
+        self.fd = fd
+        self.watched_patterns = self.patterns
+        self._add_watches(self.root)
+
+    def check_patterns(self):
+        """
+        If the patterns for this folder have changed since the folder was
+        watched, add watches for any folders that they now include. Watches
+        on folders that are now excluded are left alone; changes in them are
+        filtered out at the next refresh.
+        """
+        patterns = self.patterns
+        if self.fd is not None and patterns is not self.watched_patterns:
+            self.watched_patterns = patterns
+            self._add_watches(self.root)
+
+    def stop(self):
+        """
+        Stop watching the folder, releasing any inotify resources.
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self.watches = {}
+
+    def fileno(self):
+        return self.fd
+
+    def _fall_back_to_polling(self):
+        """
+        Stop using inotify for this folder (if it was) and start polling it
+        instead. Anything that happened before the first poll is unknown, so
+        this schedules a rescan.
+        """
+        self.stop()
+        with self.lock:
+            self.rescan = True
+
+        self.poll()
+
+    def _add_watches(self, path):
+        """
+        Add an inotify watch for the given folder and every included folder
+        beneath it; folders that are ignored by an ignore file are not
+        watched. If the watch limit is reached, switch over to polling.
+        """
+        patterns = self.patterns
+        pending = [(path, "", _ignore_chain(path, self.root))]
+        while pending and self.fd is not None:
+            path, prefix, chain = pending.pop()
+            wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), _WATCH_MASK)
+            if wd < 0:
+                if ctypes.get_errno() in (errno.ENOSPC, errno.ENOMEM):
+                    print("remote_build: inotify watch limit reached; polling {0}".format(self.root))
+                    self._fall_back_to_polling()
+                continue
+
+            self.watches[wd] = path
+            try:
+                names = os.listdir(path)
+                if chain is not None:
+                    chain = extend_chain(chain, path, prefix,
+                                         [n for n in names if n in IGNORE_FILES])
+
+                for name in names:
+                    child = os.path.join(path, name)
+                    if (_keep(name, patterns.path_includes, patterns.path_excludes)
+                            and not (chain and is_ignored(chain, prefix + name, True))
+                            and os.path.isdir(child)):
+                        pending.append((child, prefix + name + os.sep, chain))
+            except OSError:
+                pass
+
+    def read_events(self):
+        """
+        Read all pending inotify events, recording the paths they refer to as
+        changed. Anything that invalidates our view of the folder layout, such
+        as a queue overflow or a folder being moved, schedules a rescan.
+        """
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                with self.lock:
+                    self.rescan = True
+                continue
+
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            path = self.watches.get(wd)
+            if path is None:
+                continue
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF) or (
+                    mask & IN_MOVED_FROM and mask & IN_ISDIR):
+                with self.lock:
+                    self.rescan = True
+                continue
+
+            path = os.path.join(path, name) if name else path
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                patterns = self.patterns
+                if _keep(name, patterns.path_includes, patterns.path_excludes):
+                    self._add_watches(path)
+
+            # An edited ignore file may have stopped ignoring some folders,
+            # which are not being watched yet.
+            elif name in IGNORE_FILES:
+                self._add_watches(os.path.dirname(path))
+
+            with self.lock:
+                self.dirty.add(path)
+
+    def poll(self):
+        """
+        Walk the folder and compare the stat information of all of the files
+        in it against the previous walk, recording changed paths.
+        """
+        self.last_poll = time.time()
+
+        patterns = self.patterns
+        snapshot = {}
+        for name, st in _walk_folder(self.root, patterns.path_includes,
+                                     patterns.path_excludes,
+                                     _ignore_chain(self.root)):
+            snapshot[name] = (st.st_size, st.st_mtime_ns, st.st_ino)
+
+        if self.snapshot is not None:
+            old = self.snapshot
+            changed = [name for name in snapshot if old.get(name) != snapshot[name]]
+            changed.extend(name for name in old if name not in snapshot)
+            with self.lock:
+                self.dirty.update(os.path.join(self.root, name) for name in changed)
+
+        self.snapshot = snapshot
+
+    def take_changes(self):
+        """
+        Return a tuple of the rescan flag and the set of changed paths, and
+        reset both so that changes are tracked from this point forward. A
+        change in the patterns since the last call also forces a rescan.
+        """
+        patterns = self.patterns
+        changed = patterns is not self.refreshed_patterns
+        self.refreshed_patterns = patterns
+
+        with self.lock:
+            result = (self.rescan or changed, self.dirty)
+            self.rescan = False
+            self.dirty = set()
+
+        return result
+
+
+### ---------------------------------------------------------------------------
+
+
+class ProjectWatcher(Thread):
+    """
+    Keeps an in-memory manifest of a list of folder entries up to date by
+    watching them for changes in the background. Requesting the files in the
+    project only needs to examine the paths that changed since the last
+    request, instead of rescanning every folder.
+    """
+    def __init__(self, folders, project_path):
+        super().__init__()
+        self.daemon = True
+        self.event = Event()
+        self.refresh_lock = Lock()
+        self.folders = [_FolderWatch(folder, _folder_search_path(folder, project_path))
+                            for folder in folders]
+
+    def start(self):
+        """
+        Start watching all of the folders, and then start the thread that
+        services them. The folders are watched before this returns, so no
+        change after this call can be missed.
+        """
+        for folder in self.folders:
+            folder.start()
+
+        super().start()
+
+    def run(self):
+        while not self.event.is_set():
+            watched = [f for f in self.folders if f.fileno() is not None]
+            polled = [f for f in self.folders if f.fileno() is None]
+
+            if watched:
+                ready, _, _ = select.select(watched, [], [], 0.25)
+                for folder in ready:
+                    folder.read_events()
+                for folder in watched:
+                    folder.check_patterns()
+            else:
+                self.event.wait(0.25)
+
+            for folder in polled:
+                if time.time() - folder.last_poll >= _POLL_INTERVAL:
+                    folder.poll()
+
+        for folder in self.folders:
+            folder.stop()
+
+    def stop(self):
+        self.event.set()
+        self.join(0.5)
+
+    def _refresh(self, folder, hash_files, cache, workers, algorithm, blobs=None,
+                 chunk_threshold=None):
+        """
+        Bring the manifest for the given folder up to date, either with a full
+        rescan or by examining only the paths that have changed. If the digest
+        algorithm is not the one the folder was last refreshed with, all of
+        the files need to be hashed again, so that forces a rescan.
+        """
+        rescan, dirty = folder.take_changes()
+        if folder.algorithm != algorithm:
+            folder.algorithm = algorithm
+            rescan = True
+
+        # A changed ignore file can change what is a part of the build
+        # anywhere beneath it.
+        use_ignores = _use_ignore_files()
+        if use_ignores and any(os.path.basename(path) in IGNORE_FILES for path in dirty):
+            rescan = True
+
+        root = folder.root
+        patterns = folder.refreshed_patterns
+
+        if rescan:
+            _, found = _files_for_folder(None, dict(folder.folder, path=root), None)
+            folder.files = {}
+            jobs = [(root, name, st) for name, st in found]
+
+        else:
+            jobs = []
+            removed = []
+            for path in dirty:
+                name = path[len(root):].lstrip(os.sep)
+                folder.files.pop(name, None)
+                removed.append(name + os.sep)
+
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+
+                if stat.S_ISDIR(st.st_mode):
+                    if (_path_included(os.path.join(name, ""), patterns) and
+                            not (use_ignores and path_ignored(root, name, True))):
+                        jobs.extend((root, os.path.join(name, sub), sub_st)
+                            for sub, sub_st in _walk_folder(path, patterns.path_includes,
+                                                            patterns.path_excludes,
+                                                            _ignore_chain(path, root)))
+                elif not (use_ignores and path_ignored(root, name)):
+                    jobs.append((root, name, st))
+
+            # Anything contained in a changed folder is removed and then added
+            # back by the walk above, if it still exists.
+            if removed:
+                removed = tuple(removed)
+                for name in [n for n in folder.files if n.startswith(removed)]:
+                    del folder.files[name]
+
+            jobs = [job for job in jobs
+                        if _path_included(job[1], patterns) and
+                           _keep(job[1], patterns.file_includes, patterns.file_excludes)]
+
+        details = _gather_details(jobs, hash_files, cache, workers, algorithm, blobs,
+                                  chunk_threshold)
+        for (_, name, _), info in zip(jobs, details):
+            if info is not None:
+                folder.files[name] = info
+
+    def files(self, hash_files=True, workers=None, algorithm=None,
+              chunk_threshold=None):
+        """
+        Return the files in the project, in the same form as they would be
+        returned from find_project_files().
+        """
+        cache = get_hash_cache() if hash_files else None
+        blobs = get_blob_cache() if hash_files else None
+        workers = _default_workers() if workers is None else workers
+        algorithm = get_algorithm(algorithm).name
+
+        with self.refresh_lock:
+            lookup = _digest_lookup([folder.root for folder in self.folders],
+                                    cache, hash_files, algorithm)
+            for folder in self.folders:
+                self._refresh(folder, hash_files, lookup, workers, algorithm, blobs,
+                              chunk_threshold)
+
+            # Files in folders that are contained in other folders are
+            # reported in the outermost folder.
+            by_root = {folder.root: folder for folder in self.folders}
+            files = Manifest(algorithm)
+            for root, common in _coalesce_roots(by_root):
+                dst = files.folder(common)
+                if root == common:
+                    for info in by_root[root].files.values():
+                        dst.add(info)
+                else:
+                    prefix = root[len(common):].lstrip(os.sep)
+                    for name, info in by_root[root].files.items():
+                        dst.add(info.renamed(os.path.join(prefix, name)))
+
+        if cache is not None:
+            cache.save()
+
+        return files
+
+
+### ---------------------------------------------------------------------------
+
+
+# The watchers for every set of folders being watched, keyed on the folders,
+# and the key of the watcher that each window (by ID) is using. A watcher is
+# stopped once no window is using it any longer.
+_watchers = {}
+_window_keys = {}
+_watcher_lock = Lock()
+
+
+def plugin_unloaded():
+    with _watcher_lock:
+        for watcher in _watchers.values():
+            watcher.stop()
+
+        _watchers.clear()
+        _window_keys.clear()
+
+
+def _release(window_id):
+    """
+    Forget the watcher that the window with the given ID is using, stopping it
+    if no other window is using it. This must be called with the lock held.
+    """
+    key = _window_keys.pop(window_id, None)
+    if key is not None and key not in _window_keys.values():
+        watcher = _watchers.pop(key, None)
+        if watcher is not None:
+            watcher.stop()
+
+
+class ProjectWatcherListener(sublime_plugin.EventListener):
+    """
+    Stop watching the folders of a window when the window closes or has a
+    different project loaded into it. These events don't exist in all
+    versions of Sublime, so watch_project_files() also releases the watchers
+    of windows that are gone or whose folders have changed.
+    """
+    def on_pre_close_window(self, window):
+        with _watcher_lock:
+            _release(window.id())
+
+    def on_load_project(self, window):
+        with _watcher_lock:
+            _release(window.id())
+
+
+def watch_project_files(window, folders=None, hash_files=True, workers=None,
+                        algorithm=None, chunk_threshold=None):
+    """
+    This works as find_project_files() does, but the folders are watched for
+    changes in the background from the first call onward, so that subsequent
+    calls for the same folders only need to examine the files that changed.
+    """
+    folders, path = _project_folders(window, folders)
+    if not folders:
+        return find_project_files(window, folders, hash_files, workers=workers,
+                                  algorithm=algorithm,
+                                  chunk_threshold=chunk_threshold)
+
+    key = json.dumps([folders, path], sort_keys=True)
+    with _watcher_lock:
+        live = {w.id() for w in sublime.windows()}
+        for window_id in [w for w in _window_keys if w not in live]:
+            _release(window_id)
+
+        if _window_keys.get(window.id()) != key:
+            _release(window.id())
+
+        watcher = _watchers.get(key)
+        if watcher is None:
+            watcher = ProjectWatcher(folders, path)
+            watcher.start()
+            _watchers[key] = watcher
+
+        _window_keys[window.id()] = key
+
+    return watcher.files(hash_files, workers, algorithm, chunk_threshold)
+
+
+### ---------------------------------------------------------------------------
@@ -0,0 +1,324 @@
+import hashlib
+import struct
+import re
+import os
+
+
+### ---------------------------------------------------------------------------
+
+
+# The fixed size portion of an index entry: the ctime and mtime seconds and
+# nanoseconds, dev, ino, mode, uid, gid and size (all 32 bits), the sha1 of
+# the blob and the flags.
+_ENTRY = struct.Struct(">10I20sH")
+
+# Bits in the flags of an entry.
+_FLAG_ASSUME_VALID = 0x8000
+_FLAG_EXTENDED = 0x4000
+_FLAG_STAGE = 0x3000
+_FLAG_NAME_LENGTH = 0x0fff
+
+# Bits in the extended flags of a version 3 or later entry.
+_EXTENDED_SKIP_WORKTREE = 0x4000
+_EXTENDED_INTENT_TO_ADD = 0x2000
+
+# The type bits of the mode of an entry for a regular file.
+_MODE_TYPE = 0o170000
+_MODE_FILE = 0o100000
+
+# Lines in a git config or attributes file that mean the content of a file in
+# the work tree might not be the content of its blob.
+_CONFIG_CONVERTS = re.compile(r"^\s*autocrlf\s*=\s*(true|input)\s*$", re.I | re.M)
+_ATTRIBUTES_CONVERT = re.compile(r"(^|\s)(text|eol|filter|ident|working-tree-encoding)\b", re.M)
+
+
+### ---------------------------------------------------------------------------
+
+
+class IndexEntry():
+    """
+    The parts of a git index entry that are needed to tell whether a file in
+    the work tree still has the content of the blob that the index records
+    for it.
+    """
+    __slots__ = ("mtime_s", "mtime_ns", "ino", "size", "sha1", "trusted")
+
+    def __init__(self, fields, flags, extended_flags):
+        self.mtime_s = fields[2]
+        self.mtime_ns = fields[3]
+        self.ino = fields[5]
+        self.size = fields[9]
+        self.sha1 = fields[10]
+
+        # Only entries for regular files that git examines normally and that
+        # aren't in the middle of a merge can vouch for the work tree.
+        self.trusted = ((fields[6] & _MODE_TYPE) == _MODE_FILE and
+                        not flags & (_FLAG_ASSUME_VALID | _FLAG_STAGE) and
+                        not extended_flags & (_EXTENDED_SKIP_WORKTREE |
+                                              _EXTENDED_INTENT_TO_ADD))
+
+    def matches(self, stat):
+        """
+        Return a boolean to indicate if the given stat result for a file is
+        the same as what git recorded for it. The index only stores the low 32
+        bits of the size and inode, and some platforms don't record the
+        nanoseconds or the inode at all.
+        """
+        mtime_s, mtime_ns = divmod(stat.st_mtime_ns, 1000000000)
+        return (self.trusted and
+                self.mtime_s == mtime_s and
+                self.mtime_ns in (0, mtime_ns) and
+                self.size == stat.st_size & 0xffffffff and
+                (self.ino == 0 or self.ino == stat.st_ino & 0xffffffff))
+
+
+def _read_varint(data, offset):
+    """
+    Read one of the variable length integers that version 4 indexes use for
+    path prefix lengths, returning the value and the offset after it.
+    """
+    byte = data[offset]
+    offset += 1
+    value = byte & 0x7f
+    while byte & 0x80:
+        byte = data[offset]
+        offset += 1
+        value = ((value + 1) << 7) | (byte & 0x7f)
+
+    return value, offset
+
+
+def parse_index(data):
+    """
+    Parse the content of a git index file (versions 2 to 4), returning a
+    dictionary that maps the path of every entry (with / separators, relative
+    to the top of the work tree) to an IndexEntry.
+
+    A ValueError is raised if the data is not a valid index, or if it is an
+    index that doesn't contain all of its entries (a split index).
+    """
+    if len(data) < 32 or data[:4] != b"DIRC":
+        raise ValueError("not a git index")
+
+    version, count = struct.unpack_from(">II", data, 4)
+    if version not in (2, 3, 4):
+        raise ValueError("unsupported git index version {0}".format(version))
+
+    # The index ends with a sha1 of everything before it; this is all zeros
+    # when git was told not to calculate it.
+    body, checksum = data[:-20], data[-20:]
+    if checksum != bytes(20) and hashlib.sha1(body).digest() != checksum:
+        raise ValueError("git index checksum mismatch")
+
+    entries = {}
+    offset = 12
+    previous = b""
+    for _ in range(count):
+        start = offset
+        fields = _ENTRY.unpack_from(data, offset)
+        flags = fields[11]
+        offset += _ENTRY.size
+
+        extended_flags = 0
+        if flags & _FLAG_EXTENDED:
+            extended_flags = struct.unpack_from(">H", data, offset)[0]
+            offset += 2
+
+        if version == 4:
+            # The name is the previous name with some bytes stripped from the
+            # end, followed by a new suffix.
+            strip, offset = _read_varint(data, offset)
+            end = data.index(b"\0", offset)
+            name = previous[:len(previous) - strip] + data[offset:end]
+            offset = end + 1
+        else:
+            length = flags & _FLAG_NAME_LENGTH
+            if length == _FLAG_NAME_LENGTH:
+                length = data.index(b"\0", offset) - offset
+            name = data[offset:offset + length]
+
+            # Entries are padded with NULs to a multiple of 8 bytes.
+            offset = start + ((offset + length - start + 8) & ~7)
+
+        previous = name
+        entries[name.decode("utf-8", "surrogateescape")] = IndexEntry(
+            fields, flags, extended_flags)
+
+    # Look through the extensions for a link to a shared index, in which case
+    # most of the entries are somewhere else.
+    while offset + 8 <= len(body):
+        signature, size = struct.unpack_from(">4sI", data, offset)
+        if signature == b"link":
+            raise ValueError("split git indexes are not supported")
+        offset += 8 + size
+
+    return entries
+
+
+### ---------------------------------------------------------------------------
+
+
+def find_work_tree(path):
+    """
+    Given a path, return a tuple of the top folder of the git work tree that
+    contains it and the git directory for that work tree, or None if the path
+    is not in a work tree. Work trees whose .git is a file that points
+    elsewhere (linked work trees and submodules) are supported.
+    """
+    path = os.path.abspath(path)
+    while True:
+        dot_git = os.path.join(path, ".git")
+        if os.path.isdir(dot_git):
+            return path, dot_git
+
+        if os.path.isfile(dot_git):
+            try:
+                with open(dot_git, "r", encoding="utf-8") as file:
+                    line = file.readline().strip()
+            except OSError:
+                return None
+
+            if not line.startswith("gitdir:"):
+                return None
+
+            git_dir = os.path.join(path, line[len("gitdir:"):].strip())
+            return path, os.path.normpath(git_dir)
+
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+
+        path = parent
+
+
+def _read_text(path):
+    try:
+        with open(path, "r", encoding="utf-8", errors="replace") as file:
+            return file.read()
+    except OSError:
+        return ""
+
+
+def _converts_content(work_tree, git_dir):
+    """
+    Return a boolean to indicate if the given work tree might be configured
+    to convert file content as it goes in and out of the repository (line
+    ending conversion, or clean and smudge filters such as git-lfs), in which
+    case the blobs in the index are not the content of the files on disk.
+
+    This errs on the side of caution; the repository and user git config and
+    the top level attributes files are checked, and any mention of an
+    attribute that converts content counts.
+    """
+    home = os.path.expanduser("~")
+    configs = [os.path.join(git_dir, "config"),
+               os.path.join(home, ".gitconfig"),
+               os.path.join(home, ".config", "git", "config")]
+    if any(_CONFIG_CONVERTS.search(_read_text(name)) for name in configs):
+        return True
+
+    attributes = [os.path.join(work_tree, ".gitattributes"),
+                  os.path.join(git_dir, "info", "attributes")]
+    return any(_ATTRIBUTES_CONVERT.search(_read_text(name)) for name in attributes)
+
+
+class GitIndex():
+    """
+    The entries of the index of a single git work tree, which can vouch for
+    the git blob digest of any tracked file whose stat information is the
+    same as when git last looked at it.
+    """
+    def __init__(self, work_tree, git_dir):
+        self.work_tree = work_tree
+        self.git_dir = git_dir
+        self.entries = {}
+
+        index_name = os.path.join(git_dir, "index")
+        try:
+            index_stat = os.stat(index_name)
+            with open(index_name, "rb") as file:
+                data = file.read()
+        except OSError:
+            return
+
+        if _converts_content(work_tree, git_dir):
+            print("remote_build: not using the git index of '{0}'; it converts file content".format(
+                work_tree))
+            return
+
+        try:
+            self.entries = parse_index(data)
+        except (ValueError, struct.error, IndexError) as err:
+            print("remote_build: unable to use git index '{0}': {1}".format(index_name, err))
+            return
+
+        # A file modified in the same timestamp tick as the index was written
+        # can't be told apart from an unmodified one, so git considers those
+        # entries racy and so do we.
+        racy = divmod(index_stat.st_mtime_ns, 1000000000)
+        for name, entry in list(self.entries.items()):
+            if (entry.mtime_s, entry.mtime_ns) >= racy or (
+                    entry.mtime_ns == 0 and entry.mtime_s >= racy[0]):
+                del self.entries[name]
+
+    def lookup(self, relative_name, stat):
+        """
+        Return the git blob digest of the file with the given name (relative
+        to the work tree, with native separators) if the index says that the
+        file with the given stat information still has that content, or None
+        otherwise.
+        """
+        entry = self.entries.get(relative_name.replace(os.sep, "/"))
+        if entry is not None and entry.matches(stat):
+            return entry.sha1
+
+        return None
+
+
+### ---------------------------------------------------------------------------
+
+
+class GitIndexCache():
+    """
+    A stand in for a HashCache while gathering files with the "git" digest
+    algorithm; digests of files that the git index of their work tree can
+    vouch for are taken from there, and everything else is passed on to the
+    wrapped hash cache (which may be None).
+    """
+    def __init__(self, paths, cache=None):
+        self.cache = cache
+        self.indexes = []
+
+        for path in paths:
+            found = find_work_tree(path)
+            if found is not None and all(found[0] != index.work_tree for _, index in self.indexes):
+                self.indexes.append((os.path.join(found[0], ""), GitIndex(*found)))
+
+        # Check the most deeply nested work trees first, so that files in a
+        # submodule are looked up in the index of the submodule.
+        self.indexes.sort(key=lambda item: len(item[0]), reverse=True)
+
+    def lookup(self, path, stat, algorithm="sha1"):
+        if algorithm == "git":
+            for prefix, index in self.indexes:
+                if path.startswith(prefix):
+                    digest = index.lookup(path[len(prefix):], stat)
+                    if digest is not None:
+                        return digest
+                    break
+
+        if self.cache is not None:
+            return self.cache.lookup(path, stat, algorithm)
+
+        return None
+
+    def store(self, path, stat, digest, algorithm="sha1"):
+        if self.cache is not None:
+            self.cache.store(path, stat, digest, algorithm)
+
+    def evict(self, path):
+        if self.cache is not None:
+            self.cache.evict(path)
+
+
+### ---------------------------------------------------------------------------
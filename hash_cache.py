@@ -0,0 +1,233 @@
+import sublime
+
+from threading import Lock
+import binascii
+import json
+import time
+import os
+
+
+### ---------------------------------------------------------------------------
+
+
+# Files whose modification time is this close (in seconds) to the time that we
+# hashed them are not cached; on file systems with a coarse timestamp
+# granularity a second write inside the same tick would not change the stat
+# key, so we would otherwise trust a stale hash.
+_RACY_WINDOW = 2.0
+
+
+### ---------------------------------------------------------------------------
+
+
+def _parts(path):
+    """
+    Split the given path into the list of its non-empty components; this is
+    how paths are located in the folder index of the cache.
+    """
+    return [part for part in path.split(os.sep) if part]
+
+
+### ---------------------------------------------------------------------------
+
+
+class HashCache():
+    """
+    A persistent cache of file content hashes, keyed on the absolute path of a
+    file and the (size, mtime_ns, inode) values from its stat result. As long
+    as the stat information for a file is unchanged, the hash that was stored
+    for it can be used without having to read the file again. Each entry also
+    records the digest algorithm of its hash, which has to match as well.
+
+    There is a single instance of this shared by every window; all access is
+    serialized through a lock, and the cache is written to disk atomically so
+    that a partial write can never leave a corrupt cache behind.
+
+    Alongside the entries, an index of the folders that they are in is kept
+    as a tree of (folders, files) tuples, so that the entries beneath a path
+    can be found without examining every entry in the cache.
+    """
+    version = 2
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = Lock()
+        self.entries = None
+        self.tree = None
+        self.dirty = False
+
+    def _stat_key(self, stat):
+        """
+        Return the portion of a stat result that is used to determine if the
+        cached entry for a file is still valid.
+        """
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def _load(self):
+        """
+        Load the cache from disk if it has not been loaded yet. A missing or
+        unreadable cache file results in an empty cache. This must be called
+        with the lock held.
+        """
+        if self.entries is not None:
+            return
+
+        self.entries = {}
+        try:
+            with open(self.filename, "r", encoding="utf-8") as file:
+                data = json.load(file)
+
+            if data.get("version") == self.version:
+                self.entries = data.get("entries", {})
+
+        except (OSError, ValueError):
+            pass
+
+        self.tree = ({}, set())
+        for path in self.entries:
+            self._index(path)
+
+    def _index(self, path):
+        """
+        Add the given absolute path to the folder index. This must be called
+        with the lock held.
+        """
+        folder, name = os.path.split(path)
+        node = self.tree
+        for part in _parts(folder):
+            child = node[0].get(part)
+            if child is None:
+                child = node[0][part] = ({}, set())
+            node = child
+
+        node[1].add(name)
+
+    def _unindex(self, path):
+        """
+        Remove the given absolute path from the folder index. This must be
+        called with the lock held.
+        """
+        folder, name = os.path.split(path)
+        node = self.tree
+        for part in _parts(folder):
+            node = node[0].get(part)
+            if node is None:
+                return
+
+        node[1].discard(name)
+
+    def lookup(self, path, stat, algorithm="sha1"):
+        """
+        Return the binary digest that was previously stored for the file at
+        the given absolute path, or None if there is no entry or the stat
+        information for the file or the digest algorithm no longer matches
+        the entry.
+        """
+        with self.lock:
+            self._load()
+            entry = self.entries.get(path)
+            if entry is not None and entry[:4] == self._stat_key(stat) + [algorithm]:
+                return binascii.unhexlify(entry[4])
+
+        return None
+
+    def store(self, path, stat, digest, algorithm="sha1"):
+        """
+        Store the binary digest for the file at the given absolute path, which
+        was calculated with the given algorithm while the file had the
+        provided stat information.
+        """
+        if time.time() - stat.st_mtime < _RACY_WINDOW:
+            return
+
+        with self.lock:
+            self._load()
+            if path not in self.entries:
+                self._index(path)
+            self.entries[path] = self._stat_key(stat) + [
+                algorithm, binascii.hexlify(digest).decode("ascii")]
+            self.dirty = True
+
+    def evict(self, path):
+        """
+        Remove any cached entry for the file at the given absolute path.
+        """
+        with self.lock:
+            self._load()
+            if self.entries.pop(path, None) is not None:
+                self._unindex(path)
+                self.dirty = True
+
+    def paths(self, root):
+        """
+        Return a list of the absolute paths of all of the files contained in
+        the given root path that have entries. Only the part of the folder
+        index beneath the root is examined.
+        """
+        with self.lock:
+            self._load()
+            node = self.tree
+            for part in _parts(root):
+                node = node[0].get(part)
+                if node is None:
+                    return []
+
+            result = []
+            pending = [(root, node)]
+            while pending:
+                folder, (folders, files) = pending.pop()
+                result.extend(os.path.join(folder, name) for name in files)
+                pending.extend((os.path.join(folder, name), child)
+                                   for name, child in folders.items())
+
+            return result
+
+    def save(self):
+        """
+        Persist the cache to disk if it has been modified since it was loaded
+        or last saved. The data is written to a temporary file that is then
+        moved into place, so concurrent readers only ever see a whole cache.
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+
+            temp_name = "{0}.{1}.tmp".format(self.filename, os.getpid())
+            try:
+                os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+                with open(temp_name, "w", encoding="utf-8") as file:
+                    json.dump({
+                        "version": self.version,
+                        "entries": self.entries
+                    }, file)
+
+                os.replace(temp_name, self.filename)
+                self.dirty = False
+
+            except OSError as err:
+                print("remote_build: unable to save hash cache: {0}".format(err))
+
+
+### ---------------------------------------------------------------------------
+
+
+_cache = None
+_cache_lock = Lock()
+
+
+def get_hash_cache():
+    """
+    Return the global hash cache instance, creating it the first time it is
+    requested. The cache file lives in the Sublime cache folder.
+    """
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = HashCache(os.path.join(sublime.cache_path(),
+                                            "RemoteBuild", "file_hashes.json"))
+
+        return _cache
+
+
+### ---------------------------------------------------------------------------
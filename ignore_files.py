@@ -0,0 +1,273 @@
+import sublime
+
+from threading import Lock
+import re
+import os
+
+from .git_index import find_work_tree
+
+
+### ---------------------------------------------------------------------------
+
+
+# The files in a folder whose patterns say what in that folder (and beneath
+# it) is not a part of the build, in increasing order of precedence; .rbignore
+# uses the .gitignore syntax, for things that should be in the repository but
+# not sent to the build server.
+IGNORE_FILES = (".gitignore", ".rbignore")
+
+# Ignore rules are case sensitive, except on Windows and MacOS whose file
+# systems are case insensitive by default.
+_CASE_SENSITIVE = sublime.platform() not in ("windows", "osx")
+
+
+### ---------------------------------------------------------------------------
+
+
+def _translate(pattern):
+    """
+    Translate the glob portion of a gitignore pattern into a regular
+    expression. Wildcards never match a "/", except for "**" when it appears
+    as a whole path component.
+    """
+    result = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith("**/", i) and (i == 0 or pattern[i - 1] == "/"):
+            result.append("(?:.*/)?")
+            i += 3
+            continue
+
+        if pattern.startswith("**", i) and i + 2 == n and (i == 0 or pattern[i - 1] == "/"):
+            result.append(".*")
+            i += 2
+            continue
+
+        i += 1
+        if c == "*":
+            while i < n and pattern[i] == "*":
+                i += 1
+            result.append("[^/]*")
+        elif c == "?":
+            result.append("[^/]")
+        elif c == "\\" and i < n:
+            result.append(re.escape(pattern[i]))
+            i += 1
+        elif c == "[":
+            end = i
+            if end < n and pattern[end] in "!^":
+                end += 1
+            if end < n and pattern[end] == "]":
+                end += 1
+            while end < n and pattern[end] != "]":
+                end += 1
+
+            if end >= n:
+                result.append("\\[")
+            else:
+                body = pattern[i:end].replace("\\", "\\\\")
+                if body[:1] in "!^":
+                    body = "^" + body[1:]
+                result.append("[" + body + "]")
+                i = end + 1
+        else:
+            result.append(re.escape(c))
+
+    return "".join(result)
+
+
+class _Rule():
+    """
+    A single compiled pattern from an ignore file.
+    """
+    __slots__ = ("regex", "negated", "dir_only")
+
+    def __init__(self, regex, negated, dir_only):
+        self.regex = regex
+        self.negated = negated
+        self.dir_only = dir_only
+
+
+def parse_rules(lines):
+    """
+    Given the lines of a file in the .gitignore format, return a list of
+    _Rule instances for the patterns in it, in the order that they appear.
+    """
+    flags = 0 if _CASE_SENSITIVE else re.IGNORECASE
+    rules = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+
+        # Trailing spaces are ignored unless they are escaped.
+        stripped = line.rstrip(" ")
+        if stripped.endswith("\\") and len(stripped) < len(line):
+            stripped += " "
+        line = stripped
+
+        if not line or line.startswith("#"):
+            continue
+
+        negated = line.startswith("!")
+        if negated:
+            line = line[1:]
+        elif line.startswith("\\"):
+            line = line[1:]
+
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            continue
+
+        # A pattern with a separator in it is relative to the folder of the
+        # ignore file; otherwise it matches a name at any depth.
+        if "/" in line:
+            regex = _translate(line.lstrip("/"))
+        else:
+            regex = "(?:.*/)?" + _translate(line)
+
+        rules.append(_Rule(re.compile(regex + "$", flags | re.DOTALL), negated, dir_only))
+
+    return rules
+
+
+### ---------------------------------------------------------------------------
+
+
+# The rules for every folder that has ignore files, keyed on the absolute path
+# of the folder, along with the stat information of the files that they were
+# read from, so that edited ignore files are read again.
+_rule_cache = {}
+_rule_lock = Lock()
+
+
+def folder_rules(path, names=None):
+    """
+    Return the list of rules from the ignore files in the given folder, which
+    is empty if there are none. names is the set of names in the folder, if
+    it is already known; this allows folders without ignore files to be
+    skipped without looking for them.
+    """
+    files = [os.path.join(path, name) for name in IGNORE_FILES
+                if names is None or name in names]
+
+    key = []
+    for name in files:
+        try:
+            stat = os.stat(name)
+            key.append((name, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            pass
+
+    if not key:
+        return []
+
+    key = tuple(key)
+    with _rule_lock:
+        cached = _rule_cache.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+    rules = []
+    for name, _, _ in key:
+        try:
+            with open(name, "r", encoding="utf-8", errors="replace") as file:
+                rules.extend(parse_rules(file))
+        except OSError:
+            pass
+
+    with _rule_lock:
+        _rule_cache[path] = (key, rules)
+
+    return rules
+
+
+def is_ignored(chain, relative_name, is_dir):
+    """
+    Given the chain of rules for the folder that contains a file or folder,
+    return a boolean to indicate if the given name (relative to the folder
+    being walked) is ignored.
+
+    A chain is a list of (prefix, lead, rules) tuples, from the outermost
+    folder to the innermost. The prefix is the relative name of the folder
+    that the rules came from, with a trailing separator; for rules from the
+    folders above the one being walked, it is empty and lead is instead the
+    path from that folder down to the one being walked.
+
+    As in git, the last rule that matches wins, and rules in deeper folders
+    override those in the folders above them.
+    """
+    for prefix, lead, rules in reversed(chain):
+        name = (lead + relative_name[len(prefix):]).replace(os.sep, "/")
+        for rule in reversed(rules):
+            if (is_dir or not rule.dir_only) and rule.regex.match(name):
+                return not rule.negated
+
+    return False
+
+
+def base_chain(search_path, top=None):
+    """
+    Return the chain of rules that apply to the given folder from the folders
+    above it; as in git, the ignore files of a folder apply to everything
+    beneath it. Folders are considered up to the top of the git work tree
+    that contains the folder, or the given top folder if that is further up.
+    """
+    path = os.path.abspath(search_path)
+    stops = [os.path.abspath(top)] if top is not None else []
+    found = find_work_tree(path)
+    if found is not None:
+        stops.append(found[0])
+
+    if not stops:
+        return []
+
+    stop = min(stops, key=len)
+    chain = []
+    lead = ""
+    while path != stop:
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+
+        lead = os.path.basename(path) + os.sep + lead
+        path = parent
+        rules = folder_rules(path)
+        if rules:
+            chain.insert(0, ("", lead, rules))
+
+    return chain
+
+
+def extend_chain(chain, path, prefix, names=None):
+    """
+    Return the chain for the folder at the given absolute path, whose name
+    relative to the folder being walked is prefix, given the chain of its
+    parent folder.
+    """
+    rules = folder_rules(path, names)
+    return chain + [(prefix, "", rules)] if rules else chain
+
+
+def path_ignored(search_path, relative_name, is_dir=False):
+    """
+    Return a boolean to indicate if the given name inside of the given folder
+    is ignored, either directly or because a folder that contains it is.
+    This is for checking a single path, such as one that a file system
+    watcher reported as changed; a walk builds its chain as it goes instead.
+    """
+    chain = extend_chain(base_chain(search_path), search_path, "")
+    parts = relative_name.split(os.sep)
+
+    prefix = ""
+    for part in parts[:-1]:
+        if is_ignored(chain, prefix + part, True):
+            return True
+
+        prefix = prefix + part + os.sep
+        chain = extend_chain(chain, os.path.join(search_path, prefix[:-1]), prefix)
+
+    return is_ignored(chain, relative_name, is_dir)
+
+
+### ---------------------------------------------------------------------------
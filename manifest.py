@@ -0,0 +1,330 @@
+from collections.abc import Mapping
+import binascii
+import sys
+import os
+
+from .digests import get_algorithm
+
+
+### ---------------------------------------------------------------------------
+
+
+class FileRecord():
+    """
+    The details of a single file in a manifest. This is a compact replacement
+    for a dictionary with "name", "last_modified" and "digest" keys; the digest
+    is stored in its binary form, and the name is interned so that it is
+    shared with the key that the record is stored under.
+
+    For compatibility, records can be indexed like the dictionaries that they
+    replace, and dict(record) returns such a dictionary. The digest is also
+    available under the "sha1" key that it had before the digest algorithm
+    became selectable, whatever algorithm actually produced it.
+
+    Large files also carry the list of their content defined chunks (see
+    chunker.py) when they were chunked while being gathered, or None. This
+    is not a part of the record as far as comparisons are concerned.
+    """
+    __slots__ = ("name", "last_modified", "digest", "chunks")
+
+    _keys = ("name", "last_modified", "digest")
+
+    def __init__(self, name, last_modified, digest, chunks=None):
+        self.name = sys.intern(name)
+        self.last_modified = last_modified
+        self.digest = digest
+        self.chunks = chunks
+
+    def __repr__(self):
+        return "<FileRecord name='{0}' last_modified={1} digest={2}>".format(
+            self.name, self.last_modified, self["digest"])
+
+    def __eq__(self, other):
+        if not isinstance(other, FileRecord):
+            return NotImplemented
+
+        return (self.name == other.name and
+                self.last_modified == other.last_modified and
+                self.digest == other.digest)
+
+    __hash__ = None
+
+    def __getitem__(self, key):
+        if key == "name":
+            return self.name
+        if key == "last_modified":
+            return self.last_modified
+        if key in ("digest", "sha1"):
+            if self.digest is None:
+                return None
+            return binascii.hexlify(self.digest).decode("ascii")
+
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self._keys
+
+    def renamed(self, name):
+        """
+        Return a copy of this record under a different name; the digest and
+        chunks are shared with this record.
+        """
+        return FileRecord(name, self.last_modified, self.digest, self.chunks)
+
+
+def file_digest(info):
+    """
+    Given the details of a file as either a FileRecord or a dictionary, return
+    the binary digest of its contents, or None if it was not hashed.
+    """
+    if isinstance(info, FileRecord):
+        return info.digest
+
+    digest = info.get("digest", info.get("sha1"))
+    return None if digest is None else binascii.unhexlify(digest)
+
+
+def check_algorithms(ours, theirs):
+    """
+    Given two manifests (or folder manifests), raise a ValueError if their
+    digests were calculated with different algorithms, since the digests of
+    identical files would then never match.
+    """
+    if ours.algorithm != theirs.algorithm:
+        raise ValueError("Cannot compare manifests with different digest algorithms ({0} and {1})".format(
+            ours.algorithm, theirs.algorithm))
+
+
+### ---------------------------------------------------------------------------
+
+
+class _DirNode():
+    """
+    A single folder in the Merkle tree of a FolderManifest; this tracks the
+    files and subfolders directly inside the folder, and the hash of the
+    folder, which covers the names and contents of everything beneath it.
+    """
+    __slots__ = ("files", "dirs", "digest")
+
+    def __init__(self):
+        self.files = set()
+        self.dirs = set()
+        self.digest = None
+
+
+class FolderManifest(Mapping):
+    """
+    The files contained in a single build folder, as a read only mapping of
+    relative file names to FileRecord instances.
+
+    The folder also carries a Merkle tree with a hash for every folder in it,
+    so that two manifests can be compared by looking only at the folders
+    whose hashes differ. The tree is built on demand and discarded whenever
+    the folder is modified.
+
+    algorithm is the name of the digest algorithm that the digests of all of
+    the files in the folder were calculated with; the Merkle tree uses it as
+    well. None means the default algorithm.
+    """
+    __slots__ = ("algorithm", "_records", "_tree")
+
+    def __init__(self, algorithm=None):
+        self.algorithm = get_algorithm(algorithm).name
+        self._records = {}
+        self._tree = None
+
+    def __repr__(self):
+        return "<FolderManifest algorithm={0} files={1}>".format(
+            self.algorithm, len(self._records))
+
+    def __getitem__(self, name):
+        return self._records[name]
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, name):
+        return name in self._records
+
+    def add(self, record):
+        """
+        Add the given record to this folder, replacing any existing record
+        with the same name.
+        """
+        self._records[record.name] = record
+        self._tree = None
+
+    def missing(self, names):
+        """
+        Return a list of the names from the given iterable that are not in
+        this folder.
+        """
+        return [name for name in names if name not in self._records]
+
+    def discard(self, name):
+        """
+        Remove the record with the given name, if there is one.
+        """
+        if self._records.pop(name, None) is not None:
+            self._tree = None
+
+    def _get_tree(self):
+        """
+        Return the Merkle tree for this folder, building it if needed. This is
+        a dictionary that maps the relative name of every folder (with a
+        trailing separator, or an empty string for the top folder) to a
+        _DirNode.
+        """
+        if self._tree is not None:
+            return self._tree
+
+        tree = {"": _DirNode()}
+        for name in self._records:
+            parent = ""
+            parts = name.split(os.sep)
+            for part in parts[:-1]:
+                tree[parent].dirs.add(part)
+                parent = parent + part + os.sep
+                if parent not in tree:
+                    tree[parent] = _DirNode()
+
+            tree[parent].files.add(parts[-1])
+
+        # Hash the deepest folders first, so that the hashes of the subfolders
+        # of a folder are always known when the folder itself is hashed.
+        algorithm = get_algorithm(self.algorithm)
+        for path in sorted(tree, key=lambda p: p.count(os.sep), reverse=True):
+            node = tree[path]
+            entries = [(n, b"f", self._records[path + n].digest or b"") for n in node.files]
+            entries.extend((n, b"d", tree[path + n + os.sep].digest) for n in node.dirs)
+
+            hasher = algorithm.new()
+            for name, kind, digest in sorted(entries):
+                hasher.update(kind + name.encode("utf-8") + b"\0" + digest)
+            node.digest = hasher.digest()
+
+        self._tree = tree
+        return tree
+
+    def tree_hash(self, folder=""):
+        """
+        Return the Merkle hash of the given folder within this build folder,
+        which defaults to the build folder itself. Two folders with the same
+        hash contain exactly the same files with exactly the same content.
+        """
+        return self._get_tree()[folder].digest
+
+    def _names_under(self, tree, folder):
+        """
+        Yield the relative names of all files at or beneath the given folder
+        in the provided tree.
+        """
+        pending = [folder]
+        while pending:
+            folder = pending.pop()
+            node = tree[folder]
+            for name in node.files:
+                yield folder + name
+            pending.extend(folder + name + os.sep for name in node.dirs)
+
+    def diff(self, other):
+        """
+        Compare this folder against another FolderManifest, returning a tuple
+        of lists of the names of the files that are only in this folder, only
+        in the other folder, and in both but with different content.
+
+        Only folders whose Merkle hashes differ are examined, so identical
+        subtrees are skipped without looking at any of their files. Folders
+        hashed with different algorithms can't be compared, so that raises a
+        ValueError.
+        """
+        check_algorithms(self, other)
+
+        ours = self._get_tree()
+        theirs = other._get_tree()
+
+        added, removed, modified = [], [], []
+        pending = [""]
+        while pending:
+            folder = pending.pop()
+            our_node = ours[folder]
+            their_node = theirs[folder]
+            if our_node.digest == their_node.digest:
+                continue
+
+            added.extend(folder + n for n in our_node.files - their_node.files)
+            removed.extend(folder + n for n in their_node.files - our_node.files)
+            modified.extend(folder + n for n in our_node.files & their_node.files
+                if self._records[folder + n].digest != other._records[folder + n].digest)
+
+            for name in our_node.dirs - their_node.dirs:
+                added.extend(self._names_under(ours, folder + name + os.sep))
+            for name in their_node.dirs - our_node.dirs:
+                removed.extend(other._names_under(theirs, folder + name + os.sep))
+            pending.extend(folder + name + os.sep for name in our_node.dirs & their_node.dirs)
+
+        return added, removed, modified
+
+
+class Manifest(Mapping):
+    """
+    The files that make up a build, as a read only mapping of absolute build
+    folder paths to FolderManifest instances. Every folder in the manifest
+    uses the digest algorithm of the manifest.
+    """
+    __slots__ = ("algorithm", "_folders")
+
+    def __init__(self, algorithm=None):
+        self.algorithm = get_algorithm(algorithm).name
+        self._folders = {}
+
+    def __repr__(self):
+        return "<Manifest algorithm={0} folders={1}>".format(
+            self.algorithm, list(self._folders))
+
+    def __getitem__(self, root):
+        return self._folders[root]
+
+    def __iter__(self):
+        return iter(self._folders)
+
+    def __len__(self):
+        return len(self._folders)
+
+    def __contains__(self, root):
+        return root in self._folders
+
+    def folder(self, root):
+        """
+        Return the FolderManifest for the given build folder, creating an
+        empty one if the folder is not already in the manifest.
+        """
+        folder = self._folders.get(root)
+        if folder is None:
+            folder = self._folders[root] = FolderManifest(self.algorithm)
+
+        return folder
+
+    def root_hash(self):
+        """
+        Return the Merkle hash of the whole manifest, which covers the paths
+        of all of the build folders and the names and contents of every file
+        in them. Two manifests with the same root hash are identical.
+        """
+        hasher = get_algorithm(self.algorithm).new()
+        for root in sorted(self._folders):
+            hasher.update(root.encode("utf-8") + b"\0" + self._folders[root].tree_hash())
+
+        return hasher.digest()
+
+
+### ---------------------------------------------------------------------------
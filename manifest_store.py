@@ -0,0 +1,490 @@
+import sublime
+
+from collections.abc import Mapping
+from threading import RLock
+import uuid
+import os
+
+from .manifest import FileRecord, check_algorithms
+from .digests import get_algorithm
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+
+### ---------------------------------------------------------------------------
+
+
+# The tables that hold stored manifests. Every manifest has a name that is
+# unique in the store, and the files of each of its folders are keyed on the
+# folder and the relative file name, so that looking up a file or joining the
+# files of two folders is always an indexed operation.
+#
+# The sort key of a file is its name with the path separators replaced with
+# a NUL byte; ordering on it visits the files of each folder in the same
+# order that the in memory Merkle tree sorts them, with all of the files in
+# a subfolder grouped together.
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS manifests (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    algorithm TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS folders (
+    id INTEGER PRIMARY KEY,
+    manifest INTEGER NOT NULL,
+    root TEXT NOT NULL,
+    UNIQUE (manifest, root)
+);
+
+CREATE TABLE IF NOT EXISTS files (
+    folder INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    sort_key BLOB NOT NULL,
+    last_modified REAL,
+    digest BLOB,
+    PRIMARY KEY (folder, name)
+);
+
+CREATE INDEX IF NOT EXISTS files_by_sort_key ON files (folder, sort_key);
+"""
+
+# Files added to a stored folder are written in batches of this many.
+_BATCH_SIZE = 5000
+
+# Files are read back out of the store in pages of this many.
+_PAGE_SIZE = 2000
+
+# The marker in the names of temporary manifests; see create_temporary().
+_TEMPORARY = "~partial~"
+
+
+### ---------------------------------------------------------------------------
+
+
+class ManifestStore():
+    """
+    A collection of named manifests stored in a SQLite database, so that the
+    manifest of a project with millions of files doesn't need to be held in
+    memory. Stored manifests provide the same interface as Manifest, and the
+    differences between two folders in the same store are calculated by the
+    database.
+
+    All access to the database is serialized through a lock, so a store can
+    be shared between threads.
+    """
+    def __init__(self, filename):
+        if sqlite3 is None:
+            raise RuntimeError("The sqlite3 module is not available")
+
+        self.filename = filename
+        self.lock = RLock()
+        self.pending = []
+
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.executescript(_SCHEMA)
+
+        # Temporary manifests left behind by an earlier session (one that
+        # ended while a gather was in progress) can never be finished.
+        for name in self.names():
+            if _TEMPORARY in name:
+                self.drop(name)
+
+    def _flush(self):
+        """
+        Write any files that have been added but not yet written to the
+        database. This must be called with the lock held.
+        """
+        if self.pending:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", self.pending)
+            self.pending = []
+
+    def execute(self, sql, params=(), flush=True):
+        """
+        Execute the given SQL with the given parameters, returning all of the
+        resulting rows. Any pending files are written first, unless flush is
+        False because the SQL doesn't involve the files table; otherwise a
+        lookup of the folders of a manifest would defeat the batching.
+        """
+        with self.lock:
+            if flush:
+                self._flush()
+            return self.db.execute(sql, params).fetchall()
+
+    def executemany(self, sql, rows):
+        """
+        Execute the given SQL once for every set of parameters in rows, after
+        writing any pending files.
+        """
+        with self.lock:
+            self._flush()
+            self.db.executemany(sql, rows)
+
+    def add_file(self, folder_id, record):
+        """
+        Queue the given record to be written to the given folder.
+        """
+        with self.lock:
+            self.pending.append((folder_id, record.name,
+                                 record.name.replace(os.sep, "\0").encode("utf-8"),
+                                 record.last_modified, record.digest))
+            if len(self.pending) >= _BATCH_SIZE:
+                self._flush()
+
+    def commit(self):
+        """
+        Write all pending changes to disk.
+        """
+        with self.lock:
+            self._flush()
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.db.close()
+
+    def names(self):
+        """
+        Return the names of all of the manifests in this store.
+        """
+        return [row[0] for row in self.execute("SELECT name FROM manifests ORDER BY name",
+                                               flush=False)]
+
+    def open(self, name):
+        """
+        Return the stored manifest with the given name, or None if there is no
+        such manifest.
+        """
+        rows = self.execute("SELECT id, algorithm FROM manifests WHERE name = ?", (name,),
+                            flush=False)
+        if not rows:
+            return None
+
+        return StoredManifest(self, rows[0][0], name, rows[0][1])
+
+    def create(self, name, algorithm=None):
+        """
+        Create a new empty manifest with the given name and digest algorithm,
+        replacing any existing manifest with that name.
+        """
+        algorithm = get_algorithm(algorithm).name
+        with self.lock:
+            self.drop(name)
+            cursor = self.db.execute(
+                "INSERT INTO manifests (name, algorithm) VALUES (?, ?)", (name, algorithm))
+            self.db.commit()
+
+            return StoredManifest(self, cursor.lastrowid, name, algorithm)
+
+    def create_temporary(self, name, algorithm=None):
+        """
+        Create a new empty manifest with a unique name based on the given
+        name, which doesn't replace any existing manifest; once it has been
+        filled, it can take the place of the manifest with the given name (see
+        swap()), or be dropped if it's abandoned.
+        """
+        return self.create("{0}{1}{2}".format(name, _TEMPORARY, uuid.uuid4().hex), algorithm)
+
+    def swap(self, name, manifest):
+        """
+        Give the given manifest the given name, in place of the manifest that
+        currently has it. The manifest that is replaced is only renamed here,
+        to a temporary name that is returned (or None if there was no such
+        manifest), since dropping a large manifest takes a while; the caller
+        should drop it once it's convenient.
+        """
+        with self.lock:
+            self._flush()
+            retired = None
+            if self.open(name) is not None:
+                retired = "{0}{1}{2}".format(name, _TEMPORARY, uuid.uuid4().hex)
+                self.db.execute("UPDATE manifests SET name = ? WHERE name = ?", (retired, name))
+
+            self.db.execute("UPDATE manifests SET name = ? WHERE id = ?", (name, manifest.id))
+            self.db.commit()
+            manifest.name = name
+
+            return retired
+
+    def drop(self, name):
+        """
+        Remove the manifest with the given name and all of its files, if it
+        exists.
+        """
+        with self.lock:
+            self._flush()
+            self.db.execute("""DELETE FROM files WHERE folder IN (
+                                   SELECT folders.id FROM folders
+                                   JOIN manifests ON manifests.id = folders.manifest
+                                   WHERE manifests.name = ?)""", (name,))
+            self.db.execute("""DELETE FROM folders WHERE manifest IN (
+                                   SELECT id FROM manifests WHERE name = ?)""", (name,))
+            self.db.execute("DELETE FROM manifests WHERE name = ?", (name,))
+            self.db.commit()
+
+
+### ---------------------------------------------------------------------------
+
+
+class StoredFolder(Mapping):
+    """
+    The files in a single build folder of a StoredManifest, as a read only
+    mapping of relative file names to FileRecord instances; this is the
+    stored equivalent of a FolderManifest.
+    """
+    def __init__(self, manifest, root, folder_id):
+        self.store = manifest.store
+        self.algorithm = manifest.algorithm
+        self.root = root
+        self.id = folder_id
+
+    def __repr__(self):
+        return "<StoredFolder algorithm={0} root='{1}'>".format(self.algorithm, self.root)
+
+    def __getitem__(self, name):
+        rows = self.store.execute(
+            "SELECT name, last_modified, digest FROM files WHERE folder = ? AND name = ?",
+            (self.id, name))
+        if not rows:
+            raise KeyError(name)
+
+        return FileRecord(*rows[0])
+
+    def __contains__(self, name):
+        return bool(self.store.execute(
+            "SELECT 1 FROM files WHERE folder = ? AND name = ?", (self.id, name)))
+
+    def __len__(self):
+        return self.store.execute(
+            "SELECT COUNT(*) FROM files WHERE folder = ?", (self.id,))[0][0]
+
+    def __iter__(self):
+        for name, _, _ in self._rows():
+            yield name
+
+    def items(self):
+        """
+        Yield a (name, FileRecord) tuple for every file in this folder. This
+        reads the files a page at a time, rather than looking each one up.
+        """
+        for row in self._rows():
+            yield row[0], FileRecord(*row)
+
+    def values(self):
+        for _, record in self.items():
+            yield record
+
+    def _rows(self, order="name"):
+        """
+        Yield a (name, last_modified, digest) tuple for every file in this
+        folder, ordered on the given column; rows are fetched a page at a
+        time using the index, so this doesn't hold the database lock between
+        pages.
+        """
+        last = "" if order == "name" else b""
+        while True:
+            rows = self.store.execute(
+                """SELECT name, last_modified, digest, {0} FROM files
+                   WHERE folder = ? AND {0} > ? ORDER BY {0} LIMIT ?""".format(order),
+                (self.id, last, _PAGE_SIZE))
+            for row in rows:
+                yield row[:3]
+
+            if len(rows) < _PAGE_SIZE:
+                return
+
+            last = rows[-1][3]
+
+    def add(self, record):
+        """
+        Add the given record to this folder, replacing any existing record
+        with the same name.
+        """
+        self.store.add_file(self.id, record)
+
+    def missing(self, names):
+        """
+        Return a list of the names from the given iterable that are not in
+        this folder. The names are joined against the files of the folder in a
+        temporary table, rather than each being looked up on its own.
+        """
+        with self.store.lock:
+            self.store.execute("CREATE TEMP TABLE IF NOT EXISTS lookup (name TEXT PRIMARY KEY)")
+            self.store.executemany("INSERT OR IGNORE INTO temp.lookup VALUES (?)",
+                                   ((name,) for name in names))
+            rows = self.store.execute(
+                """SELECT lookup.name FROM temp.lookup
+                   LEFT JOIN files ON files.folder = ? AND files.name = lookup.name
+                   WHERE files.name IS NULL""", (self.id,))
+            self.store.execute("DELETE FROM temp.lookup")
+
+        return [row[0] for row in rows]
+
+    def discard(self, name):
+        """
+        Remove the record with the given name, if there is one.
+        """
+        self.store.execute("DELETE FROM files WHERE folder = ? AND name = ?",
+                           (self.id, name))
+
+    def tree_hash(self):
+        """
+        Return the Merkle hash of this folder, which is identical to what the
+        tree_hash() of a FolderManifest with the same files would return. The
+        files are visited in sort key order, which groups every subfolder
+        together, so only the folders along the current path are held in
+        memory while hashing.
+        """
+        algorithm = get_algorithm(self.algorithm)
+
+        # The stack of folders that are currently being hashed, as lists of
+        # the folder name and the hash object for the folder.
+        stack = [["", algorithm.new()]]
+
+        def pop():
+            name, hasher = stack.pop()
+            stack[-1][1].update(b"d" + name.encode("utf-8") + b"\0" + hasher.digest())
+
+        for name, _, digest in self._rows("sort_key"):
+            parts = name.split(os.sep)
+            depth = 1
+            while depth < len(stack) and depth < len(parts) and stack[depth][0] == parts[depth - 1]:
+                depth += 1
+
+            while len(stack) > depth:
+                pop()
+
+            for part in parts[len(stack) - 1:-1]:
+                stack.append([part, algorithm.new()])
+
+            stack[-1][1].update(b"f" + parts[-1].encode("utf-8") + b"\0" + (digest or b""))
+
+        while len(stack) > 1:
+            pop()
+
+        return stack[0][1].digest()
+
+    def diff(self, other):
+        """
+        Compare this folder against another folder in the same store,
+        returning a tuple of lists of the names of the files that are only in
+        this folder, only in the other folder, and in both but with different
+        content. The comparison is done by the database, as joins on the
+        index of the files table.
+        """
+        check_algorithms(self, other)
+        if other.store is not self.store:
+            raise ValueError("Stored folders can only be compared within the same store")
+
+        only_in = """SELECT a.name FROM files a
+                     LEFT JOIN files b ON b.folder = ? AND b.name = a.name
+                     WHERE a.folder = ? AND b.name IS NULL"""
+
+        added = self.store.execute(only_in, (other.id, self.id))
+        removed = self.store.execute(only_in, (self.id, other.id))
+        modified = self.store.execute(
+            """SELECT a.name FROM files a
+               JOIN files b ON b.folder = ? AND b.name = a.name
+               WHERE a.folder = ? AND a.digest IS NOT b.digest""", (other.id, self.id))
+
+        return ([row[0] for row in added], [row[0] for row in removed],
+                [row[0] for row in modified])
+
+
+class StoredManifest(Mapping):
+    """
+    The files that make up a build, as a read only mapping of absolute build
+    folder paths to StoredFolder instances; this is the stored equivalent of
+    a Manifest.
+    """
+    def __init__(self, store, manifest_id, name, algorithm):
+        self.store = store
+        self.id = manifest_id
+        self.name = name
+        self.algorithm = algorithm
+
+    def __repr__(self):
+        return "<StoredManifest name='{0}' algorithm={1} folders={2}>".format(
+            self.name, self.algorithm, list(self))
+
+    def _folder_ids(self):
+        return dict(self.store.execute(
+            "SELECT root, id FROM folders WHERE manifest = ?", (self.id,), flush=False))
+
+    def __getitem__(self, root):
+        folder_id = self._folder_ids().get(root)
+        if folder_id is None:
+            raise KeyError(root)
+
+        return StoredFolder(self, root, folder_id)
+
+    def __iter__(self):
+        return iter(sorted(self._folder_ids()))
+
+    def __len__(self):
+        return len(self._folder_ids())
+
+    def folder(self, root):
+        """
+        Return the StoredFolder for the given build folder, creating an empty
+        one if the folder is not already in the manifest.
+        """
+        with self.store.lock:
+            if root not in self._folder_ids():
+                self.store.execute("INSERT INTO folders (manifest, root) VALUES (?, ?)",
+                                   (self.id, root), flush=False)
+
+            return self[root]
+
+    def root_hash(self):
+        """
+        Return the Merkle hash of the whole manifest; this is the same as the
+        root_hash() of a Manifest with the same content.
+        """
+        hasher = get_algorithm(self.algorithm).new()
+        for root in sorted(self._folder_ids()):
+            hasher.update(root.encode("utf-8") + b"\0" + self[root].tree_hash())
+
+        return hasher.digest()
+
+
+### ---------------------------------------------------------------------------
+
+
+_store = None
+_store_lock = RLock()
+
+
+def plugin_unloaded():
+    global _store
+
+    with _store_lock:
+        if _store is not None:
+            _store.close()
+            _store = None
+
+
+def get_manifest_store():
+    """
+    Return the global manifest store, creating it the first time it is
+    requested; the database lives in the Sublime cache folder. This raises a
+    RuntimeError if the sqlite3 module is not available.
+    """
+    global _store
+
+    with _store_lock:
+        if _store is None:
+            path = os.path.join(sublime.cache_path(), "RemoteBuild")
+            os.makedirs(path, exist_ok=True)
+            _store = ManifestStore(os.path.join(path, "manifests.sqlite"))
+
+        return _store
+
+
+### ---------------------------------------------------------------------------
@@ -1,12 +1,19 @@
 import sublime
 
 import inspect
+import functools
+import operator
 import struct
 import socket
-import hashlib
+import binascii
+import shutil
+import os
 
 from os.path import dirname, basename, join
 
+from .digests import get_algorithm
+from .compression import compress, decompress
+
 
 class ProtocolMessage():
     """
@@ -17,6 +24,12 @@ class ProtocolMessage():
     """
     _registry = {}
 
+    # The schema of the message; a tuple of Field instances in the order that
+    # their values appear in the encoded message. Messages with a schema are
+    # encoded and decoded by a MessageCodec compiled from it when they are
+    # registered, and don't need to implement encode() and decode().
+    fields = None
+
     @classmethod
     def register(cls, classObj):
         """
@@ -35,6 +48,9 @@ class ProtocolMessage():
         if msg_id in cls._registry:
             raise ValueError('Duplicate message type detected (%d, %s)' % (msg_id, classObj.__name__))
 
+        if classObj.fields is not None:
+            classObj._codec = MessageCodec(msg_id, classObj.fields)
+
         cls._registry[msg_id] = classObj
 
     @classmethod
@@ -68,7 +84,10 @@ class ProtocolMessage():
         that data. The data provided will be exactly the data that was returned
         from a prior call to encode().
         """
-        raise NotImplementedError('abstract base method should be overridden')
+        if cls.fields is None:
+            raise NotImplementedError('abstract base method should be overridden')
+
+        return cls._codec.decode(cls, data)
 
     def encode(self):
         """
@@ -76,7 +95,513 @@ class ProtocolMessage():
         decode() method can use to restore this object state. The first field
         in the encoded message needs to be the message type code.
         """
-        raise NotImplementedError('abstract base method should be overridden')
+        if self.fields is None:
+            raise NotImplementedError('abstract base method should be overridden')
+
+        return self._codec.encode(self)
+
+    def encode_parts(self):
+        """
+        Return a list of the parts that make up the encoded form of this
+        message, each of which is either a bytes-like object or a FileRegion
+        whose content goes out straight from the file. Messages with a schema
+        never copy the data of their Bytes fields into the encoded message;
+        for other messages the whole message is the one part returned by
+        encode().
+        """
+        if self.fields is not None:
+            return self._codec.encode_parts(self)
+
+        return [self.encode()]
+
+
+class FileRegion():
+    """
+    A region of a file that is sent to the other end of a connection directly
+    from the file, rather than being read into memory first. Where the
+    platform supports it this uses os.sendfile(), so the content goes from
+    the file to the socket without passing through Python at all.
+
+    The file is only opened once the region starts being sent, and the offset
+    is advanced as the socket accepts data, so a region can be sent over any
+    number of partial writes.
+    """
+    # The largest block read at once when os.sendfile() can't be used.
+    block_size = 65536
+
+    def __init__(self, filename, offset, length):
+        self.filename = filename
+        self.offset = offset
+        self.remaining = length
+        self.file = None
+
+    def __len__(self):
+        return self.remaining
+
+    def read(self):
+        """
+        Return the (remaining) content of the region as bytes; used when the
+        whole message is needed in memory.
+        """
+        with open(self.filename, "rb") as file:
+            file.seek(self.offset)
+            data = file.read(self.remaining)
+
+        if len(data) != self.remaining:
+            raise IOError("'{0}' changed size while being sent".format(self.filename))
+
+        return data
+
+    def send_to(self, sock):
+        """
+        Send as much of the region as the given socket will accept, returning
+        the number of bytes sent; the region is done when its remaining count
+        reaches 0. The socket may raise BlockingIOError if it can't accept
+        anything right now.
+        """
+        if not self.remaining:
+            return 0
+
+        if self.file is None:
+            self.file = open(self.filename, "rb")
+
+        sent = None
+        if hasattr(os, "sendfile"):
+            try:
+                sent = os.sendfile(sock.fileno(), self.file.fileno(),
+                                   self.offset, self.remaining)
+            except BlockingIOError:
+                raise
+            except OSError:
+                # Not every kind of file can be sent from; fall back to the
+                # slow path for this region.
+                sent = None
+
+        if sent is None:
+            self.file.seek(self.offset)
+            data = self.file.read(min(self.remaining, self.block_size))
+            sent = sock.send(data) if data else 0
+
+        # The message header already announced the length of the region, so
+        # running out of file is fatal to the connection.
+        if sent == 0:
+            raise IOError("'{0}' changed size while being sent".format(self.filename))
+
+        self.offset += sent
+        self.remaining -= sent
+        if not self.remaining:
+            self.close()
+
+        return sent
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def join_parts(parts):
+    """
+    Given the list of parts of an encoded message, return the whole message
+    as bytes, reading any file regions into memory.
+    """
+    return b"".join(part.read() if isinstance(part, FileRegion) else part
+                    for part in parts)
+
+
+### ---------------------------------------------------------------------------
+
+
+class Field():
+    """
+    The base class for the fields in the schema of a protocol message. Each
+    field names the attribute of the message that holds its value and gives
+    the struct format of the value on the wire, along with the functions that
+    convert a value to and from its form on the wire.
+
+    Variable fields have data of some length following the fixed portion of
+    the message; their struct format is for the 32 bit count that precedes
+    that data, and they know how to append that data to a message buffer and
+    unpack it again.
+    """
+    fmt = None
+    variable = False
+
+    # Conversions of a value to and from its form on the wire; None means that
+    # the value is used as is.
+    to_wire = None
+    from_wire = None
+
+    def __init__(self, name):
+        self.name = name
+
+
+class UInt8(Field):
+    fmt = "B"
+
+
+class UInt16(Field):
+    fmt = "H"
+
+
+class UInt32(Field):
+    fmt = "I"
+
+
+class UInt64(Field):
+    fmt = "Q"
+
+
+class Bool(Field):
+    fmt = "?"
+
+
+class FixedString(Field):
+    """
+    A string that is encoded as UTF-8 into a fixed number of bytes; shorter
+    strings are padded with NUL bytes and longer ones are truncated.
+    """
+    to_wire = staticmethod(str.encode)
+    from_wire = staticmethod(lambda value: value.decode("utf-8").rstrip("\000"))
+
+    def __init__(self, name, width):
+        super().__init__(name)
+        self.fmt = "%ds" % width
+
+
+class Bytes(Field):
+    """
+    Binary data of any length, preceded by its length. The data is not copied
+    into the encoded parts of a message; it's passed through as a part of its
+    own, so it can be a memoryview or a FileRegion. Likewise, a decoded value
+    is a memoryview over the received message data rather than a copy of it.
+    """
+    fmt = "I"
+    variable = True
+    inline = False
+    item_size = 1
+
+    def append_to(self, buffer, value):
+        buffer += value.read() if isinstance(value, FileRegion) else value
+
+    def unpack_from(self, data, offset, count):
+        return memoryview(data)[offset:offset + count]
+
+
+class String(Bytes):
+    """
+    A string of any length, encoded as UTF-8 and preceded by its length in
+    bytes. Unlike Bytes, this is packed into the encoded message.
+    """
+    inline = True
+    to_wire = staticmethod(str.encode)
+    from_wire = staticmethod(functools.partial(str, encoding="utf-8"))
+
+    def unpack_from(self, data, offset, count):
+        return data[offset:offset + count]
+
+
+class List(Field):
+    """
+    A list of items that all have the given struct format, preceded by the
+    number of items. Items with a format of a single value are plain values
+    rather than tuples.
+    """
+    fmt = "I"
+    variable = True
+    inline = True
+
+    def __init__(self, name, item_fmt):
+        super().__init__(name)
+        self.item = struct.Struct(">" + item_fmt)
+        self.item_size = self.item.size
+        self.single = len(self.item.unpack(bytes(self.item.size))) == 1
+
+    def append_to(self, buffer, value):
+        offset = len(buffer)
+        buffer.extend(bytes(len(value) * self.item_size))
+
+        pack_into = self.item.pack_into
+        for item in value:
+            if self.single:
+                pack_into(buffer, offset, item)
+            else:
+                pack_into(buffer, offset, *item)
+            offset += self.item_size
+
+    def unpack_from(self, data, offset, count):
+        unpack_from = self.item.unpack_from
+        end = offset + count * self.item.size
+        items = [unpack_from(data, pos) for pos in range(offset, end, self.item.size)]
+        if self.single:
+            items = [item[0] for item in items]
+
+        return items
+
+
+def _wire_values(fields):
+    """
+    Return a function that takes a message and returns a list of the values
+    of the given fields of it, in the form that they have on the wire.
+    """
+    if not fields:
+        return lambda msg: []
+
+    get = operator.attrgetter(*[field.name for field in fields])
+    conversions = [(index, field.to_wire) for index, field in enumerate(fields)
+                       if field.to_wire is not None]
+
+    if len(fields) == 1:
+        to_wire = fields[0].to_wire
+        if to_wire is None:
+            return lambda msg: [get(msg)]
+        return lambda msg: [to_wire(get(msg))]
+
+    def wire_values(msg):
+        values = list(get(msg))
+        for index, to_wire in conversions:
+            values[index] = to_wire(values[index])
+        return values
+
+    return wire_values
+
+
+class MessageCodec():
+    """
+    The encoder and decoder for a protocol message, built from the schema of
+    its fields when the message is registered.
+
+    The fields are split into segments, each of which is a run of fixed size
+    fields that ends either at the end of the message or with the count of a
+    variable field (whose data follows the segment); the struct for each
+    segment is created once, here. The first segment also holds the frame
+    length and the message ID.
+
+    Encoded messages are built in a single buffer; the data of each variable
+    field is appended to it as the segment before it is packed.
+    """
+    def __init__(self, msg_id, fields):
+        self.msg_id = msg_id
+        self.fields = fields
+
+        # The segments, as tuples of the struct that encodes the segment, the
+        # struct that decodes it (the first omits the frame length, which is
+        # not a part of the message data) and the fields in it.
+        self.segments = []
+        start = 0
+        for index, field in enumerate(fields):
+            if field.variable:
+                self._add_segment(fields[start:index + 1])
+                start = index + 1
+
+        if start < len(fields) or not self.segments:
+            self._add_segment(fields[start:])
+
+        self.fixed_size = sum(encoder.size for encoder, _, _ in self.segments)
+        self.split = any(field.variable and not field.inline for field in fields)
+        self.wire_values = _wire_values(fields)
+
+        if len(self.segments) == 1:
+            self.encode = self._single_encoder()
+            self.decode = self._single_decoder()
+        if not self.split:
+            encode = self.encode
+            self.encode_parts = lambda msg: [encode(msg)]
+
+    def _add_segment(self, fields):
+        fmt = "".join(field.fmt for field in fields)
+        first = not self.segments
+        self.segments.append((struct.Struct((">IH" if first else ">") + fmt),
+                              struct.Struct((">H" if first else ">") + fmt),
+                              fields))
+
+    def _single_encoder(self):
+        """
+        Return the function that encodes a message with a single segment,
+        which covers almost every message. The last field may be a variable
+        field, whose data is appended to the buffer after the space for the
+        segment, which is then packed in place.
+        """
+        wire_values = self.wire_values
+        msg_id = self.msg_id
+        size = self.fixed_size
+        encoder = self.segments[0][0]
+        field = self.fields[-1] if self.fields else None
+
+        if field is None or not field.variable:
+            pack = encoder.pack
+            return lambda msg: pack(size - 4, msg_id, *wire_values(msg))
+
+        # Strings are by far the most common variable field, and are simple
+        # enough to append here.
+        pack_into = encoder.pack_into
+        append_to = None if isinstance(field, String) else field.append_to
+
+        def encode(msg):
+            values = wire_values(msg)
+            value = values[-1]
+            values[-1] = len(value)
+
+            buffer = bytearray(size)
+            if append_to is None:
+                buffer += value
+            else:
+                append_to(buffer, value)
+
+            pack_into(buffer, 0, len(buffer) - 4, msg_id, *values)
+            return buffer
+
+        return encode
+
+    def _single_decoder(self):
+        """
+        Return the function that decodes a message with a single segment,
+        in the same way as _single_encoder().
+        """
+        msg_id = self.msg_id
+        decoder = self.segments[0][1]
+        unpack_from = decoder.unpack_from
+        size = decoder.size
+        field = self.fields[-1] if self.fields else None
+        if field is None or not field.variable:
+            field = None
+
+        # The fixed fields are set as they are unpacked; the variable field
+        # (if any) is always last, and is set once its data is unpacked. As
+        # in the encoder, strings are handled here.
+        string = isinstance(field, String)
+        fixed = [(field.name, field.from_wire) for field in self.fields
+                     if not field.variable]
+        plain = all(from_wire is None for _, from_wire in fixed)
+        names = [name for name, _ in fixed]
+
+        def decode(cls, data):
+            values = unpack_from(data)
+            msg = cls.__new__(cls)
+
+            if plain:
+                for name, value in zip(names, values[1:]):
+                    setattr(msg, name, value)
+            else:
+                for (name, from_wire), value in zip(fixed, values[1:]):
+                    setattr(msg, name, value if from_wire is None else from_wire(value))
+
+            if field is not None:
+                count = values[-1]
+                if size + count * field.item_size > len(data):
+                    raise ValueError("Message data length is invalid")
+                if string:
+                    value = data[size:size + count].decode("utf-8")
+                else:
+                    value = field.unpack_from(data, size, count)
+                    if field.from_wire is not None:
+                        value = field.from_wire(value)
+                setattr(msg, field.name, value)
+
+            return msg
+
+        return decode
+
+    def _pack(self, msg, split):
+        """
+        Pack the given message into a new buffer a segment at a time,
+        returning the buffer and a list of the (offset, value) of every Bytes
+        field. The data of Bytes fields is left out of the buffer if split is
+        True, but still counts towards the frame length.
+        """
+        values = self.wire_values(msg)
+        counts = [len(value) if field.variable else value
+                      for field, value in zip(self.fields, values)]
+
+        length = self.fixed_size - 4
+        for field, value in zip(self.fields, values):
+            if field.variable:
+                length += len(value) * field.item_size
+
+        buffer = bytearray()
+        external = []
+        index = 0
+        for encoder, _, fields in self.segments:
+            args = counts[index:index + len(fields)]
+            if index == 0:
+                args[0:0] = (length, self.msg_id)
+
+            buffer += encoder.pack(*args)
+            index += len(fields)
+
+            field = fields[-1] if fields else None
+            if field is not None and field.variable:
+                value = values[index - 1]
+                if not field.inline:
+                    external.append((len(buffer), value))
+                if field.inline or not split:
+                    field.append_to(buffer, value)
+
+        return buffer, external
+
+    def encode(self, msg):
+        """
+        Return the encoded form of the given message; for messages with a
+        single segment, this is replaced by a faster version when the codec
+        is created.
+        """
+        return self._pack(msg, False)[0]
+
+    def encode_parts(self, msg):
+        """
+        Return the encoded form of the given message as a list of parts; the
+        data of Bytes fields are parts of their own, between views of the
+        buffer that holds the rest of the message. Messages without any Bytes
+        fields are a single part, and this is replaced when the codec is
+        created.
+        """
+        buffer, external = self._pack(msg, True)
+        view = memoryview(buffer)
+
+        parts = []
+        start = 0
+        for offset, value in external:
+            parts.append(view[start:offset])
+            parts.append(value)
+            start = offset
+
+        if start < len(buffer):
+            parts.append(view[start:])
+
+        return parts
+
+    def decode(self, cls, data):
+        """
+        Decode the given message data (starting with the message ID) into a
+        new instance of the given message class. The values are set as
+        attributes of the instance without calling its constructor. As with
+        encode(), this is replaced for messages with a single segment.
+        """
+        msg = cls.__new__(cls)
+
+        offset = 0
+        for _, decoder, fields in self.segments:
+            values = decoder.unpack_from(data, offset)
+            if offset == 0:
+                values = values[1:]
+            offset += decoder.size
+
+            for field, value in zip(fields, values):
+                if field.variable:
+                    end = offset + value * field.item_size
+                    if end > len(data):
+                        raise ValueError("Message data length is invalid")
+                    value = field.unpack_from(data, offset, value)
+                    offset = end
+
+                if field.from_wire is not None:
+                    value = field.from_wire(value)
+                setattr(msg, field.name, value)
+
+        return msg
+
+
+### ---------------------------------------------------------------------------
 
 
 class IntroductionMessage(ProtocolMessage):
@@ -84,45 +609,46 @@ class IntroductionMessage(ProtocolMessage):
     This message is used to introduce ourselves to the build server and declare
     what version of the protocol we speak, so that the server knows what to
     expect from us.
+
+    We also offer the compression codecs that we support, in the order that
+    we would prefer them; the server picks one and tells us which with a
+    SetCompression message.
     """
-    protocol_version = 1
+    protocol_version = 2
 
-    def __init__(self, user, password, hostname=None, platform=None):
+    fields = (UInt8("protocol_version"),
+              FixedString("user", 64),
+              FixedString("password", 64),
+              FixedString("hostname", 64),
+              FixedString("platform", 8),
+              String("codec_data"))
+
+    def __init__(self, user, password, hostname=None, platform=None, codecs=None):
         self.user = user
         self.password = password
         self.hostname = hostname or socket.getfqdn()
         self.platform = platform or sublime.platform()
+        self.codecs = list(codecs or [])
 
     def __str__(self):
-        return "<Introduction user={0} host={1} platform={2} version={3}>".format(
-            self.user, self.hostname, self.platform, self.protocol_version)
+        return "<Introduction user={0} host={1} platform={2} version={3} codecs={4}>".format(
+            self.user, self.hostname, self.platform, self.protocol_version, self.codecs)
 
     @classmethod
     def msg_id(cls):
         return 0
 
-    @classmethod
-    def decode(cls, data):
-        _, version, user, password, hostname, platform = struct.unpack(">HB64s64s64s8s", data)
-
-        msg = IntroductionMessage(
-            user.decode("utf-8").rstrip("\000"),
-            password.decode("utf-8").rstrip("\000"),
-            hostname.decode("utf-8").rstrip("\000"),
-            platform.decode("utf-8").rstrip("\000"))
-        msg.protocol_version = version
-
-        return msg
+    @property
+    def codec_data(self):
+        """
+        The names of the codecs as they go on the wire, as a single comma
+        separated string.
+        """
+        return ",".join(self.codecs)
 
-    def encode(self):
-        return struct.pack(">IHB64s64s64s8s",
-            2 + 1 + 64 + 64 + 64 + 8,
-            IntroductionMessage.msg_id(),
-            self.protocol_version,
-            self.user.encode("utf-8"),
-            self.password.encode("utf-8"),
-            self.hostname.encode("utf-8"),
-            self.platform.encode("utf-8"))
+    @codec_data.setter
+    def codec_data(self, data):
+        self.codecs = data.split(",") if data else []
 
 ProtocolMessage.register(IntroductionMessage)
 
@@ -132,6 +658,8 @@ class MessageMessage(ProtocolMessage):
     This message is used to report generic message information to the remote
     end of the connection.
     """
+    fields = (String("msg"),)
+
     def __init__(self, msg):
         self.msg = msg
 
@@ -142,23 +670,6 @@ class MessageMessage(ProtocolMessage):
     def msg_id(cls):
         return 1
 
-    @classmethod
-    def decode(cls, data):
-        pre_len = struct.calcsize(">HI")
-        _, msg_len = struct.unpack(">HI", data[:pre_len])
-
-        msg_str, = struct.unpack_from(">%ds" % msg_len, data, pre_len)
-
-        return MessageMessage(msg_str.decode('utf-8'))
-
-    def encode(self):
-        msg_data = self.msg.encode("utf-8")
-        return struct.pack(">IHI%ds" % len(msg_data),
-            2 + 4 + len(msg_data),
-            MessageMessage.msg_id(),
-            len(msg_data),
-            msg_data)
-
 ProtocolMessage.register(MessageMessage)
 
 
@@ -167,6 +678,9 @@ class ErrorMessage(ProtocolMessage):
     This message is used to report an error to the remote end of the
     connection.
     """
+    fields = (UInt32("error_code"),
+              String("error_msg"))
+
     def __init__(self, error_code, error_msg):
         self.error_code = error_code
         self.error_msg = error_msg
@@ -179,24 +693,6 @@ class ErrorMessage(ProtocolMessage):
     def msg_id(cls):
         return 2
 
-    @classmethod
-    def decode(cls, data):
-        pre_len = struct.calcsize(">HII")
-        _, code, msg_len = struct.unpack(">HII", data[:pre_len])
-
-        msg_str, = struct.unpack_from(">%ds" % msg_len, data, pre_len)
-
-        return ErrorMessage(code, msg_str.decode('utf-8'))
-
-    def encode(self):
-        msg_data = self.error_msg.encode("utf-8")
-        return struct.pack(">IHII%ds" % len(msg_data),
-            2 + 4 + 4 + len(msg_data),
-            ErrorMessage.msg_id(),
-            self.error_code,
-            len(msg_data),
-            msg_data)
-
 ProtocolMessage.register(ErrorMessage)
 
 
@@ -204,9 +700,11 @@ class SetBuildMessage(ProtocolMessage):
     """
     This message is used to indicate to the remote server that we are preparing
     to execute a build. This gives the folders that are taking part in the
-    build as well as a unique build ID value (sha1 hash) that uniquely
-    represents the build.
+    build as well as a unique build ID value (a hash of the folder names) that
+    uniquely represents the build.
     """
+    fields = (String("folder_data"),)
+
     def __init__(self, build_id, folders):
         self.folders = folders
         self.build_id = build_id
@@ -221,36 +719,37 @@ class SetBuildMessage(ProtocolMessage):
         return 3
 
     @classmethod
-    def make_build_id(cls, folders):
+    def make_build_id(cls, folders, algorithm=None):
         folders = sorted(folders, key=lambda fn: (dirname(fn), basename(fn)))
-        sha1 = hashlib.sha1()
+        hasher = get_algorithm(algorithm).new()
         for folder in folders:
-            sha1.update(folder.encode('utf-8'))
+            hasher.update(folder.encode('utf-8'))
 
-        return sha1.hexdigest()
+        return binascii.hexlify(hasher.digest()).decode("ascii")
 
     @classmethod
-    def decode(cls, data):
-        pre_len = struct.calcsize(">HI")
-        _, msg_len = struct.unpack(">HI", data[:pre_len])
-
-        folder_data, = struct.unpack_from(">%ds" % msg_len, data, pre_len)
-        folders = folder_data.decode("utf-8").split("\x00")
+    def make_content_id(cls, manifest):
+        """
+        Return a fingerprint for the content of a build, given the Manifest of
+        the files in it. Unlike the build ID, which only covers the folder
+        names, this changes whenever any file in the build changes.
+        """
+        return binascii.hexlify(manifest.root_hash()).decode("ascii")
 
-        build_id = folders[0]
-        del folders[0]
+    @property
+    def folder_data(self):
+        """
+        The build ID and the folders as they go on the wire, as a single NUL
+        separated string.
+        """
+        return "\x00".join([self.build_id] + list(self.folders))
 
-        return SetBuildMessage(build_id, folders)
+    @folder_data.setter
+    def folder_data(self, data):
+        folders = data.split("\x00")
 
-    def encode(self):
-        data = "\x00".join([
-            f for sub in [[self.build_id], self.folders] for f in sub
-            ]).encode("utf-8")
-        return struct.pack(">IHI%ds" % len(data),
-            2 + 4 + len(data),
-            SetBuildMessage.msg_id(),
-            len(data),
-            data)
+        self.build_id = folders[0]
+        self.folders = folders[1:]
 
 ProtocolMessage.register(SetBuildMessage)
 
@@ -262,6 +761,9 @@ class AcknowledgeMessage(ProtocolMessage):
     Message, allowing the code to know the result of the message  without
     having to try and parse or otherwise understand the return text.
     """
+    fields = (UInt16("message_id"),
+              Bool("positive"))
+
     def __init__(self, message_id, positive=True):
         self.message_id = message_id
         self.positive = positive
@@ -274,68 +776,112 @@ class AcknowledgeMessage(ProtocolMessage):
     def msg_id(cls):
         return 4
 
-    @classmethod
-    def decode(cls, data):
-        _, message_id, positive = struct.unpack(">HH?", data)
-
-        return AcknowledgeMessage(message_id, positive)
-
-    def encode(self):
-        return struct.pack(">IHH?",
-            2 + 2 + 1,
-            AcknowledgeMessage.msg_id(),
-            self.message_id,
-            self.positive)
-
 ProtocolMessage.register(AcknowledgeMessage)
 
 
 class FileContentMessage(ProtocolMessage):
     """
     This message is used by both the client and the server to transmit file
-    contents around. In a better implementation this would be a partial message
-    which can be slowly spooled off of disk and transmitted, but for expediency
-    of Devember being almost over we're instead just allocating data for the
-    entire content of the file in one shot.
+    contents around.
+
+    The content is always binary; a received message holds it as a view of
+    the message data, and it's only decoded as text if text() is called.
+
+    The content can be provided directly (such as from the blob cache);
+    otherwise only the size of the file is looked up here and the content is
+    sent as a FileRegion, straight from the file to the socket, so that even
+    very large files never need to be held in memory.
+
+    A file can also be sent as a series of smaller frames (see frames()), so
+    that the other end doesn't need to hold all of it in memory either.
     """
-    def __init__(self, root_path, relative_name, read_file=True):
+    fields = (FixedString("root_path", 256),
+              FixedString("relative_name", 256),
+              Bytes("payload"))
+
+    def __init__(self, root_path, relative_name, read_file=True, file_content=None):
         self.root_path = root_path
         self.relative_name = relative_name
+        self.file_content = file_content
+        self.file_length = 0
 
-        if read_file:
-            with open(join(root_path, relative_name), "rb") as file:
-                self.file_content = file.read()
+        if file_content is not None:
+            self.file_length = len(file_content)
+        elif read_file:
+            self.file_length = os.path.getsize(join(root_path, relative_name))
 
     def __str__(self):
         return "<FileContent root='{0}' name='{1}' size={2}>".format(
-            self.root_path, self.relative_name, len(self.file_content))
+            self.root_path, self.relative_name, self.file_length)
 
     @classmethod
     def msg_id(cls):
         return 5
 
-    @classmethod
-    def decode(cls, data):
-        pre_len = struct.calcsize(">H256s256sI")
-        _, root, name, file_length = struct.unpack(">H256s256sI", data[:pre_len])
+    @property
+    def payload(self):
+        """
+        The content of the file as it goes on the wire; this is the content
+        itself if it was provided, or the region of the file to send it from.
+        """
+        if self.file_content is not None:
+            return self.file_content
 
-        msg = FileContentMessage(root.decode('utf-8').rstrip("\000"),
-                                 name.decode('utf-8').rstrip("\000"),
-                                 read_file=False)
-        content, = struct.unpack_from(">%ds" % file_length, data, pre_len)
+        return FileRegion(join(self.root_path, self.relative_name), 0, self.file_length)
 
-        msg.file_content = content.decode('utf-8')
+    @payload.setter
+    def payload(self, data):
+        self.file_content = data
+        self.file_length = len(data)
 
-        return msg
+    def text(self, encoding="utf-8", errors="replace"):
+        """
+        Return the content of the file decoded as text. Content is binary (and
+        for a received message, a view of the message data) until this is
+        called, since files such as images are not text at all.
+        """
+        if self.file_content is None:
+            with open(join(self.root_path, self.relative_name), "rb") as file:
+                return file.read().decode(encoding, errors)
 
-    def encode(self):
-        return struct.pack(">IH256s256sI%ds" % len(self.file_content),
-            2 + 256 + 256 + 4 + len(self.file_content),
-            FileContentMessage.msg_id(),
-            self.root_path.encode('utf-8'),
-            self.relative_name.encode('utf-8'),
-            len(self.file_content),
-            self.file_content)
+        return str(self.file_content, encoding, errors)
+
+    def write_to(self, filename):
+        """
+        Write the content of the file to the given file, straight from the
+        buffer that holds it.
+        """
+        os.makedirs(dirname(filename), exist_ok=True)
+        if self.file_content is None:
+            return shutil.copyfile(join(self.root_path, self.relative_name), filename)
+
+        with open(filename, "wb") as file:
+            file.write(self.file_content)
+
+    def frames(self, frame_size):
+        """
+        Return an iterator over the messages that send this file as a spooled
+        series of frames: a FileStart, then FileData messages carrying at most
+        frame_size bytes of the content each, and a FileEnd. The frames are
+        created lazily as the iterator is consumed, so their content is only
+        read (or viewed, for content that is already in memory) as the
+        connection gets around to sending it.
+        """
+        yield FileStartMessage(self.root_path, self.relative_name, self.file_length)
+
+        filename = join(self.root_path, self.relative_name)
+        content = self.file_content
+        if content is not None:
+            content = memoryview(content)
+
+        for offset in range(0, self.file_length, frame_size):
+            length = min(frame_size, self.file_length - offset)
+            if content is not None:
+                yield FileDataMessage(content[offset:offset + length])
+            else:
+                yield FileDataMessage(FileRegion(filename, offset, length))
+
+        yield FileEndMessage(self.root_path, self.relative_name)
 
 ProtocolMessage.register(FileContentMessage)
 
@@ -346,6 +892,8 @@ class ExecuteBuildMessage(ProtocolMessage):
     build. The build always happens in the first folder that was sent to the
     server, and requires that the files already be sent there.
     """
+    fields = (String("shell_cmd"),)
+
     def __init__(self, shell_cmd):
         self.shell_cmd = shell_cmd
 
@@ -356,23 +904,6 @@ class ExecuteBuildMessage(ProtocolMessage):
     def msg_id(cls):
         return 6
 
-    @classmethod
-    def decode(cls, data):
-        pre_len = struct.calcsize(">HI")
-        _, msg_len = struct.unpack(">HI", data[:pre_len])
-
-        msg_str, = struct.unpack_from(">%ds" % msg_len, data, pre_len)
-
-        return ExecuteBuildMessage(msg_str.decode('utf-8'))
-
-    def encode(self):
-        msg_data = self.shell_cmd.encode("utf-8")
-        return struct.pack(">IHI%ds" % len(msg_data),
-            2 + 4 + len(msg_data),
-            ExecuteBuildMessage.msg_id(),
-            len(msg_data),
-            msg_data)
-
 ProtocolMessage.register(ExecuteBuildMessage)
 
 
@@ -381,6 +912,9 @@ class BuildOutputMessage(ProtocolMessage):
     This messages is used by the server to transmit information to us on the
     output of a running build.
     """
+    fields = (Bool("stdout"),
+              String("msg"))
+
     def __init__(self, msg, stdout):
         self.msg = msg
         self.stdout = stdout
@@ -393,24 +927,6 @@ class BuildOutputMessage(ProtocolMessage):
     def msg_id(cls):
         return 7
 
-    @classmethod
-    def decode(cls, data):
-        pre_len = struct.calcsize(">H?I")
-        _, is_stdout, msg_len = struct.unpack(">H?I", data[:pre_len])
-
-        msg_str, = struct.unpack_from(">%ds" % msg_len, data, pre_len)
-
-        return BuildOutputMessage(msg_str.decode('utf-8'), is_stdout)
-
-    def encode(self):
-        msg_data = self.msg.encode("utf-8")
-        return struct.pack(">IH?I%ds" % len(msg_data),
-            2 + 1 + 4 + len(msg_data),
-            BuildOutputMessage.msg_id(),
-            self.stdout,
-            len(msg_data),
-            msg_data)
-
 ProtocolMessage.register(BuildOutputMessage)
 
 
@@ -419,6 +935,8 @@ class BuildCompleteMessage(ProtocolMessage):
     This message is used by the server to transmit the information that the
     build has completed and what the exit code was.
     """
+    fields = (UInt16("exit_code"),)
+
     def __init__(self, exit_code):
         self.exit_code = exit_code
 
@@ -429,16 +947,334 @@ class BuildCompleteMessage(ProtocolMessage):
     def msg_id(cls):
         return 8
 
+ProtocolMessage.register(BuildCompleteMessage)
+
+
+class FileChunkListMessage(ProtocolMessage):
+    """
+    This message is used by the client in place of a FileContent message for
+    large files. Rather than the content of the file, it carries the digest
+    and length of each of the content defined chunks that make up the file.
+    The server rebuilds the file from the chunks that it already has in its
+    copy of the file, and sends a ChunkRequest for any that it doesn't.
+    """
+    fields = (FixedString("root_path", 256),
+              FixedString("relative_name", 256),
+              UInt64("file_length"),
+              List("chunks", "20sI"))
+
+    def __init__(self, root_path, relative_name, chunks):
+        self.root_path = root_path
+        self.relative_name = relative_name
+        self.chunks = chunks
+        self.file_length = sum(length for _, length in chunks)
+
+    def __str__(self):
+        return "<FileChunkList root='{0}' name='{1}' size={2} chunks={3}>".format(
+            self.root_path, self.relative_name, self.file_length, len(self.chunks))
+
+    @classmethod
+    def msg_id(cls):
+        return 9
+
+ProtocolMessage.register(FileChunkListMessage)
+
+
+class ChunkRequestMessage(ProtocolMessage):
+    """
+    This message is used by the server in response to a FileChunkList, to ask
+    for the chunks of the file that it could not find in its existing copy.
+    The chunks are given as indexes into the chunk list.
+    """
+    fields = (FixedString("root_path", 256),
+              FixedString("relative_name", 256),
+              List("indices", "I"))
+
+    def __init__(self, root_path, relative_name, indices):
+        self.root_path = root_path
+        self.relative_name = relative_name
+        self.indices = indices
+
+    def __str__(self):
+        return "<ChunkRequest root='{0}' name='{1}' chunks={2}>".format(
+            self.root_path, self.relative_name, len(self.indices))
+
+    @classmethod
+    def msg_id(cls):
+        return 10
+
+ProtocolMessage.register(ChunkRequestMessage)
+
+
+class FileChunksMessage(ProtocolMessage):
+    """
+    This message is used by the client to answer a ChunkRequest; it carries
+    the index and the data of every chunk that the server asked for. Once the
+    server has rebuilt the file, it acknowledges it as a FileContent.
+
+    The data of a chunk can be a FileRegion, in which case it is sent straight
+    from the file. The chunks don't fit a schema of fields, so this message
+    is encoded by hand.
+    """
+    _header = struct.Struct(">IH256s256sI")
+    _decode_header = struct.Struct(">H256s256sI")
+    _entry = struct.Struct(">II")
+
+    def __init__(self, root_path, relative_name, chunks):
+        self.root_path = root_path
+        self.relative_name = relative_name
+        self.chunks = chunks
+
+    def __str__(self):
+        return "<FileChunks root='{0}' name='{1}' chunks={2} size={3}>".format(
+            self.root_path, self.relative_name, len(self.chunks),
+            sum(len(data) for _, data in self.chunks))
+
+    @classmethod
+    def msg_id(cls):
+        return 11
+
     @classmethod
     def decode(cls, data):
-        _, code = struct.unpack(">HH", data)
+        _, root, name, count = cls._decode_header.unpack_from(data)
+
+        chunks = []
+        offset = cls._decode_header.size
+        for _ in range(count):
+            index, length = cls._entry.unpack_from(data, offset)
+            offset += cls._entry.size
+            chunks.append((index, data[offset:offset + length]))
+            offset += length
+
+        return FileChunksMessage(root.decode('utf-8').rstrip("\000"),
+                                 name.decode('utf-8').rstrip("\000"),
+                                 chunks)
+
+    def encode_parts(self):
+        parts = [None]
+        total = 0
+        for index, data in self.chunks:
+            parts.append(self._entry.pack(index, len(data)))
+            parts.append(data)
+            total += self._entry.size + len(data)
+
+        parts[0] = self._header.pack(
+            self._header.size - 4 + total,
+            FileChunksMessage.msg_id(),
+            self.root_path.encode('utf-8'),
+            self.relative_name.encode('utf-8'),
+            len(self.chunks))
 
-        return BuildCompleteMessage(code)
+        return parts
 
     def encode(self):
-        return struct.pack(">IHH",
-            2 + 2,
-            BuildCompleteMessage.msg_id(),
-            self.exit_code)
+        return join_parts(self.encode_parts())
 
-ProtocolMessage.register(BuildCompleteMessage)
+ProtocolMessage.register(FileChunksMessage)
+
+
+class CopyFileMessage(ProtocolMessage):
+    """
+    This message is used by the client in place of a FileContent message for
+    a file whose content is identical to one that was already sent in this
+    build (such as the same vendored file under several build folders). The
+    server makes a copy of its copy of the source file at the destination,
+    and acknowledges it as if the file content had been sent.
+    """
+    fields = (FixedString("source_root", 256),
+              FixedString("source_name", 256),
+              FixedString("root_path", 256),
+              FixedString("relative_name", 256))
+
+    def __init__(self, source_root, source_name, root_path, relative_name):
+        self.source_root = source_root
+        self.source_name = source_name
+        self.root_path = root_path
+        self.relative_name = relative_name
+
+    def __str__(self):
+        return "<CopyFile source='{0}' name='{1}' root='{2}' name='{3}'>".format(
+            self.source_root, self.source_name, self.root_path, self.relative_name)
+
+    @classmethod
+    def msg_id(cls):
+        return 12
+
+ProtocolMessage.register(CopyFileMessage)
+
+
+class FileStartMessage(ProtocolMessage):
+    """
+    This message is used by the client to start sending a file that is too
+    large to be sent in a single FileContent message; the content follows in
+    FileData messages and ends with a FileEnd. Only one file is ever being
+    spooled in this way at a time.
+    """
+    fields = (FixedString("root_path", 256),
+              FixedString("relative_name", 256),
+              UInt64("file_length"))
+
+    def __init__(self, root_path, relative_name, file_length):
+        self.root_path = root_path
+        self.relative_name = relative_name
+        self.file_length = file_length
+
+    def __str__(self):
+        return "<FileStart root='{0}' name='{1}' size={2}>".format(
+            self.root_path, self.relative_name, self.file_length)
+
+    @classmethod
+    def msg_id(cls):
+        return 13
+
+ProtocolMessage.register(FileStartMessage)
+
+
+class FileDataMessage(ProtocolMessage):
+    """
+    This message carries the next part of the content of the file that is
+    currently being spooled to the server; the data can be a FileRegion, in
+    which case it is sent straight from the file.
+    """
+    fields = (Bytes("data"),)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return "<FileData size={0}>".format(len(self.data))
+
+    @classmethod
+    def msg_id(cls):
+        return 14
+
+ProtocolMessage.register(FileDataMessage)
+
+
+class FileEndMessage(ProtocolMessage):
+    """
+    This message is used by the client to say that all of the content of the
+    file that it is spooling has been sent. The server acknowledges it as a
+    FileContent, the same as for a file that was sent whole.
+    """
+    fields = (FixedString("root_path", 256),
+              FixedString("relative_name", 256))
+
+    def __init__(self, root_path, relative_name):
+        self.root_path = root_path
+        self.relative_name = relative_name
+
+    def __str__(self):
+        return "<FileEnd root='{0}' name='{1}'>".format(
+            self.root_path, self.relative_name)
+
+    @classmethod
+    def msg_id(cls):
+        return 15
+
+ProtocolMessage.register(FileEndMessage)
+
+
+class CompressedMessage(ProtocolMessage):
+    """
+    This message carries another message, compressed with the codec that the
+    server picked when we introduced ourselves. For a message with data that
+    is sent as parts of its own (the content of a file, or the chunks of one)
+    only that data is compressed, and the fixed part of the message before it
+    goes as is in the header. That keeps the compressed content of a file the
+    same no matter where the file is going, so it can be cached on the digest
+    of the file. Other messages are compressed whole.
+
+    Decoding this message returns the message that it carries, so nothing
+    past the network layer ever sees one of these. The carried message can't
+    be larger than max_length (which the server enforces as well), so that a
+    bogus length can't make the other end allocate any amount of memory; the
+    carried message can't be another Compressed message either.
+    """
+    max_length = 16 * 1024 * 1024
+
+    fields = (String("codec"),
+              UInt32("length"),
+              Bytes("header"),
+              Bytes("body"))
+
+    def __init__(self, codec, length, header, body):
+        self.codec = codec
+        self.length = length
+        self.header = header
+        self.body = body
+
+    def __str__(self):
+        return "<Compressed codec='{0}' size={1} compressed={2}>".format(
+            self.codec, self.length, len(self.header) + len(self.body))
+
+    @classmethod
+    def msg_id(cls):
+        return 16
+
+    @classmethod
+    def wrap(cls, codec, msg, body=None):
+        """
+        Return a message that sends the given message compressed with the
+        named codec, or the message itself if compressing it doesn't make it
+        any smaller. If the data after the header has already been compressed
+        (such as file content from a cache), it can be given as body.
+        """
+        parts = msg.encode_parts()
+        if len(parts) > 1:
+            header = bytes(memoryview(parts[0])[4:])
+            tail = parts[1:]
+        else:
+            header = b""
+            tail = [memoryview(parts[0])[4:]]
+
+        length = sum(len(part) for part in tail)
+        if len(header) + length > cls.max_length:
+            return msg
+
+        if body is None:
+            body = compress(codec, join_parts(tail))
+
+        if len(body) >= length:
+            return msg
+
+        return cls(codec, len(header) + length, header, body)
+
+    @classmethod
+    def decode(cls, data):
+        wrapper = super().decode(data)
+        if not len(wrapper.header) <= wrapper.length <= cls.max_length:
+            raise ValueError('Compressed message length is invalid')
+
+        data = bytes(wrapper.header) + decompress(wrapper.codec, wrapper.body,
+                                                  wrapper.length - len(wrapper.header))
+        if len(data) != wrapper.length:
+            raise ValueError('Compressed message length is invalid')
+
+        if len(data) >= 2 and struct.unpack_from(">H", data)[0] == cls.msg_id():
+            raise ValueError('Compressed message carries a compressed message')
+
+        return ProtocolMessage.from_data(data)
+
+ProtocolMessage.register(CompressedMessage)
+
+
+class SetCompressionMessage(ProtocolMessage):
+    """
+    This message is used by the server in response to our introduction, to
+    tell us which of the compression codecs that we offered it picked. An
+    empty codec means that nothing is to be compressed.
+    """
+    fields = (String("codec"),)
+
+    def __init__(self, codec):
+        self.codec = codec
+
+    def __str__(self):
+        return "<SetCompression codec='{0}'>".format(self.codec)
+
+    @classmethod
+    def msg_id(cls):
+        return 17
+
+ProtocolMessage.register(SetCompressionMessage)
@@ -2,6 +2,7 @@ import sublime
 import sublime_plugin
 
 from threading import Thread, Event, Lock
+from itertools import chain
 import queue
 import inspect
 import struct
@@ -11,7 +12,7 @@ import os
 import time
 import textwrap
 
-from .messages import ProtocolMessage
+from .messages import ProtocolMessage, FileRegion
 
 
 ### ---------------------------------------------------------------------------
@@ -253,6 +254,7 @@ class Connection():
         self.socket = socket
         self.connected = False
 
+        self.send_parts = None
         self.send_data = None
         self.receive_data = bytearray()
         self.expected_length = None
@@ -287,9 +289,21 @@ class Connection():
         Queue the provided protocol message up for sending to the other end of
         the connection.
 
-        This would go into the input queue.
+        This would go into the input queue. The message goes in as the list of
+        its encoded parts, so that file content can be sent straight from the
+        file by the network thread instead of being read into memory here.
         """
-        self.send_queue.put(protocolMsgInstance.encode())
+        self.send_queue.put(iter(protocolMsgInstance.encode_parts()))
+
+    def send_all(self, messages):
+        """
+        Queue all of the messages from the provided iterable up for sending,
+        one after the other. The iterable is only consumed as the network
+        thread gets around to sending each message, so a generator can be used
+        to create messages (such as the frames of a large file) lazily.
+        """
+        self.send_queue.put(chain.from_iterable(
+            msg.encode_parts() for msg in messages))
 
     def receive(self):
         """
@@ -312,8 +326,20 @@ class Connection():
         graceful goodbye message or something.
         """
         self.manager._remove(self)
+        self._discard_send_data()
         self._raise(Notification.CLOSED)
 
+    def _discard_send_data(self):
+        """
+        Throw away the partially sent message, if any, closing any file that
+        it was being sent from.
+        """
+        if isinstance(self.send_data, FileRegion):
+            self.send_data.close()
+
+        self.send_parts = None
+        self.send_data = None
+
 
 
     def fileno(self):
@@ -350,7 +376,7 @@ class Connection():
         if self.socket:
             return (not self.connected or
                     self.send_queue.qsize() > 0 or
-                    self.send_data is not None)
+                    self.send_parts is not None)
 
         return False
 
@@ -385,18 +411,37 @@ class Connection():
                 self.close()
                 return
 
+        # send_parts is an iterator over the parts of the message being sent,
+        # and send_data is the part currently being sent. A partially sent
+        # part is replaced by a view of what is left of it (a file region
+        # tracks its own offset instead), so nothing is copied; parts are only
+        # taken from the iterator once the previous one is gone, which bounds
+        # what is held in memory no matter how large the message is.
         try:
             for _ in range(10):
-                if self.send_data is None:
-                    self.send_data = self.send_queue.get_nowait()
-
-                sent = self.socket.send(self.send_data)
-                # sent = self.socket.send(self.send_data[:1])
-                self.send_data = self.send_data[sent:]
-                if not self.send_data:
-                    self.send_data = None
+                while self.send_data is None:
+                    if self.send_parts is None:
+                        self.send_parts = self.send_queue.get_nowait()
+
+                    self.send_data = next(self.send_parts, None)
+                    if self.send_data is None:
+                        self.send_parts = None
+
+                part = self.send_data
+                if isinstance(part, FileRegion):
+                    # A region is sent for as long as the socket takes it;
+                    # when it's full, send_to() raises BlockingIOError.
+                    if part.remaining:
+                        part.send_to(self.socket)
+                        continue
                 else:
-                    break
+                    sent = self.socket.send(part)
+                    # sent = self.socket.send(part[:1])
+                    if sent < len(part):
+                        self.send_data = memoryview(part)[sent:]
+                        break
+
+                self.send_data = None
 
         except queue.Empty:
             pass
@@ -430,13 +475,16 @@ class Connection():
                 if self.expected_length is None:
                     if len(self.receive_data) >= 4:
                         self.expected_length, = struct.unpack_from(">I", self.receive_data)
-                        self.receive_data = self.receive_data[4:]
+                        del self.receive_data[:4]
                     else:
                         break
 
                 if len(self.receive_data) >= self.expected_length:
+                    # The slice is a copy that belongs to the message, since
+                    # the decoded message may hold views of it (such as the
+                    # content of a file).
                     msg_data = self.receive_data[:self.expected_length]
-                    self.receive_data = self.receive_data[self.expected_length:]
+                    del self.receive_data[:self.expected_length]
                     self.expected_length = None
 
                     self.recv_queue.put(ProtocolMessage.from_data(msg_data))
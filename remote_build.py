@@ -1,7 +1,8 @@
 import sublime
 import sublime_plugin
 
-from threading import Thread
+from threading import Thread, Lock, Condition
+from collections import deque
 from queue import Queue
 
 import textwrap
@@ -14,10 +15,18 @@ from .messages import MessageMessage, ErrorMessage
 from .messages import SetBuildMessage, AcknowledgeMessage
 from .messages import FileContentMessage, ExecuteBuildMessage
 from .messages import BuildOutputMessage, BuildCompleteMessage
+from .messages import FileChunkListMessage, ChunkRequestMessage
+from .messages import FileChunksMessage, CopyFileMessage, FileRegion
+from .messages import FileDataMessage, CompressedMessage, SetCompressionMessage
+from .messages import join_parts
 
 from .network import ConnectionManager, Notification, log
 
-from .file_gather import find_project_files
+from .file_gather import iter_project_files, project_roots
+from .file_watcher import watch_project_files
+from .manifest_store import get_manifest_store, StoredManifest
+from .blob_cache import get_blob_cache
+from .compression import supported_codecs, compress
 
 
 ### ---------------------------------------------------------------------------
@@ -26,6 +35,16 @@ from .file_gather import find_project_files
 # Our global connection manager object
 netManager = None
 
+# The most files that are queued to be sent at once; the gather waits for the
+# queue to drain before it adds more, so the files of a huge project are not
+# all held in memory while they're sent.
+_QUEUE_LIMIT = 10000
+
+# The most distinct digests that are remembered in a build to find files with
+# the same content (see copy_source()); past this, duplicate files are just
+# sent again.
+_SOURCE_LIMIT = 100000
+
 
 ### ---------------------------------------------------------------------------
 
@@ -41,7 +60,14 @@ def plugin_loaded():
 
     rb_setting.obj = sublime.load_settings("RemoteBuild.sublime-settings")
     rb_setting.default = {
-        "build_hosts": []
+        "build_hosts": [],
+        "watch_project_files": False,
+        "delta_transfer_threshold": 131072,
+        "digest_algorithm": "sha1",
+        "manifest_store": False,
+        "send_buffer_size": 262144,
+        "compression_codecs": ["deflate-6", "deflate-1", "deflate-9"],
+        "compression_threshold": 1024
     }
 
 
@@ -136,6 +162,17 @@ class RemoteBuildCommand(sublime_plugin.WindowCommand):
     def __init__(self, window):
         super().__init__(window)
         self.connection = None
+        self.codec = None
+
+        # Guards the state of the build in progress (the proj_ attributes)
+        # against the thread that gathers the files for it. This is created
+        # once, so that a gather thread for an older build always holds the
+        # same lock as the build that replaces it. proj_ready is signalled
+        # whenever a file leaves the queue of files to send, or the build
+        # changes.
+        self.proj_lock = Lock()
+        self.proj_ready = Condition(self.proj_lock)
+        self.proj_build = None
 
     def run(self, **kwargs):
         self.build_args = kwargs
@@ -143,8 +180,7 @@ class RemoteBuildCommand(sublime_plugin.WindowCommand):
         # Assume we want to build the `test_project` contained in our package.
         self.build_args["folders"] = [
             {
-                "path": os.path.join(sublime.packages_path(), "devember_2018", "test_project"),
-                "folder_exclude_patterns": ["bin", "obj"]
+                "path": os.path.join(sublime.packages_path(), "devember_2018", "test_project")
             }
         ]
 
@@ -157,7 +193,9 @@ class RemoteBuildCommand(sublime_plugin.WindowCommand):
         if self.connection is None or self.connection.connected == False:
             if all (k in kwargs for k in ("host", "port", "username", "password")):
                 self.connection = netManager.connect(kwargs["host"], kwargs["port"], lambda c,n: self.result(c,n))
-                self.connection.send(IntroductionMessage(kwargs["username"], kwargs["password"]))
+                self.codec = None
+                self.connection.send(IntroductionMessage(kwargs["username"], kwargs["password"],
+                    codecs=supported_codecs(rb_setting("compression_codecs"))))
                 return
 
             else:
@@ -168,35 +206,230 @@ class RemoteBuildCommand(sublime_plugin.WindowCommand):
 
     def start_build(self):
         """
-        Kick off a build by capturing the list of project folders and files
-        and announcing it to the server.
+        Kick off a build by announcing the list of project folders to the
+        server, while the files in them are gathered in the background.
         """
-        self.proj_info = find_project_files(self.window, folders=self.build_args["folders"])
-        self.proj_roots = list(self.proj_info.keys())
-        self.proj_id = SetBuildMessage.make_build_id(self.proj_roots)
-
-        # Make a big list of all files that need to be transferred. This is
-        # a list of lists that contains the root and the relative name. As
-        # we transmit files to the server, they're removed from this list.
-        # We know the build is ready to execute when the last file is done.
-        self.proj_files = []
-        for root in self.proj_roots:
-            for file in self.proj_info[root]:
-                self.proj_files.append([root, file])
-
-        # Set up to track the percentage of files transmitted (count, not
-        # bytes overall).
-        if self.proj_files:
-            self.proj_pct = 0
-            self.proj_step = (1.0 / len(self.proj_files)) * 100.0
+        algorithm = self.digest_algorithm()
+        roots = project_roots(self.window, folders=self.build_args["folders"])
+
+        # The list of files that need to be transferred, as lists that contain
+        # the root, the relative name, the digest (which finds the content of
+        # the file in the blob cache, if it was put there while the file was
+        # being hashed), the (root, name) of an earlier file with the same
+        # content, or None, and the chunks of large files (which are found
+        # while gathering, so that they are never calculated here on the main
+        # thread), or None. Files are added by the gather thread
+        # as they're found and removed as we transmit them to the server. We
+        # know the build is ready to execute when the gather is done and the
+        # last file has been sent.
+        #
+        # All of this is replaced with the lock held, so a gather thread for
+        # an older build either finishes adding its file before the reset or
+        # sees that its build is no longer current afterwards.
+        with self.proj_lock:
+            self.proj_build = object()
+            self.proj_algorithm = algorithm
+            self.proj_roots = roots
+            self.proj_id = SetBuildMessage.make_build_id(roots, algorithm)
+            self.proj_files = deque()
+            self.proj_sources = {}
+            self.proj_found = 0
+            self.proj_sent = 0
+            self.proj_done = False
+            self.proj_waiting = False
+
+            # The chunks of the file that was most recently sent as a chunk
+            # list, so that we know where to find them when the server
+            # requests some.
+            self.proj_chunks = None
+
+            build = self.proj_build
+            self.proj_ready.notify_all()
+
+        if rb_setting("watch_project_files"):
+            gather = self.watched_files()
+        elif rb_setting("manifest_store"):
+            gather = self.stored_files(self.proj_id, algorithm)
+        else:
+            gather = iter_project_files(self.window, folders=self.build_args["folders"],
+                                        algorithm=algorithm,
+                                        chunk_threshold=rb_setting("delta_transfer_threshold"))
+
+        Thread(target=self.gather_files, args=(gather, build)).start()
 
         # Send off the message to start the build now.
         self.connection.send(SetBuildMessage(self.proj_id, self.proj_roots))
 
+    def digest_algorithm(self):
+        """
+        Return the name of the digest algorithm that the files in the build
+        are hashed with. A project can select its own algorithm with a
+        "digest_algorithm" key in a "remote_build" dictionary in its project
+        data; otherwise the global setting is used.
+        """
+        data = self.window.project_data() or {}
+        algorithm = data.get("remote_build", {}).get("digest_algorithm")
+
+        return algorithm or rb_setting("digest_algorithm")
+
+    def stored_files(self, proj_id, algorithm):
+        """
+        Yield the files in the build in the same way as iter_project_files(),
+        gathering them into the manifest store rather than into memory. This
+        is a generator, so all of the work happens in the gather thread.
+
+        The files are gathered into a temporary manifest, which is compared
+        against the manifest of the last build of the project before it is
+        given its place (see gather_files()); a gather that doesn't finish
+        drops its manifest, leaving the last one as it was.
+        """
+        try:
+            store = get_manifest_store()
+            manifest = store.create_temporary(proj_id, algorithm)
+        except RuntimeError as err:
+            log("Manifest store unavailable; gathering in memory: {0}", err)
+            store = manifest = None
+
+        try:
+            for root, name, info in iter_project_files(
+                    self.window, folders=self.build_args["folders"],
+                    algorithm=algorithm, manifest=manifest,
+                    chunk_threshold=rb_setting("delta_transfer_threshold")):
+                if name is None and manifest is not None:
+                    self.log_changes(manifest, store.open(proj_id))
+
+                yield root, name, info
+
+        finally:
+            if manifest is not None and manifest.name != proj_id:
+                store.drop(manifest.name)
+
+    def log_changes(self, manifest, previous):
+        """
+        Log how the given stored manifest differs from the given previous one
+        (if there is one); each folder is compared by the database.
+        """
+        if previous is None or previous.algorithm != manifest.algorithm:
+            return
+
+        added = removed = modified = 0
+        for root in manifest:
+            if root in previous:
+                only_ours, only_theirs, changed = manifest[root].diff(previous[root])
+                added += len(only_ours)
+                removed += len(only_theirs)
+                modified += len(changed)
+            else:
+                added += len(manifest[root])
+
+        for root in previous:
+            if root not in manifest:
+                removed += len(previous[root])
+
+        log("Gather: {0} added, {1} removed, {2} modified since the last build",
+            added, removed, modified, panel=True)
+
+    def watched_files(self):
+        """
+        Yield the files in the build in the same way as iter_project_files(),
+        from the manifest that is kept up to date by a watcher. This is a
+        generator so that the first scan of the watched folders (and the
+        refresh of any changes after that) happens in the gather thread.
+        """
+        files = watch_project_files(self.window, folders=self.build_args["folders"],
+                                    algorithm=self.proj_algorithm,
+                                    chunk_threshold=rb_setting("delta_transfer_threshold"))
+        for root in files:
+            for name in files[root]:
+                yield root, name, files[root][name]
+
+        yield None, None, files
+
+    def gather_files(self, gather, build):
+        """
+        Runs in a background thread to collect the files that are a part of
+        the build, making them available to send as soon as each is found.
+        If another build starts before the gather is finished, this one stops
+        without touching the state of the new build.
+
+        A stored manifest takes the place of the one from the last build of
+        the project only here, with the lock held and only if the build is
+        still current, so that an older gather can never replace the manifest
+        of a newer one.
+        """
+        retired = None
+        try:
+            for root, name, info in gather:
+                with self.proj_lock:
+                    while self.proj_build is build and len(self.proj_files) >= _QUEUE_LIMIT:
+                        self.proj_ready.wait()
+
+                    if self.proj_build is not build:
+                        break
+
+                    if name is None:
+                        self.proj_info = info
+                        self.proj_content_id = SetBuildMessage.make_content_id(info)
+                        self.proj_done = True
+                        if isinstance(info, StoredManifest):
+                            retired = info.store.swap(self.proj_id, info)
+                    else:
+                        self.proj_files.append([root, name, info.digest,
+                                                self.copy_source(root, name, info.digest),
+                                                info.chunks])
+                        self.proj_found += 1
+
+                    waiting, self.proj_waiting = self.proj_waiting, False
+
+                # If all files found so far have been sent, the last ack could
+                # not send anything, so kick off the next send now.
+                if waiting:
+                    sublime.set_timeout(lambda: self.send_next_file())
+
+        except Exception as err:
+            log("Error gathering build files: {0}", err, panel=True)
+            with self.proj_lock:
+                if self.proj_build is build:
+                    self.proj_content_id = ""
+                    self.proj_done = True
+
+        finally:
+            if hasattr(gather, "close"):
+                gather.close()
+
+        # The manifest of the last build is dropped outside of the lock, since
+        # that can take a while.
+        if retired is not None:
+            get_manifest_store().drop(retired)
+
+    def copy_source(self, root, name, digest):
+        """
+        Return the (root, name) of the first file in the build that has the
+        given digest, or None if this is that file; identical files are only
+        sent once, and the server copies them to every other location. This
+        must be called with the project lock held.
+        """
+        if digest is None:
+            return None
+
+        source = self.proj_sources.get(digest)
+        if source is None:
+            if len(self.proj_sources) < _SOURCE_LIMIT:
+                self.proj_sources[digest] = (root, name)
+            return None
+
+        return None if source == (root, name) else source
+
     def acknowledge(self, msg_id, ack):
-        # For now, we don't do anything in response to a NACK message; only
-        # ACK.
+        # The only NACK that we do anything about is for a file that we sent as
+        # a chunk list, which the server couldn't rebuild from the chunks
+        # (such as when the file changed while it was being sent); the server
+        # wants the whole file instead.
         if not ack:
+            if msg_id == FileContentMessage.msg_id() and self.proj_chunks is not None:
+                root, name, _ = self.proj_chunks
+                self.proj_chunks = None
+                self.send_file(root, name, None, None, self.proj_found)
             return
 
         # On ack of the introduction message, start the build; we logged in
@@ -209,28 +442,202 @@ class RemoteBuildCommand(sublime_plugin.WindowCommand):
             self.send_next_file()
 
     def send_next_file(self):
-        if self.proj_files:
-            file_info = self.proj_files.pop()
-            file_msg = FileContentMessage(file_info[0], file_info[1])
-
-            # Count this as a new step percentage; ensure that the last file
-            # is always the 100% file.
-            if self.proj_files:
-                self.proj_pct += self.proj_step
-            else:
-                self.proj_pct = 100
+        with self.proj_lock:
+            file_info = self.proj_files.popleft() if self.proj_files else None
+            found = self.proj_found
+            self.proj_ready.notify()
+
+            # If there's nothing to send yet but the gather is still running,
+            # the gather thread will call us back when the next file is found.
+            if file_info is None and not self.proj_done:
+                self.proj_waiting = True
+                return
 
-            log("Sending: [{3:3.0f}%] {0}/{1} ({2} bytes)",
-                os.path.basename(os.path.normpath(file_msg.root_path)),
-                file_msg.relative_name,
-                len(file_msg.file_content),
-                self.proj_pct,
-                panel=True)
+        if file_info is not None:
+            self.proj_sent += 1
+            root, name, digest, source, chunks = file_info
+
+            # Use the content that was read while hashing the file, if it is
+            # still around; otherwise it has to be read again.
+            content = None
+            if digest is not None:
+                content = get_blob_cache().get(self.proj_algorithm, digest)
+
+            size = len(content) if content is not None else os.path.getsize(os.path.join(root, name))
+
+            # A file with the same content as one that was already sent is
+            # copied by the server, unless it's small enough that sending the
+            # content is no bigger than asking for the copy.
+            if source is not None:
+                copy_msg = CopyFileMessage(source[0], source[1], root, name)
+                if size > len(copy_msg.encode()):
+                    log("Sending: [{2}/{3}] {0}/{1} (copy of {4})",
+                        os.path.basename(os.path.normpath(root)), name,
+                        self.proj_sent, found, source[1], panel=True)
+
+                    return self.connection.send(copy_msg)
+
+            # Large files are sent as a list of chunks, so that if the server
+            # has an older copy only the chunks that changed are transmitted;
+            # the chunks are found while gathering, so a file that was not
+            # chunked then or has changed size since is just sent whole.
+            threshold = rb_setting("delta_transfer_threshold")
+            if threshold and size >= threshold and chunks and sum(chunks[-1][:2]) == size:
+                return self.send_chunk_list(root, name, chunks, found)
+
+            return self.send_file(root, name, content, digest, found)
+
+        log("Receive: All files transmitted (content {0}), starting build",
+            self.proj_content_id[:12], panel=True)
+        self.connection.send(ExecuteBuildMessage(self.build_args["shell_cmd"]))
 
-            return self.connection.send(file_msg)
+    def send_file(self, root, name, content, digest, found):
+        """
+        Send the whole of the given file; content is the content of the file
+        if it's already in memory, or None to send it from the file.
+        """
+        file_msg = FileContentMessage(root, name, file_content=content)
+
+        log("Sending: [{3}/{4}] {0}/{1} ({2} bytes)",
+            os.path.basename(os.path.normpath(file_msg.root_path)),
+            file_msg.relative_name,
+            file_msg.file_length,
+            self.proj_sent,
+            found,
+            panel=True)
+
+        # Files too large for a single frame are spooled to the server a
+        # frame at a time, so neither end holds all of it in memory; each
+        # frame of content is compressed on its own.
+        frame_size = rb_setting("send_buffer_size")
+        if frame_size and file_msg.file_length > frame_size:
+            return self.connection.send_all(self.file_frames(file_msg, frame_size))
+
+        # Files big enough to be worth it are compressed, if the server
+        # picked a codec when we introduced ourselves.
+        if self.should_compress(file_msg.file_length):
+            return self.connection.send(self.compress_file(file_msg, digest))
+
+        return self.connection.send(file_msg)
+
+    def should_compress(self, size):
+        """
+        Return True if a message carrying the given number of bytes of data is
+        big enough to be worth compressing, if the server picked a codec when
+        we introduced ourselves.
+        """
+        threshold = rb_setting("compression_threshold")
+        return self.codec is not None and bool(threshold) and size >= threshold
 
-        log("Receive: All files transmitted, starting build", panel=True)
-        self.connection.send(ExecuteBuildMessage(self.build_args["shell_cmd"]))
+    def compressed(self, msg, size):
+        """
+        Return the given message, which carries the given number of bytes of
+        data, compressed if it's worth compressing.
+        """
+        if self.should_compress(size):
+            return CompressedMessage.wrap(self.codec, msg)
+
+        return msg
+
+    def file_frames(self, file_msg, frame_size):
+        """
+        Yield the frames that spool the given file to the server, with the
+        content in each of them compressed if it's worth compressing.
+        """
+        for frame in file_msg.frames(frame_size):
+            if isinstance(frame, FileDataMessage):
+                frame = self.compressed(frame, len(frame.data))
+
+            yield frame
+
+    def compress_file(self, file_msg, digest):
+        """
+        Return the message that sends the given file compressed with the codec
+        that the server picked. The compressed content is kept in the blob
+        cache under the digest of the file, so a file that hasn't changed is
+        only compressed once no matter how many builds it's sent in.
+        """
+        cache = get_blob_cache()
+        algorithm = "{0}+{1}".format(self.proj_algorithm, self.codec)
+
+        body = cache.get(algorithm, digest) if digest is not None else None
+        if body is None:
+            body = compress(self.codec, join_parts([file_msg.payload]))
+            if digest is not None:
+                cache.put(algorithm, digest, body)
+
+        return CompressedMessage.wrap(self.codec, file_msg, body)
+
+    def send_chunk_list(self, root, name, chunks, found):
+        """
+        Send the given file as the given list of the content defined chunks in
+        it; the server will rebuild the file from its existing copy and request
+        any chunks that it does not already have.
+        """
+        self.proj_chunks = (root, name, chunks)
+
+        file_msg = FileChunkListMessage(root, name,
+            [(digest, length) for _, length, digest in chunks])
+
+        log("Sending: [{3}/{4}] {0}/{1} ({2} bytes, {5} chunks)",
+            os.path.basename(os.path.normpath(root)),
+            name,
+            file_msg.file_length,
+            self.proj_sent,
+            found,
+            len(chunks),
+            panel=True)
+
+        # Each chunk in the list is a 20 byte digest and a 32 bit length.
+        self.connection.send(self.compressed(file_msg, len(chunks) * 24))
+
+    def send_chunks(self, msg):
+        """
+        Respond to a request from the server for some of the chunks of the
+        file that we most recently sent a chunk list for.
+        """
+        if self.proj_chunks is None or self.proj_chunks[:2] != (msg.root_path, msg.relative_name):
+            log("Error: Chunks requested for unexpected file {0}", msg.relative_name, panel=True)
+            return
+
+        root, name, chunks = self.proj_chunks
+
+        log("Sending: {0}/{1} ({2} of {3} chunks, {4} bytes)",
+            os.path.basename(os.path.normpath(root)),
+            name,
+            len(msg.indices),
+            len(chunks),
+            sum(chunks[index][1] for index in msg.indices),
+            panel=True)
+
+        self.connection.send_all(self.chunk_frames(root, name, chunks, msg.indices))
+
+    def chunk_frames(self, root, name, chunks, indices):
+        """
+        Yield the FileChunks messages that carry the chunks with the given
+        indices, each holding no more than send_buffer_size bytes of chunks
+        (but always at least one), so that a file with no copy on the server
+        is not sent as one enormous frame. The frames are created as the
+        socket takes them; the chunks in a frame are sent straight from the
+        file, or read into memory one frame at a time to compress them.
+        """
+        filename = os.path.join(root, name)
+        frame_size = rb_setting("send_buffer_size")
+
+        data = []
+        size = 0
+        for index in indices:
+            offset, length, _ = chunks[index]
+            if data and frame_size and size + length > frame_size:
+                yield self.compressed(FileChunksMessage(root, name, data), size)
+                data = []
+                size = 0
+
+            data.append((index, FileRegion(filename, offset, length)))
+            size += length
+
+        if data:
+            yield self.compressed(FileChunksMessage(root, name, data), size)
 
     def result(self, connection, notification):
         if notification == Notification.CLOSED:
@@ -238,6 +645,13 @@ class RemoteBuildCommand(sublime_plugin.WindowCommand):
                 self.connection = None
                 log("Connection: Closed", panel=True)
 
+                # Nothing more will be sent, so stop the gather for the build
+                # in progress, rather than leave it waiting for the queue of
+                # files to send to drain.
+                with self.proj_lock:
+                    self.proj_build = None
+                    self.proj_ready.notify_all()
+
         elif notification == Notification.CONNECTING:
             log("Connection: Connecting to {0}:{1}", connection.host, connection.port, panel=True)
 
@@ -267,6 +681,13 @@ class RemoteBuildCommand(sublime_plugin.WindowCommand):
             elif isinstance(msg, AcknowledgeMessage):
                 self.acknowledge(msg.message_id, msg.positive)
 
+            elif isinstance(msg, SetCompressionMessage):
+                self.codec = msg.codec or None
+                log("Connection: Compression {0}", self.codec or "disabled", panel=True)
+
+            elif isinstance(msg, ChunkRequestMessage):
+                self.send_chunks(msg)
+
             # elif isinstance(msg, FileContentMessage):
             #     log("Receive: {0}/{1} ({2} bytes)",
             #         os.path.basename(os.path.normpath(msg.root_path)),
@@ -145,6 +145,7 @@ public partial class BuildClient
             if (bytesRead == 0)
             {
                 Console.WriteLine("Client closed connection");
+                client.ReleasePendingFiles();
                 return;
             }
 
@@ -174,11 +175,13 @@ public partial class BuildClient
         {
             Console.WriteLine("Socket Error: {0}", se.Message);
             Console.WriteLine("Closing connection");
+            ReleasePendingFiles();
         }
 
         catch (Exception e)
         {
             Console.WriteLine(e.ToString());
+            ReleasePendingFiles();
         }
     }
 
@@ -3,6 +3,7 @@ using System.IO;
 using System.Text;
 using System.Collections.Generic;
 using System.Diagnostics;
+using System.Security.Cryptography;
 
 
 // The state object for reading client data.
@@ -29,6 +30,13 @@ public partial class BuildClient
     /// </summary>
     private string remote_platform;
 
+    /// <summary>
+    /// The compression codec that we picked from those that the client
+    /// offered in its introduction, or an empty string if messages that we
+    /// send are not to be compressed.
+    /// </summary>
+    private string compression_codec = "";
+
     /// <summary>
     /// If we are executing a build, this stores the build ID of the current
     /// build.
@@ -42,6 +50,71 @@ public partial class BuildClient
     /// </summary>
     private Dictionary<string, string> current_build_folders;
 
+    /// <summary>
+    /// Files that the client has sent us a chunk list for, which are waiting
+    /// for the chunks that we requested to arrive; this is keyed on the local
+    /// file name. The chunks can arrive over any number of messages.
+    /// </summary>
+    private Dictionary<string, PendingChunkedFile> pending_chunked_files = new Dictionary<string, PendingChunkedFile>();
+
+    /// <summary>
+    /// If the client is spooling a file to us a frame at a time, this is the
+    /// local file name, the stream that the content is being written to and
+    /// the number of bytes of content that are still to come.
+    /// </summary>
+    private string spool_file = null;
+    private FileStream spool_stream = null;
+    private long spool_remaining = 0;
+
+    /// <summary>
+    /// The total number of bytes of file content that this client has spooled
+    /// to disk (or is about to, for a file that is being sent a frame at a
+    /// time), which is limited by the spool_limit configuration value.
+    /// </summary>
+    private long spooled_bytes = 0;
+
+    /// <summary>
+    /// Account for the given number of bytes of file content that are about to
+    /// be spooled to disk. If this takes the client over the spool limit, the
+    /// client is told and disconnected, and this returns false.
+    /// </summary>
+    bool Spool(long count)
+    {
+        if (config.spool_limit > 0 && count > config.spool_limit - spooled_bytes)
+        {
+            SendError(true, 2003, "Spooled file content is over the limit of {0} bytes", config.spool_limit);
+            ReleasePendingFiles();
+            return false;
+        }
+
+        spooled_bytes += count;
+        return true;
+    }
+
+    /// <summary>
+    /// Close and remove the partial files for any files that are in the middle
+    /// of being sent to us; this is called when the connection to the client
+    /// is closed, since they can never be finished.
+    /// </summary>
+    public void ReleasePendingFiles()
+    {
+        if (spool_stream != null)
+        {
+            spool_stream.Dispose();
+            spool_stream = null;
+            File.Delete(spool_file + ".rbtmp");
+        }
+
+        foreach (var pending in pending_chunked_files.Values)
+        {
+            if (pending.ReceivedStream != null)
+                pending.ReceivedStream.Dispose();
+            File.Delete(pending.ReceivedFile);
+        }
+
+        pending_chunked_files.Clear();
+    }
+
     /// <summary>
     /// Transmit an error message to the user, optionally closing the connection
     /// once the message has been transmitted.
@@ -73,6 +146,29 @@ public partial class BuildClient
         Send(new AcknowledgeMessage(msgType, ack));
     }
 
+    /// <summary>
+    /// Return the given message compressed with the codec that we picked for
+    /// this client, or the message itself if there is no codec, the message
+    /// is too small to bother with, or compressing it doesn't make it any
+    /// smaller.
+    /// </summary>
+    IProtocolMessage Compress(IProtocolMessage message)
+    {
+        if (compression_codec == "" || config.compression_threshold <= 0)
+            return message;
+
+        byte[] encoded = message.Encode();
+        if (encoded.Length - 6 < config.compression_threshold || encoded.Length - 4 > CompressedMessage.MaxLength)
+            return message;
+
+        var compressed = new CompressedMessage(compression_codec, encoded);
+        if (compressed.Body.Count >= encoded.Length - 4)
+            return message;
+
+        compressed.CloseAfterSending = message.CloseAfterSending;
+        return compressed;
+    }
+
     /// <summary>
     /// Handle an incoming protocol message by echoing it back to the remote
     /// client exactly as received. This is a useful test that both ends can
@@ -133,6 +229,8 @@ public partial class BuildClient
                 case MessageType.Acknowledge:
                 case MessageType.BuildOutput:
                 case MessageType.BuildComplete:
+                case MessageType.ChunkRequest:
+                case MessageType.SetCompression:
                     ProtocolViolationMessage(message, "These messages are for server use only");
                     break;
 
@@ -156,6 +254,38 @@ public partial class BuildClient
                     HandleFileContents(message as FileContentMessage);
                     break;
 
+                // The client is sending us a large file as a list of chunks; we
+                // rebuild it from our existing copy and ask for what's missing.
+                case MessageType.FileChunkList:
+                    HandleFileChunkList(message as FileChunkListMessage);
+                    break;
+
+                // The client is sending us the chunks of a file that we asked
+                // for in response to a chunk list.
+                case MessageType.FileChunks:
+                    HandleFileChunks(message as FileChunksMessage);
+                    break;
+
+                // The client is telling us that a file has the same content as
+                // one it already sent, so we can copy that one into place.
+                case MessageType.CopyFile:
+                    HandleCopyFile(message as CopyFileMessage);
+                    break;
+
+                // The client is sending us a large file a frame at a time; the
+                // content is written out as it arrives.
+                case MessageType.FileStart:
+                    HandleFileStart(message as FileStartMessage);
+                    break;
+
+                case MessageType.FileData:
+                    HandleFileData(message as FileDataMessage);
+                    break;
+
+                case MessageType.FileEnd:
+                    HandleFileEnd(message as FileEndMessage);
+                    break;
+
                 // Handle the command to execute a build by running the given
                 // command inside of the appropriate folder, dispatching all of
                 // the output back to the other end.
@@ -192,9 +322,9 @@ public partial class BuildClient
         // If the client is not using the correct protocol version, then error
         // out the connection; a more robust implementation would try to tailor
         // to the age of the client and fall back to an older protocol.
-        if (message.ProtocolVersion != 1)
+        if (message.ProtocolVersion < 1 || message.ProtocolVersion > 2)
         {
-            SendError(true, 1000, "Invalid protocol; only version 1 is supported");
+            SendError(true, 1000, "Invalid protocol; only versions 1 and 2 are supported");
             return;
         }
 
@@ -225,6 +355,16 @@ public partial class BuildClient
             user.username,
             remote_platform,
             remote_host);
+
+        // Clients from version 2 on offer the compression codecs that they
+        // support; pick one and tell the client which one before it starts
+        // sending us anything that might be compressed.
+        if (message.ProtocolVersion >= 2)
+        {
+            compression_codec = Compression.Choose(message.Codecs);
+            Send(new SetCompressionMessage(compression_codec));
+        }
+
         Acknowledge(MessageType.Introduction);
     }
 
@@ -268,38 +408,346 @@ public partial class BuildClient
     }
 
     /// <summary>
-    /// Handle a file transmission by writing the file to the appropriate
-    /// location in the cache folder for the currently registered build.
+    /// Given the root path and relative name of a file on the client, return
+    /// the absolute name of our cached copy of that file. If the root is not
+    /// a part of the current build, this sends an error and returns null.
     /// </summary>
-    void HandleFileContents(FileContentMessage message)
+    string LocalFileName(string root_path, string relative_name)
     {
         // Map the root path on the client to the local cached version; if this
         // fails, the client is sending us files for a root it didn't tell us
         // about when it started the build, so trigger an error.
         string local_path;
-        if (current_build_folders.TryGetValue(message.RootPath, out local_path) == false)
+        if (current_build_folders.TryGetValue(root_path, out local_path) == false)
         {
-            SendError(true, 2000, "Unrecognized root path {0}", message.RootPath);
-            return;
+            SendError(true, 2000, "Unrecognized root path {0}", root_path);
+            return null;
         }
 
         // Now we can combine the relative path of the file in the root with our
         // locally mapped root in order to get an entire complete absolute file
         // name.
-        //
-        // Once we do that, ensure that the directory that contains the file
-        // esists (since it may have never before seen relative parts) and then
-        // write it there.
-        var local_file = Path.Combine(local_path, message.RelativeName);
+        return Path.Combine(local_path, relative_name);
+    }
+
+    /// <summary>
+    /// Handle a file transmission by writing the file to the appropriate
+    /// location in the cache folder for the currently registered build.
+    /// </summary>
+    void HandleFileContents(FileContentMessage message)
+    {
+        // Find where the file lives locally. Once we do that, ensure that the
+        // directory that contains the file exists (since it may have never
+        // before seen relative parts) and then write it there.
+        var local_file = LocalFileName(message.RootPath, message.RelativeName);
+        if (local_file == null)
+            return;
 
         Directory.CreateDirectory(Path.GetDirectoryName(local_file));
-        File.WriteAllText(local_file, message.FileContent, Encoding.UTF8);
+        message.WriteTo(local_file);
 
         // Now that we're done, tell the client that we have received the file
         // and handled it so they can send the next one or start the build.
         Acknowledge(MessageType.FileContent);
     }
 
+    /// <summary>
+    /// Handle a file that is being sent to us as a list of chunks by finding
+    /// all of the chunks that our existing copy of the file has in common with
+    /// the new version, and requesting only the ones that we don't have.
+    /// </summary>
+    void HandleFileChunkList(FileChunkListMessage message)
+    {
+        var local_file = LocalFileName(message.RootPath, message.RelativeName);
+        if (local_file == null)
+            return;
+
+        // Chunk our current copy of the file (if any) the same way the client
+        // did, so that any unchanged parts of the file result in identical
+        // chunks on both ends.
+        var existing = new Dictionary<string, Chunk>();
+        if (File.Exists(local_file))
+        {
+            foreach (var chunk in Chunker.ChunkFile(local_file))
+                existing[chunk.Key] = chunk;
+        }
+
+        var needed = new List<UInt32>();
+        for (int i = 0 ; i < message.Chunks.Count ; i++)
+        {
+            if (existing.ContainsKey(message.Chunks[i].Key) == false)
+                needed.Add((UInt32) i);
+        }
+
+        var pending = new PendingChunkedFile(message, existing, needed, local_file + ".rbchunks");
+
+        // If we already have every chunk, the file can be rebuilt right away;
+        // otherwise hold onto it until the chunks we need arrive.
+        if (needed.Count == 0)
+        {
+            AssembleChunkedFile(local_file, pending);
+            return;
+        }
+
+        // A chunk list for a file that we were already waiting on chunks for
+        // replaces it.
+        PendingChunkedFile previous;
+        if (pending_chunked_files.TryGetValue(local_file, out previous))
+            previous.ReceivedStream.Dispose();
+
+        Directory.CreateDirectory(Path.GetDirectoryName(local_file));
+        pending.ReceivedStream = File.Create(pending.ReceivedFile);
+
+        pending_chunked_files[local_file] = pending;
+        Send(Compress(new ChunkRequestMessage(message.RootPath, message.RelativeName, needed)));
+    }
+
+    /// <summary>
+    /// Handle the arrival of some of the chunks that we requested for a file
+    /// by writing them out; once the last of them arrives, we can rebuild it.
+    /// </summary>
+    void HandleFileChunks(FileChunksMessage message)
+    {
+        var local_file = LocalFileName(message.RootPath, message.RelativeName);
+        if (local_file == null)
+            return;
+
+        PendingChunkedFile pending;
+        if (pending_chunked_files.TryGetValue(local_file, out pending) == false)
+        {
+            ProtocolViolationMessage(message, "Received chunks for a file with no chunk list");
+            return;
+        }
+
+        foreach (var entry in message.Chunks)
+        {
+            if (Spool(entry.Value.Count) == false)
+                return;
+
+            if (pending.Needed.Remove(entry.Key) == false)
+            {
+                ProtocolViolationMessage(message, "Received chunk {0} of {1}, which was not requested",
+                                         entry.Key, message.RelativeName);
+                return;
+            }
+
+            var chunk = pending.ChunkList.Chunks[(int) entry.Key];
+            pending.Received[entry.Key] = new Chunk(pending.ReceivedStream.Position, entry.Value.Count, chunk.Digest);
+            pending.ReceivedStream.Write(entry.Value.Array, entry.Value.Offset, entry.Value.Count);
+        }
+
+        if (pending.Needed.Count != 0)
+            return;
+
+        pending_chunked_files.Remove(local_file);
+        pending.ReceivedStream.Dispose();
+        pending.ReceivedStream = null;
+
+        try
+        {
+            AssembleChunkedFile(local_file, pending);
+        }
+        finally
+        {
+            File.Delete(pending.ReceivedFile);
+        }
+    }
+
+    /// <summary>
+    /// Read the given number of bytes from the given offset of a stream.
+    /// </summary>
+    static byte[] ReadChunk(Stream input, long offset, int length)
+    {
+        var data = new byte[length];
+        input.Seek(offset, SeekOrigin.Begin);
+        for (int read = 0 ; read < data.Length ; )
+        {
+            int count = input.Read(data, read, data.Length - read);
+            if (count == 0)
+                throw new EndOfStreamException();
+            read += count;
+        }
+
+        return data;
+    }
+
+    /// <summary>
+    /// Rebuild a file from its chunk list, taking the chunks either from the
+    /// ones that the client sent us or from our existing copy of the file. The
+    /// new file is written alongside the old one and then moved into place.
+    ///
+    /// If a chunk is missing or doesn't match its digest (such as when the
+    /// file changed on either end while it was being sent), the file is left
+    /// as it was and we negatively acknowledge it, which tells the client to
+    /// send the whole file instead.
+    /// </summary>
+    void AssembleChunkedFile(string local_file, PendingChunkedFile pending)
+    {
+        var temp_file = local_file + ".rbtmp";
+        string problem = null;
+
+        Directory.CreateDirectory(Path.GetDirectoryName(local_file));
+        using (var sha1 = SHA1.Create())
+        using (var output = File.Create(temp_file))
+        using (var input = pending.Existing.Count > 0 ? File.OpenRead(local_file) : null)
+        using (var received = pending.Received.Count > 0 ? File.OpenRead(pending.ReceivedFile) : null)
+        {
+            var chunks = pending.ChunkList.Chunks;
+            for (int i = 0 ; i < chunks.Count && problem == null ; i++)
+            {
+                byte[] data = null;
+                Chunk have;
+                try
+                {
+                    if (pending.Received.TryGetValue((UInt32) i, out have))
+                        data = ReadChunk(received, have.Offset, have.Length);
+                    else if (pending.Existing.TryGetValue(chunks[i].Key, out have))
+                        data = ReadChunk(input, have.Offset, have.Length);
+                }
+                catch (EndOfStreamException)
+                {
+                }
+
+                // Verify each chunk as we go, so that a file that changed on
+                // either end in the meantime can't be silently corrupted.
+                if (data == null)
+                    problem = String.Format("Missing chunk {0} of {1}", i, pending.ChunkList.RelativeName);
+                else if (Chunker.DigestKey(sha1.ComputeHash(data)) != chunks[i].Key)
+                    problem = String.Format("Chunk {0} of {1} does not match", i, pending.ChunkList.RelativeName);
+                else
+                    output.Write(data, 0, data.Length);
+            }
+        }
+
+        if (problem != null)
+        {
+            File.Delete(temp_file);
+            SendMessage("{0}; asking for the whole file", problem);
+            Acknowledge(MessageType.FileContent, false);
+            return;
+        }
+
+        if (File.Exists(local_file))
+            File.Delete(local_file);
+        File.Move(temp_file, local_file);
+
+        // The file is complete now, so this acknowledges it the same way as a
+        // file that was sent to us whole.
+        Acknowledge(MessageType.FileContent);
+    }
+
+    /// <summary>
+    /// Handle a file whose content is the same as a file that the client has
+    /// already sent us in this build, by copying our copy of that file.
+    /// </summary>
+    void HandleCopyFile(CopyFileMessage message)
+    {
+        var source_file = LocalFileName(message.SourceRoot, message.SourceName);
+        var local_file = LocalFileName(message.RootPath, message.RelativeName);
+        if (source_file == null || local_file == null)
+            return;
+
+        if (File.Exists(source_file) == false)
+        {
+            SendError(true, 2001, "Copy source {0} does not exist", message.SourceName);
+            return;
+        }
+
+        Directory.CreateDirectory(Path.GetDirectoryName(local_file));
+        File.Copy(source_file, local_file, true);
+
+        // The client continues on in the same way as for a file that it sent.
+        Acknowledge(MessageType.FileContent);
+    }
+
+    /// <summary>
+    /// Handle the start of a file that the client is spooling to us a frame at
+    /// a time, by creating a temporary file for its content to go into.
+    /// </summary>
+    void HandleFileStart(FileStartMessage message)
+    {
+        if (spool_stream != null)
+        {
+            ProtocolViolationMessage(message, "Received the start of a file while another is being sent");
+            return;
+        }
+
+        var local_file = LocalFileName(message.RootPath, message.RelativeName);
+        if (local_file == null)
+            return;
+
+        if (message.FileLength > (UInt64) Int64.MaxValue)
+        {
+            ProtocolViolationMessage(message, "File {0} is too large", message.RelativeName);
+            return;
+        }
+
+        // The whole file counts towards the spool limit as soon as it starts.
+        if (Spool((long) message.FileLength) == false)
+            return;
+
+        Directory.CreateDirectory(Path.GetDirectoryName(local_file));
+
+        spool_file = local_file;
+        spool_stream = File.Create(local_file + ".rbtmp");
+        spool_remaining = (long) message.FileLength;
+    }
+
+    /// <summary>
+    /// Handle the next frame of content for the file being spooled to us by
+    /// writing it out, so that we never hold more than a frame of it.
+    /// </summary>
+    void HandleFileData(FileDataMessage message)
+    {
+        if (spool_stream == null)
+        {
+            ProtocolViolationMessage(message, "Received file data with no file being sent");
+            return;
+        }
+
+        if (message.Data.Count > spool_remaining)
+        {
+            ProtocolViolationMessage(message, "Received more data than the size of {0}", spool_file);
+            return;
+        }
+
+        spool_stream.Write(message.Data.Array, message.Data.Offset, message.Data.Count);
+        spool_remaining -= message.Data.Count;
+    }
+
+    /// <summary>
+    /// Handle the end of the file being spooled to us by moving it into place
+    /// and acknowledging it the same way as a file that was sent whole.
+    /// </summary>
+    void HandleFileEnd(FileEndMessage message)
+    {
+        var local_file = LocalFileName(message.RootPath, message.RelativeName);
+        if (local_file == null)
+            return;
+
+        if (spool_stream == null || spool_file != local_file)
+        {
+            ProtocolViolationMessage(message, "Received the end of a file that is not being sent");
+            return;
+        }
+
+        spool_stream.Dispose();
+        spool_stream = null;
+
+        if (spool_remaining != 0)
+        {
+            File.Delete(local_file + ".rbtmp");
+            SendError(true, 2002, "File {0} ended {1} bytes early", message.RelativeName, spool_remaining);
+            return;
+        }
+
+        if (File.Exists(local_file))
+            File.Delete(local_file);
+        File.Move(local_file + ".rbtmp", local_file);
+
+        Acknowledge(MessageType.FileContent);
+    }
+
     /// <summary>
     /// Handle the execution of the build by executing the command that exists
     /// in the first cached folder in the build.
@@ -397,12 +845,12 @@ public partial class BuildClient
             // that the output is done now.
             process.OutputDataReceived += (sender, data) => {
                 if (data.Data != null)
-                    Send(new BuildOutputMessage(data.Data, true));
+                    Send(Compress(new BuildOutputMessage(data.Data, true)));
             };
 
             process.ErrorDataReceived += (sender, data) => {
                 if (data.Data != null)
-                    Send(new BuildOutputMessage(data.Data, false));
+                    Send(Compress(new BuildOutputMessage(data.Data, false)));
             };
 
             // Also ensure that we can detect when the process is going away
@@ -0,0 +1,176 @@
+using System;
+using System.IO;
+using System.Collections.Generic;
+using System.Security.Cryptography;
+
+
+/// <summary>
+/// A single content defined chunk of a file; where it is in the file, how big
+/// it is, and the SHA-1 of its content.
+/// </summary>
+public class Chunk
+{
+    public long Offset { get ; private set; }
+    public int Length { get ; private set; }
+    public byte[] Digest { get ; private set; }
+
+    public Chunk(long offset, int length, byte[] digest)
+    {
+        Offset = offset;
+        Length = length;
+        Digest = digest;
+    }
+
+    /// <summary>
+    /// A string version of the digest of this chunk, suitable for use as a
+    /// dictionary key.
+    /// </summary>
+    public string Key
+    {
+        get { return Chunker.DigestKey(Digest); }
+    }
+}
+
+
+/// <summary>
+/// Splits files into content defined chunks, using exactly the same rolling
+/// hash and parameters as the client (see chunker.py) so that both ends agree
+/// on where the chunk boundaries in a file are.
+/// </summary>
+public static class Chunker
+{
+    public const int MinChunkSize = 2048;
+    public const int MaxChunkSize = 65536;
+
+    // How much of a file is held in memory at once while it is chunked.
+    const int BufferSize = MaxChunkSize * 16;
+
+    // A boundary occurs wherever the rolling hash has all of these bits clear.
+    const UInt32 CutMask = 0xFFF80000;
+
+    // The gear table maps each byte value to the first four bytes (big endian)
+    // of the SHA-1 of that byte.
+    static readonly UInt32[] Gear = BuildGear();
+
+    static UInt32[] BuildGear()
+    {
+        var gear = new UInt32[256];
+        using (var sha1 = SHA1.Create())
+        {
+            for (int i = 0 ; i < 256 ; i++)
+            {
+                var hash = sha1.ComputeHash(new byte[] { (byte) i });
+                gear[i] = ProtocolMessageFactory.Converter.ToUInt32(hash, 0);
+            }
+        }
+
+        return gear;
+    }
+
+    /// <summary>
+    /// Return the key used to look up a chunk with the given digest.
+    /// </summary>
+    public static string DigestKey(byte[] digest)
+    {
+        return Convert.ToBase64String(digest);
+    }
+
+    /// <summary>
+    /// Given a buffer and the range of it that has not been chunked yet,
+    /// return the length of the next chunk.
+    /// </summary>
+    static int FindCut(byte[] data, int start, int length)
+    {
+        int end = Math.Min(length, MaxChunkSize);
+        if (end <= MinChunkSize)
+            return end;
+
+        UInt32 h = 0;
+        for (int i = MinChunkSize ; i < end ; i++)
+        {
+            h = (h << 1) + Gear[data[start + i]];
+            if ((h & CutMask) == 0)
+                return i + 1;
+        }
+
+        return end;
+    }
+
+    /// <summary>
+    /// Return the list of chunks that make up the given file. The file is
+    /// read a buffer at a time, so it is never entirely in memory; the buffer
+    /// is refilled whenever less than a whole chunk remains in it.
+    /// </summary>
+    public static List<Chunk> ChunkFile(string filename)
+    {
+        var chunks = new List<Chunk>();
+        var data = new byte[BufferSize];
+
+        using (var sha1 = SHA1.Create())
+        using (var input = File.OpenRead(filename))
+        {
+            long offset = 0;
+            int start = 0;
+            int length = 0;
+            bool eof = false;
+
+            while (true)
+            {
+                if (eof == false && length < MaxChunkSize)
+                {
+                    Buffer.BlockCopy(data, start, data, 0, length);
+                    start = 0;
+
+                    while (eof == false && length < data.Length)
+                    {
+                        int count = input.Read(data, length, data.Length - length);
+                        if (count == 0)
+                            eof = true;
+                        length += count;
+                    }
+                }
+
+                if (length == 0)
+                    break;
+
+                int cut = FindCut(data, start, length);
+                chunks.Add(new Chunk(offset, cut, sha1.ComputeHash(data, start, cut)));
+                offset += cut;
+                start += cut;
+                length -= cut;
+            }
+        }
+
+        return chunks;
+    }
+}
+
+
+/// <summary>
+/// A file that the client has sent a chunk list for, along with the chunks of
+/// our existing copy of that file, keyed by digest, and the indexes of the
+/// chunks that we requested but have not received yet.
+///
+/// The client sends the requested chunks over as many messages as it likes;
+/// as they arrive they are written to a temporary file rather than being
+/// held in memory, and Received records where each one was written.
+/// </summary>
+public class PendingChunkedFile
+{
+    public FileChunkListMessage ChunkList { get ; private set; }
+    public Dictionary<string, Chunk> Existing { get ; private set; }
+    public HashSet<UInt32> Needed { get ; private set; }
+    public Dictionary<UInt32, Chunk> Received { get ; private set; }
+    public string ReceivedFile { get ; private set; }
+    public FileStream ReceivedStream { get ; set; }
+
+    public PendingChunkedFile(FileChunkListMessage chunk_list, Dictionary<string, Chunk> existing,
+                              IEnumerable<UInt32> needed, string received_file)
+    {
+        ChunkList = chunk_list;
+        Existing = existing;
+        Needed = new HashSet<UInt32>(needed);
+        Received = new Dictionary<UInt32, Chunk>();
+        ReceivedFile = received_file;
+    }
+}
@@ -0,0 +1,86 @@
+using System;
+using System.IO;
+using System.IO.Compression;
+using System.Collections.Generic;
+
+
+/// <summary>
+/// The compression codecs that messages can be compressed with, which are the
+/// same as those on the client (see compression.py). The deflate codecs are
+/// raw deflate streams; the client can also do lzma, which we don't support,
+/// so we never pick it.
+/// </summary>
+public static class Compression
+{
+    /// <summary>
+    /// The codecs that we support, and the level that we compress at for each
+    /// of them; there is no way to ask for an exact deflate level here, so
+    /// this is as close as we can get.
+    /// </summary>
+    static readonly Dictionary<string, CompressionLevel> codecs = new Dictionary<string, CompressionLevel>
+    {
+        { "deflate-1", CompressionLevel.Fastest },
+        { "deflate-6", CompressionLevel.Optimal },
+        { "deflate-9", CompressionLevel.Optimal },
+    };
+
+    /// <summary>
+    /// Given the codecs that a client offered in order of preference, return
+    /// the first one that we support, or an empty string if there are none,
+    /// which means that nothing is compressed.
+    /// </summary>
+    public static string Choose(IEnumerable<string> offered)
+    {
+        foreach (var codec in offered)
+        {
+            if (codecs.ContainsKey(codec))
+                return codec;
+        }
+
+        return "";
+    }
+
+    /// <summary>
+    /// Compress the given data with the named codec.
+    /// </summary>
+    public static byte[] Compress(string codec, byte[] data, int offset, int count)
+    {
+        if (codecs.ContainsKey(codec) == false)
+            throw new ArgumentException(String.Format("Unknown compression codec '{0}'", codec));
+
+        using (var output = new MemoryStream())
+        {
+            using (var deflate = new DeflateStream(output, codecs[codec], true))
+                deflate.Write(data, offset, count);
+
+            return output.ToArray();
+        }
+    }
+
+    /// <summary>
+    /// Decompress the given data, which was compressed with the named codec,
+    /// into the given buffer at the given offset; the decompressed data must
+    /// exactly fill the rest of the buffer.
+    /// </summary>
+    public static void Decompress(string codec, ArraySegment<byte> data, byte[] buffer, int offset)
+    {
+        if (codecs.ContainsKey(codec) == false)
+            throw new ArgumentException(String.Format("Unknown compression codec '{0}'", codec));
+
+        using (var input = new MemoryStream(data.Array, data.Offset, data.Count, false))
+        using (var inflate = new DeflateStream(input, CompressionMode.Decompress))
+        {
+            while (offset < buffer.Length)
+            {
+                int read = inflate.Read(buffer, offset, buffer.Length - offset);
+                if (read == 0)
+                    break;
+
+                offset += read;
+            }
+
+            if (offset != buffer.Length || inflate.ReadByte() != -1)
+                throw new ArgumentException("Compressed message length is invalid");
+        }
+    }
+}
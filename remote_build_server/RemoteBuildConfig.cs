@@ -20,6 +20,16 @@ public class RemoteBuildConfig
     // Should we listen on localhost instead of the "normal" host name?
     public bool use_localhost = false;
 
+    // Build output messages at least this many bytes in size are compressed,
+    // if the client offered a compression codec that we support; 0 turns this
+    // off.
+    public int compression_threshold = 1024;
+
+    // The most bytes of file content that a single client connection can
+    // spool to disk, as files sent a frame at a time and as requested chunks;
+    // a client that goes over this is disconnected. 0 turns this off.
+    public long spool_limit = 64L * 1024 * 1024 * 1024;
+
     // The list of users that have access to remote builds.
     public List<RemoteBuildUser> users;
 
@@ -0,0 +1,62 @@
+using System;
+using System.Text;
+using System.Collections.Generic;
+using MiscUtil.Conversion;
+
+public class ChunkRequestMessage : IProtocolMessage
+{
+    public string RootPath { get ; private set; } = null;
+    public string RelativeName { get ; private set; } = null;
+    public List<UInt32> Indices { get ; private set; } = null;
+
+    public MessageType MsgID { get ; private set; } = MessageType.ChunkRequest;
+    public bool CloseAfterSending { get ; set; } = false;
+
+
+    public ChunkRequestMessage(string root, string name, List<UInt32> indices)
+    {
+        RootPath = root;
+        RelativeName = name;
+        Indices = indices;
+    }
+
+    public ChunkRequestMessage(byte[] data)
+    {
+        if (data.Length < 2 + 256 + 256 + 4)
+            throw new ArgumentException("Message data length is invalid");
+
+        RootPath = Extensions.GetFixedWidthString(data, 2, 256);
+        RelativeName = Extensions.GetFixedWidthString(data, 258, 256);
+        UInt32 count = ProtocolMessageFactory.Converter.ToUInt32(data, 514);
+
+        if (data.Length < 2 + 256 + 256 + 4 + count * 4)
+            throw new ArgumentException("Message data length is invalid");
+
+        Indices = new List<UInt32>((int) count);
+        for (int i = 0 ; i < count ; i++)
+            Indices.Add(ProtocolMessageFactory.Converter.ToUInt32(data, 518 + i * 4));
+    }
+
+    public byte[] Encode()
+    {
+        byte[] msg = new byte[4 + 2 + 256 + 256 + 4 + Indices.Count * 4];
+
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) msg.Length - 4), 0, msg, 0, 4);
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt16) MessageType.ChunkRequest), 0, msg, 4, 2);
+
+        Buffer.BlockCopy(RootPath.PaddedByteArray(256),     0 , msg,   6, 256);
+        Buffer.BlockCopy(RelativeName.PaddedByteArray(256), 0 , msg, 262, 256);
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) Indices.Count), 0, msg, 518, 4);
+
+        for (int i = 0 ; i < Indices.Count ; i++)
+            Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes(Indices[i]), 0, msg, 522 + i * 4, 4);
+
+        return msg;
+    }
+
+    public override string ToString()
+    {
+        return String.Format("<ChunkRequest root='{0}' name='{1}' chunks={2}>",
+            RootPath, RelativeName, Indices.Count);
+    }
+}
@@ -0,0 +1,114 @@
+using System;
+using System.Text;
+using MiscUtil.Conversion;
+
+public class CompressedMessage : IProtocolMessage
+{
+    // The largest message that can be carried compressed, which is the same
+    // as on the client (see messages.py); the length of the carried message
+    // is checked against this before anything is allocated for it, so that a
+    // bogus length can't make us allocate any amount of memory.
+    public const UInt32 MaxLength = 16 * 1024 * 1024;
+
+    public string Codec { get ; private set; }
+    // The length of the carried message once it has been decompressed, the
+    // uncompressed start of it, and the compressed remainder.
+    public UInt32 Length { get ; private set; }
+    public ArraySegment<byte> Header { get ; private set; }
+    public ArraySegment<byte> Body { get ; private set; }
+
+    public MessageType MsgID { get ; private set; } = MessageType.Compressed;
+    public bool CloseAfterSending { get ; set; } = false;
+
+
+    /// <summary>
+    /// Compress a message with the given codec, given its encoded form; the
+    /// whole message is compressed, so the header is empty.
+    /// </summary>
+    public CompressedMessage(string codec, byte[] encoded)
+    {
+        Codec = codec;
+        Length = (UInt32) encoded.Length - 4;
+        Header = new ArraySegment<byte>(new byte[0]);
+        Body = new ArraySegment<byte>(Compression.Compress(codec, encoded, 4, encoded.Length - 4));
+    }
+
+    public CompressedMessage(byte[] data)
+    {
+        if (data.Length < 2 + 4)
+            throw new ArgumentException("Message data length is invalid");
+
+        UInt32 codecLength = ProtocolMessageFactory.Converter.ToUInt32(data, 2);
+        int offset = 6 + (int) codecLength;
+
+        if (data.Length < offset + 4 + 4)
+            throw new ArgumentException("Message data length is invalid");
+
+        Codec = Encoding.UTF8.GetString(data, 6, (int) codecLength);
+        Length = ProtocolMessageFactory.Converter.ToUInt32(data, offset);
+        UInt32 headerLength = ProtocolMessageFactory.Converter.ToUInt32(data, offset + 4);
+        offset += 8;
+
+        if (data.Length < offset + headerLength + 4)
+            throw new ArgumentException("Message data length is invalid");
+
+        Header = new ArraySegment<byte>(data, offset, (int) headerLength);
+        offset += (int) headerLength;
+
+        UInt32 bodyLength = ProtocolMessageFactory.Converter.ToUInt32(data, offset);
+        offset += 4;
+
+        if (data.Length != offset + bodyLength)
+            throw new ArgumentException("Message data length is invalid");
+
+        Body = new ArraySegment<byte>(data, offset, (int) bodyLength);
+    }
+
+    /// <summary>
+    /// Decompress the message that this message carries and return it.
+    /// </summary>
+    public IProtocolMessage Unwrap()
+    {
+        if (Length < Header.Count || Length > MaxLength)
+            throw new ArgumentException("Compressed message length is invalid");
+
+        byte[] data = new byte[Length];
+
+        Buffer.BlockCopy(Header.Array, Header.Offset, data, 0, Header.Count);
+        Compression.Decompress(Codec, Body, data, Header.Count);
+
+        if (data.Length >= 2 && ProtocolMessageFactory.Converter.ToUInt16(data, 0) == (UInt16) MessageType.Compressed)
+            throw new ArgumentException("Compressed message carries a compressed message");
+
+        return ProtocolMessageFactory.from_data(data);
+    }
+
+    public byte[] Encode()
+    {
+        byte[] codecBytes = Encoding.UTF8.GetBytes(Codec);
+        int offset = 10 + codecBytes.Length;
+
+        byte[] msg = new byte[offset + 4 + 4 + Header.Count + 4 + Body.Count];
+
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) msg.Length - 4), 0, msg, 0, 4);
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt16) MessageType.Compressed), 0, msg, 4, 2);
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) codecBytes.Length), 0, msg, 6, 4);
+        Buffer.BlockCopy(codecBytes, 0, msg, 10, codecBytes.Length);
+
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes(Length), 0, msg, offset, 4);
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) Header.Count), 0, msg, offset + 4, 4);
+        Buffer.BlockCopy(Header.Array, Header.Offset, msg, offset + 8, Header.Count);
+        offset += 8 + Header.Count;
+
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) Body.Count), 0, msg, offset, 4);
+        Buffer.BlockCopy(Body.Array, Body.Offset, msg, offset + 4, Body.Count);
+
+        return msg;
+    }
+
+    public override string ToString()
+    {
+        return String.Format("<Compressed codec='{0}' size={1} compressed={2}>",
+            Codec, Length, Header.Count + Body.Count);
+    }
+}
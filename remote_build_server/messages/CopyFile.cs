@@ -0,0 +1,55 @@
+using System;
+using System.Text;
+using MiscUtil.Conversion;
+
+public class CopyFileMessage : IProtocolMessage
+{
+    public string SourceRoot { get ; private set; } = null;
+    public string SourceName { get ; private set; } = null;
+    public string RootPath { get ; private set; } = null;
+    public string RelativeName { get ; private set; } = null;
+
+    public MessageType MsgID { get ; private set; } = MessageType.CopyFile;
+    public bool CloseAfterSending { get ; set; } = false;
+
+
+    public CopyFileMessage(string source_root, string source_name, string root, string name)
+    {
+        SourceRoot = source_root;
+        SourceName = source_name;
+        RootPath = root;
+        RelativeName = name;
+    }
+
+    public CopyFileMessage(byte[] data)
+    {
+        if (data.Length != 2 + 256 + 256 + 256 + 256)
+            throw new ArgumentException("Message data length is invalid");
+
+        SourceRoot = Extensions.GetFixedWidthString(data, 2, 256);
+        SourceName = Extensions.GetFixedWidthString(data, 258, 256);
+        RootPath = Extensions.GetFixedWidthString(data, 514, 256);
+        RelativeName = Extensions.GetFixedWidthString(data, 770, 256);
+    }
+
+    public byte[] Encode()
+    {
+        byte[] msg = new byte[4 + 2 + 256 + 256 + 256 + 256];
+
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) msg.Length - 4), 0, msg, 0, 4);
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt16) MessageType.CopyFile), 0, msg, 4, 2);
+
+        Buffer.BlockCopy(SourceRoot.PaddedByteArray(256),   0 , msg,   6, 256);
+        Buffer.BlockCopy(SourceName.PaddedByteArray(256),   0 , msg, 262, 256);
+        Buffer.BlockCopy(RootPath.PaddedByteArray(256),     0 , msg, 518, 256);
+        Buffer.BlockCopy(RelativeName.PaddedByteArray(256), 0 , msg, 774, 256);
+
+        return msg;
+    }
+
+    public override string ToString()
+    {
+        return String.Format("<CopyFile source='{0}' name='{1}' root='{2}' name='{3}'>",
+            SourceRoot, SourceName, RootPath, RelativeName);
+    }
+}
@@ -0,0 +1,83 @@
+using System;
+using System.Text;
+using System.Collections.Generic;
+using MiscUtil.Conversion;
+
+public class FileChunkListMessage : IProtocolMessage
+{
+    public string RootPath { get ; private set; } = null;
+    public string RelativeName { get ; private set; } = null;
+    public UInt64 FileLength { get ; private set; } = 0;
+    public List<Chunk> Chunks { get ; private set; } = null;
+
+    public MessageType MsgID { get ; private set; } = MessageType.FileChunkList;
+    public bool CloseAfterSending { get ; set; } = false;
+
+
+    public FileChunkListMessage(string root, string name, List<Chunk> chunks)
+    {
+        RootPath = root;
+        RelativeName = name;
+        Chunks = chunks;
+
+        foreach (var chunk in chunks)
+            FileLength += (UInt64) chunk.Length;
+    }
+
+    public FileChunkListMessage(byte[] data)
+    {
+        if (data.Length < 2 + 256 + 256 + 8 + 4)
+            throw new ArgumentException("Message data length is invalid");
+
+        RootPath = Extensions.GetFixedWidthString(data, 2, 256);
+        RelativeName = Extensions.GetFixedWidthString(data, 258, 256);
+        FileLength = ProtocolMessageFactory.Converter.ToUInt64(data, 514);
+        UInt32 count = ProtocolMessageFactory.Converter.ToUInt32(data, 522);
+
+        if (data.Length < 2 + 256 + 256 + 8 + 4 + count * 24)
+            throw new ArgumentException("Message data length is invalid");
+
+        // The chunk offsets are not transmitted, but they follow from the
+        // lengths of the chunks that come before them.
+        Chunks = new List<Chunk>((int) count);
+        long offset = 0;
+        for (int i = 0 ; i < count ; i++)
+        {
+            int pos = 526 + i * 24;
+            var digest = new byte[20];
+            Buffer.BlockCopy(data, pos, digest, 0, 20);
+            int length = (int) ProtocolMessageFactory.Converter.ToUInt32(data, pos + 20);
+
+            Chunks.Add(new Chunk(offset, length, digest));
+            offset += length;
+        }
+    }
+
+    public byte[] Encode()
+    {
+        byte[] msg = new byte[4 + 2 + 256 + 256 + 8 + 4 + Chunks.Count * 24];
+
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) msg.Length - 4), 0, msg, 0, 4);
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt16) MessageType.FileChunkList), 0, msg, 4, 2);
+
+        Buffer.BlockCopy(RootPath.PaddedByteArray(256),     0 , msg,   6, 256);
+        Buffer.BlockCopy(RelativeName.PaddedByteArray(256), 0 , msg, 262, 256);
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes(FileLength), 0, msg, 518, 8);
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) Chunks.Count), 0, msg, 526, 4);
+
+        for (int i = 0 ; i < Chunks.Count ; i++)
+        {
+            int pos = 530 + i * 24;
+            Buffer.BlockCopy(Chunks[i].Digest, 0, msg, pos, 20);
+            Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) Chunks[i].Length), 0, msg, pos + 20, 4);
+        }
+
+        return msg;
+    }
+
+    public override string ToString()
+    {
+        return String.Format("<FileChunkList root='{0}' name='{1}' size={2} chunks={3}>",
+            RootPath, RelativeName, FileLength, Chunks.Count);
+    }
+}
@@ -0,0 +1,85 @@
+using System;
+using System.Text;
+using System.Collections.Generic;
+using MiscUtil.Conversion;
+
+public class FileChunksMessage : IProtocolMessage
+{
+    public string RootPath { get ; private set; } = null;
+    public string RelativeName { get ; private set; } = null;
+    public List<KeyValuePair<UInt32, ArraySegment<byte>>> Chunks { get ; private set; } = null;
+
+    public MessageType MsgID { get ; private set; } = MessageType.FileChunks;
+    public bool CloseAfterSending { get ; set; } = false;
+
+
+    public FileChunksMessage(string root, string name, List<KeyValuePair<UInt32, ArraySegment<byte>>> chunks)
+    {
+        RootPath = root;
+        RelativeName = name;
+        Chunks = chunks;
+    }
+
+    public FileChunksMessage(byte[] data)
+    {
+        if (data.Length < 2 + 256 + 256 + 4)
+            throw new ArgumentException("Message data length is invalid");
+
+        RootPath = Extensions.GetFixedWidthString(data, 2, 256);
+        RelativeName = Extensions.GetFixedWidthString(data, 258, 256);
+        UInt32 count = ProtocolMessageFactory.Converter.ToUInt32(data, 514);
+
+        // The chunks refer to the message data rather than being copied out of
+        // it, since they're just going to be written out to disk.
+        Chunks = new List<KeyValuePair<UInt32, ArraySegment<byte>>>();
+        int pos = 518;
+        for (int i = 0 ; i < count ; i++)
+        {
+            if (data.Length < pos + 8)
+                throw new ArgumentException("Message data length is invalid");
+
+            UInt32 index = ProtocolMessageFactory.Converter.ToUInt32(data, pos);
+            int length = (int) ProtocolMessageFactory.Converter.ToUInt32(data, pos + 4);
+            pos += 8;
+
+            if (data.Length < pos + length)
+                throw new ArgumentException("Message data length is invalid");
+
+            Chunks.Add(new KeyValuePair<UInt32, ArraySegment<byte>>(index, new ArraySegment<byte>(data, pos, length)));
+            pos += length;
+        }
+    }
+
+    public byte[] Encode()
+    {
+        int size = 4 + 2 + 256 + 256 + 4;
+        foreach (var chunk in Chunks)
+            size += 8 + chunk.Value.Count;
+
+        byte[] msg = new byte[size];
+
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) msg.Length - 4), 0, msg, 0, 4);
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt16) MessageType.FileChunks), 0, msg, 4, 2);
+
+        Buffer.BlockCopy(RootPath.PaddedByteArray(256),     0 , msg,   6, 256);
+        Buffer.BlockCopy(RelativeName.PaddedByteArray(256), 0 , msg, 262, 256);
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) Chunks.Count), 0, msg, 518, 4);
+
+        int pos = 522;
+        foreach (var entry in Chunks)
+        {
+            Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes(entry.Key), 0, msg, pos, 4);
+            Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) entry.Value.Count), 0, msg, pos + 4, 4);
+            Buffer.BlockCopy(entry.Value.Array, entry.Value.Offset, msg, pos + 8, entry.Value.Count);
+            pos += 8 + entry.Value.Count;
+        }
+
+        return msg;
+    }
+
+    public override string ToString()
+    {
+        return String.Format("<FileChunks root='{0}' name='{1}' chunks={2}>",
+            RootPath, RelativeName, Chunks.Count);
+    }
+}
@@ -1,4 +1,5 @@
 using System;
+using System.IO;
 using System.Text;
 using MiscUtil.Conversion;
 
@@ -6,7 +7,9 @@ public class FileContentMessage : IProtocolMessage
 {
     public string RootPath { get ; private set; } = null;
     public string RelativeName { get ; private set; } = null;
-    public string FileContent { get ; private set; } = null;
+    // The content of the file, which is binary. For a received message this
+    // is a view of the message data rather than a copy of it.
+    public ArraySegment<byte> FileContent { get ; private set; }
 
     public MessageType MsgID { get ; private set; } = MessageType.FileContent;
     public bool CloseAfterSending { get ; set; } = false;
@@ -19,7 +22,7 @@ public class FileContentMessage : IProtocolMessage
     {
         RootPath = root;
         RelativeName = name;
-        FileContent = "";
+        FileContent = new ArraySegment<byte>(new byte[0]);
     }
 
     public FileContentMessage(byte[] data)
@@ -34,21 +37,30 @@ public class FileContentMessage : IProtocolMessage
         if (data.Length < 2 + 256 + 256 + 4 + fileLength)
             throw new ArgumentException("Message data length is invalid");
 
-        FileContent = Encoding.UTF8.GetString(data, 518, (int) fileLength);
+        FileContent = new ArraySegment<byte>(data, 518, (int) fileLength);
+    }
+
+    /// <summary>
+    /// Write the content of the file to the given file, straight from the
+    /// buffer that holds it.
+    /// </summary>
+    public void WriteTo(string filename)
+    {
+        using (var output = File.Create(filename))
+            output.Write(FileContent.Array, FileContent.Offset, FileContent.Count);
     }
 
     public byte[] Encode()
     {
-        byte[] file_data = Encoding.UTF8.GetBytes(FileContent);
-        byte[] msg = new byte[4 + 2 + 256 + 256 + 4 + file_data.Length];
+        byte[] msg = new byte[4 + 2 + 256 + 256 + 4 + FileContent.Count];
 
         Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) msg.Length - 4), 0, msg, 0, 4);
         Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt16) MessageType.FileContent), 0, msg, 4, 2);
 
         Buffer.BlockCopy(RootPath.PaddedByteArray(256),     0 , msg,   6, 256);
         Buffer.BlockCopy(RelativeName.PaddedByteArray(256), 0 , msg, 262, 256);
-        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) file_data.Length), 0, msg, 518, 4);
-        Buffer.BlockCopy(file_data, 0, msg, 522, file_data.Length);
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) FileContent.Count), 0, msg, 518, 4);
+        Buffer.BlockCopy(FileContent.Array, FileContent.Offset, msg, 522, FileContent.Count);
 
         return msg;
     }
@@ -56,6 +68,6 @@ public class FileContentMessage : IProtocolMessage
     public override string ToString()
     {
         return String.Format("<FileContent root='{0}' name='{1}' size={2}>",
-            RootPath, RelativeName, FileContent.Length);
+            RootPath, RelativeName, FileContent.Count);
     }
 }
\ No newline at end of file
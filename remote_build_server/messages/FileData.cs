@@ -0,0 +1,47 @@
+using System;
+using System.Text;
+using MiscUtil.Conversion;
+
+public class FileDataMessage : IProtocolMessage
+{
+    public ArraySegment<byte> Data { get ; private set; }
+
+    public MessageType MsgID { get ; private set; } = MessageType.FileData;
+    public bool CloseAfterSending { get ; set; } = false;
+
+
+    public FileDataMessage(byte[] content, int offset, int length)
+    {
+        Data = new ArraySegment<byte>(content, offset, length);
+    }
+
+    public FileDataMessage(byte[] data)
+    {
+        if (data.Length < 2 + 4)
+            throw new ArgumentException("Message data length is invalid");
+
+        UInt32 length = ProtocolMessageFactory.Converter.ToUInt32(data, 2);
+
+        if (data.Length != 2 + 4 + length)
+            throw new ArgumentException("Message data length is invalid");
+
+        Data = new ArraySegment<byte>(data, 6, (int) length);
+    }
+
+    public byte[] Encode()
+    {
+        byte[] msg = new byte[4 + 2 + 4 + Data.Count];
+
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) msg.Length - 4), 0, msg, 0, 4);
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt16) MessageType.FileData), 0, msg, 4, 2);
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) Data.Count), 0, msg, 6, 4);
+        Buffer.BlockCopy(Data.Array, Data.Offset, msg, 10, Data.Count);
+
+        return msg;
+    }
+
+    public override string ToString()
+    {
+        return String.Format("<FileData size={0}>", Data.Count);
+    }
+}
@@ -0,0 +1,47 @@
+using System;
+using System.Text;
+using MiscUtil.Conversion;
+
+public class FileEndMessage : IProtocolMessage
+{
+    public string RootPath { get ; private set; } = null;
+    public string RelativeName { get ; private set; } = null;
+
+    public MessageType MsgID { get ; private set; } = MessageType.FileEnd;
+    public bool CloseAfterSending { get ; set; } = false;
+
+
+    public FileEndMessage(string root, string name)
+    {
+        RootPath = root;
+        RelativeName = name;
+    }
+
+    public FileEndMessage(byte[] data)
+    {
+        if (data.Length != 2 + 256 + 256)
+            throw new ArgumentException("Message data length is invalid");
+
+        RootPath = Extensions.GetFixedWidthString(data, 2, 256);
+        RelativeName = Extensions.GetFixedWidthString(data, 258, 256);
+    }
+
+    public byte[] Encode()
+    {
+        byte[] msg = new byte[4 + 2 + 256 + 256];
+
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) msg.Length - 4), 0, msg, 0, 4);
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt16) MessageType.FileEnd), 0, msg, 4, 2);
+
+        Buffer.BlockCopy(RootPath.PaddedByteArray(256),     0 , msg,   6, 256);
+        Buffer.BlockCopy(RelativeName.PaddedByteArray(256), 0 , msg, 262, 256);
+
+        return msg;
+    }
+
+    public override string ToString()
+    {
+        return String.Format("<FileEnd root='{0}' name='{1}'>",
+            RootPath, RelativeName);
+    }
+}
@@ -0,0 +1,51 @@
+using System;
+using System.Text;
+using MiscUtil.Conversion;
+
+public class FileStartMessage : IProtocolMessage
+{
+    public string RootPath { get ; private set; } = null;
+    public string RelativeName { get ; private set; } = null;
+    public UInt64 FileLength { get ; private set; } = 0;
+
+    public MessageType MsgID { get ; private set; } = MessageType.FileStart;
+    public bool CloseAfterSending { get ; set; } = false;
+
+
+    public FileStartMessage(string root, string name, UInt64 length)
+    {
+        RootPath = root;
+        RelativeName = name;
+        FileLength = length;
+    }
+
+    public FileStartMessage(byte[] data)
+    {
+        if (data.Length != 2 + 256 + 256 + 8)
+            throw new ArgumentException("Message data length is invalid");
+
+        RootPath = Extensions.GetFixedWidthString(data, 2, 256);
+        RelativeName = Extensions.GetFixedWidthString(data, 258, 256);
+        FileLength = ProtocolMessageFactory.Converter.ToUInt64(data, 514);
+    }
+
+    public byte[] Encode()
+    {
+        byte[] msg = new byte[4 + 2 + 256 + 256 + 8];
+
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) msg.Length - 4), 0, msg, 0, 4);
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt16) MessageType.FileStart), 0, msg, 4, 2);
+
+        Buffer.BlockCopy(RootPath.PaddedByteArray(256),     0 , msg,   6, 256);
+        Buffer.BlockCopy(RelativeName.PaddedByteArray(256), 0 , msg, 262, 256);
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes(FileLength), 0, msg, 518, 8);
+
+        return msg;
+    }
+
+    public override string ToString()
+    {
+        return String.Format("<FileStart root='{0}' name='{1}' size={2}>",
+            RootPath, RelativeName, FileLength);
+    }
+}
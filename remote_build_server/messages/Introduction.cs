@@ -1,5 +1,6 @@
 using System;
 using System.Text;
+using System.Collections.Generic;
 using MiscUtil.Conversion;
 
 
@@ -8,12 +9,15 @@ public class IntroductionMessage : IProtocolMessage
     /// <summary>
     /// The protocol version
     /// </summary>
-    public byte ProtocolVersion { get ; private set; } = 1;
+    public byte ProtocolVersion { get ; private set; } = 2;
 
     public string User { get ; private set; }
     public string Password { get; private set; }
     public string Hostname { get; private set; }
     public string Platform { get; private set; }
+    // The compression codecs that the client supports, in the order that it
+    // prefers them; version 1 clients don't offer any.
+    public List<string> Codecs { get; private set; } = new List<string>();
 
     public MessageType MsgID { get ; private set; } = MessageType.Introduction;
     public bool CloseAfterSending { get ; set; } = false;
@@ -28,20 +32,41 @@ public class IntroductionMessage : IProtocolMessage
 
     public IntroductionMessage(byte[] data)
     {
-        if (data.Length != 2 + 1 + 64 + 64 + 64 + 8)
+        if (data.Length < 2 + 1 + 64 + 64 + 64 + 8)
             throw new ArgumentException("Message data length is invalid");
 
         ProtocolVersion = data[2];
 
+        if (ProtocolVersion == 1 && data.Length != 2 + 1 + 64 + 64 + 64 + 8)
+            throw new ArgumentException("Message data length is invalid");
+
         User = Extensions.GetFixedWidthString(data, 3, 64);
         Password = Extensions.GetFixedWidthString(data, 67, 64);
         Hostname = Extensions.GetFixedWidthString(data, 131, 64);
         Platform = Extensions.GetFixedWidthString(data, 195, 8);
+
+        if (ProtocolVersion >= 2)
+        {
+            if (data.Length < 203 + 4)
+                throw new ArgumentException("Message data length is invalid");
+
+            UInt32 codecLength = ProtocolMessageFactory.Converter.ToUInt32(data, 203);
+
+            if (data.Length != 207 + codecLength)
+                throw new ArgumentException("Message data length is invalid");
+
+            string codecs = Encoding.UTF8.GetString(data, 207, (int) codecLength);
+            if (codecs != "")
+                Codecs.AddRange(codecs.Split(','));
+        }
     }
 
     public byte[] Encode()
     {
-        byte[] msg = new byte[4 + 2 + 1 + 64 + 64 + 64 + 8];
+        byte[] codecBytes = Encoding.UTF8.GetBytes(String.Join(",", Codecs));
+        UInt32 codecLength = (UInt32) codecBytes.Length;
+
+        byte[] msg = new byte[4 + 2 + 1 + 64 + 64 + 64 + 8 + 4 + codecLength];
 
         Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) msg.Length - 4), 0, msg, 0, 4);
         Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt16) MessageType.Introduction), 0, msg, 4, 2);
@@ -51,13 +76,15 @@ public class IntroductionMessage : IProtocolMessage
         Buffer.BlockCopy(Password.PaddedByteArray(64), 0, msg, 71, 64);
         Buffer.BlockCopy(Hostname.PaddedByteArray(64), 0, msg, 135, 64);
         Buffer.BlockCopy(Platform.PaddedByteArray(8), 0, msg, 199, 8);
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes(codecLength), 0, msg, 207, 4);
+        Buffer.BlockCopy(codecBytes, 0, msg, 211, (int) codecLength);
 
         return msg;
     }
 
     public override string ToString()
     {
-        return String.Format("<Introduction user={0} host={1} platform={2} version={3}>",
-            User, Hostname, Platform, ProtocolVersion);
+        return String.Format("<Introduction user={0} host={1} platform={2} version={3} codecs={4}>",
+            User, Hostname, Platform, ProtocolVersion, String.Join(",", Codecs));
     }
 }
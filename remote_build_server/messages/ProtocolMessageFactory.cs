@@ -16,6 +16,15 @@ public enum MessageType
     ExecuteBuild = 6,
     BuildOutput = 7,
     BuildComplete = 8,
+    FileChunkList = 9,
+    ChunkRequest = 10,
+    FileChunks = 11,
+    CopyFile = 12,
+    FileStart = 13,
+    FileData = 14,
+    FileEnd = 15,
+    Compressed = 16,
+    SetCompression = 17,
 }
 
 // An interface that represents a protocol message;
@@ -69,6 +78,35 @@ public class ProtocolMessageFactory
             case MessageType.BuildComplete:
                 return new BuildCompleteMessage(data);
 
+            case MessageType.FileChunkList:
+                return new FileChunkListMessage(data);
+
+            case MessageType.ChunkRequest:
+                return new ChunkRequestMessage(data);
+
+            case MessageType.FileChunks:
+                return new FileChunksMessage(data);
+
+            case MessageType.CopyFile:
+                return new CopyFileMessage(data);
+
+            case MessageType.FileStart:
+                return new FileStartMessage(data);
+
+            case MessageType.FileData:
+                return new FileDataMessage(data);
+
+            case MessageType.FileEnd:
+                return new FileEndMessage(data);
+
+            // A compressed message is never seen as such; it decodes to the
+            // message that it carries.
+            case MessageType.Compressed:
+                return new CompressedMessage(data).Unwrap();
+
+            case MessageType.SetCompression:
+                return new SetCompressionMessage(data);
+
             default:
                 throw new ArgumentOutOfRangeException("Unrecognized message type");
         }
@@ -0,0 +1,50 @@
+using System;
+using System.Text;
+using MiscUtil.Conversion;
+
+public class SetCompressionMessage : IProtocolMessage
+{
+    public string Codec { get ; private set; } = null;
+
+    public MessageType MsgID { get ; private set; } = MessageType.SetCompression;
+    public bool CloseAfterSending { get ; set; } = false;
+
+
+    public SetCompressionMessage(string codec)
+    {
+        Codec = codec;
+    }
+
+    public SetCompressionMessage(byte[] data)
+    {
+        if (data.Length < 6)
+            throw new ArgumentException("Message data length is invalid");
+
+        UInt32 codecLength = ProtocolMessageFactory.Converter.ToUInt32(data, 2);
+
+        if (data.Length < 6 + codecLength)
+            throw new ArgumentException("Message data length is invalid");
+
+        Codec = Encoding.UTF8.GetString(data, 6, (int) codecLength);
+    }
+
+    public byte[] Encode()
+    {
+        byte[] codecBytes = Encoding.UTF8.GetBytes(Codec);
+        UInt32 codecLength = (UInt32) codecBytes.Length;
+
+        byte[] msg = new byte[4 + 2 + 4 + codecLength];
+
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt32) msg.Length - 4), 0, msg, 0, 4);
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes((UInt16) MessageType.SetCompression), 0, msg, 4, 2);
+        Buffer.BlockCopy(ProtocolMessageFactory.Converter.GetBytes(codecLength), 0, msg, 6, 4);
+        Buffer.BlockCopy(codecBytes, 0, msg, 10, (int) codecLength);
+
+        return msg;
+    }
+
+    public override string ToString()
+    {
+        return String.Format("<SetCompression codec='{0}'>", Codec);
+    }
+}
@@ -2,9 +2,21 @@ import sublime
 import sublime_plugin
 
 from pprint import pprint
+import struct
 import json
 
 from .file_gather import find_project_files, calculate_fileset_deltas
+from .digests import benchmark
+from .messages import ProtocolMessage, IntroductionMessage
+from .messages import MessageMessage, ErrorMessage
+from .messages import SetBuildMessage, AcknowledgeMessage
+from .messages import FileContentMessage, ExecuteBuildMessage
+from .messages import BuildOutputMessage, BuildCompleteMessage
+from .messages import FileChunkListMessage, ChunkRequestMessage
+from .messages import FileChunksMessage, CopyFileMessage
+from .messages import FileStartMessage, FileDataMessage, FileEndMessage
+from .messages import CompressedMessage, SetCompressionMessage
+from .compression import CODECS
 
 
 ### ---------------------------------------------------------------------------
@@ -87,3 +99,186 @@ class FileGatherCommand(sublime_plugin.WindowCommand):
             ])
         diffed = calculate_fileset_deltas(files, test_folder)
         print(json.dumps(diffed, indent=2, sort_keys=True))
+
+
+class DigestBenchmarkCommand(sublime_plugin.WindowCommand):
+    """
+    Report how fast each of the available digest algorithms can hash data on
+    this machine, fastest first, to help select the digest_algorithm setting.
+    """
+    def run(self, size_mb=64):
+        results = benchmark(size=size_mb * 1024 * 1024)
+        for name, speed in sorted(results.items(), key=lambda r: -r[1]):
+            print("{0:>10}: {1:8.1f} MB/s".format(name, speed))
+
+
+### ---------------------------------------------------------------------------
+
+
+def _frame(fmt, *values):
+    """
+    Pack a message the way that the hand written encoders did, prefixed with
+    its length.
+    """
+    data = struct.pack(">" + fmt, *values)
+    return struct.pack(">I", len(data)) + data
+
+
+def _codec_test_cases():
+    """
+    Return a list of (message, encoded, attributes) for every protocol
+    message; the encoded form is the byte layout that the server expects, and
+    the attributes are those that must survive a round trip.
+    """
+    root, name = "/home/tmartin/src", "sub/dir/file.cs"
+    digest = bytes(range(20))
+
+    return [
+        (IntroductionMessage("tmartin", "password", "host.local", "linux", ["deflate-6", "lzma"]),
+         _frame("HB64s64s64s8sI14s", 0, 2, b"tmartin", b"password", b"host.local", b"linux",
+                14, b"deflate-6,lzma"),
+         ["protocol_version", "user", "password", "hostname", "platform", "codecs"]),
+
+        (MessageMessage("Hello \u00e9"),
+         _frame("HI8s", 1, 8, "Hello \u00e9".encode("utf-8")),
+         ["msg"]),
+
+        (ErrorMessage(2001, "Oops"),
+         _frame("HII4s", 2, 2001, 4, b"Oops"),
+         ["error_code", "error_msg"]),
+
+        (SetBuildMessage("abc", ["/a", "/b"]),
+         _frame("HI9s", 3, 9, b"abc\x00/a\x00/b"),
+         ["build_id", "folders"]),
+
+        (AcknowledgeMessage(5, False),
+         _frame("HH?", 4, 5, False),
+         ["message_id", "positive"]),
+
+        (FileContentMessage(root, name, file_content=b"\x89PNG\xff\x00"),
+         _frame("H256s256sI6s", 5, root.encode(), name.encode(), 6, b"\x89PNG\xff\x00"),
+         ["root_path", "relative_name", "file_length", "file_content"]),
+
+        (ExecuteBuildMessage("make all"),
+         _frame("HI8s", 6, 8, b"make all"),
+         ["shell_cmd"]),
+
+        (BuildOutputMessage("warning", True),
+         _frame("H?I7s", 7, True, 7, b"warning"),
+         ["msg", "stdout"]),
+
+        (BuildCompleteMessage(2),
+         _frame("HH", 8, 2),
+         ["exit_code"]),
+
+        (FileChunkListMessage(root, name, [(digest, 100), (digest, 50)]),
+         _frame("H256s256sQI20sI20sI", 9, root.encode(), name.encode(), 150, 2,
+                digest, 100, digest, 50),
+         ["root_path", "relative_name", "file_length", "chunks"]),
+
+        (ChunkRequestMessage(root, name, [0, 3, 7]),
+         _frame("H256s256sI3I", 10, root.encode(), name.encode(), 3, 0, 3, 7),
+         ["root_path", "relative_name", "indices"]),
+
+        (FileChunksMessage(root, name, [(1, b"ab"), (4, b"cde")]),
+         _frame("H256s256sIII2sII3s", 11, root.encode(), name.encode(), 2,
+                1, 2, b"ab", 4, 3, b"cde"),
+         ["root_path", "relative_name", "chunks"]),
+
+        (CopyFileMessage(root, "a.cs", root, "b.cs"),
+         _frame("H256s256s256s256s", 12, root.encode(), b"a.cs", root.encode(), b"b.cs"),
+         ["source_root", "source_name", "root_path", "relative_name"]),
+
+        (FileStartMessage(root, name, 5 << 30),
+         _frame("H256s256sQ", 13, root.encode(), name.encode(), 5 << 30),
+         ["root_path", "relative_name", "file_length"]),
+
+        (FileDataMessage(b"data"),
+         _frame("HI4s", 14, 4, b"data"),
+         ["data"]),
+
+        (FileEndMessage(root, name),
+         _frame("H256s256s", 15, root.encode(), name.encode()),
+         ["root_path", "relative_name"]),
+
+        (SetCompressionMessage("deflate-6"),
+         _frame("HI9s", 17, 9, b"deflate-6"),
+         ["codec"]),
+    ]
+
+
+def _compression_test_cases():
+    """
+    Return a list of (message, attributes) for the messages that are sent
+    compressed; the attributes are those that must survive being compressed
+    and decompressed again.
+    """
+    root, name = "/home/tmartin/src", "sub/dir/file.cs"
+
+    return [
+        (FileContentMessage(root, name, file_content=b"using System;\n" * 200),
+         ["root_path", "relative_name", "file_length", "file_content"]),
+
+        (BuildOutputMessage("warning CS0168: unused variable " * 50, False),
+         ["msg", "stdout"]),
+
+        (FileChunkListMessage(root, name, [(b"\x01" * 20, 8192)] * 100),
+         ["root_path", "relative_name", "file_length", "chunks"]),
+
+        (FileChunksMessage(root, name, [(3, b"using System;\n" * 100),
+                                        (7, b"namespace Test {}\n" * 100)]),
+         ["root_path", "relative_name", "chunks"]),
+
+        (FileDataMessage(b"using System;\n" * 200),
+         ["data"]),
+    ]
+
+
+class MessageCodecTestCommand(sublime_plugin.WindowCommand):
+    """
+    Check that every protocol message encodes to exactly the byte layout of
+    the hand written encoders that the message schemas replaced (which is
+    what the server expects), and that the encoded form decodes back to the
+    same message.
+    """
+    def run(self):
+        failures = 0
+        for msg, expected, attributes in _codec_test_cases():
+            encoded = msg.encode()
+            decoded = ProtocolMessage.from_data(expected[4:])
+
+            problems = []
+            if encoded != expected:
+                problems.append("encoded form differs")
+
+            for attribute in attributes:
+                if getattr(decoded, attribute) != getattr(msg, attribute):
+                    problems.append("{0} is {1!r}, expected {2!r}".format(
+                        attribute, getattr(decoded, attribute), getattr(msg, attribute)))
+
+            failures += len(problems) > 0
+            print("{0:>24}: {1}".format(type(msg).__name__, "; ".join(problems) or "ok"))
+
+        print("{0} of {1} messages failed".format(failures, len(_codec_test_cases())))
+
+        # A compressed message decodes to the message that it carries.
+        failures = 0
+        for codec in CODECS:
+            for msg, attributes in _compression_test_cases():
+                wrapped = CompressedMessage.wrap(codec, msg)
+                decoded = ProtocolMessage.from_data(wrapped.encode()[4:])
+
+                problems = []
+                if not isinstance(wrapped, CompressedMessage):
+                    problems.append("not compressed")
+
+                for attribute in attributes:
+                    if getattr(decoded, attribute) != getattr(msg, attribute):
+                        problems.append("{0} differs".format(attribute))
+
+                failures += len(problems) > 0
+                print("{0:>24}: {1}".format(codec + " " + type(msg).__name__,
+                                            "; ".join(problems) or "ok"))
+
+        print("{0} of {1} compressed messages failed".format(
+            failures, len(CODECS) * len(_compression_test_cases())))